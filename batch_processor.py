@@ -0,0 +1,196 @@
+"""
+Processing of many images of one request: uploaded images or members of zip archives are read one by one,
+decoded by a thread pool, detected in batches of the same size and drawn and encoded by the pool again.
+Results are written to a zip archive streamed to the client while the next images are processed, so memory
+holds only two batches of images, not the whole upload or result.
+"""
+import functools
+import json
+import logging
+import os
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict
+
+import cv2
+import numpy as np
+from werkzeug.utils import secure_filename
+
+from frame import Frame
+from metrics import STAGE_SECONDS, FRAMES
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp', '.tif', '.tiff', '.webp')
+
+
+class BatchLimitError(Exception):
+    """Raised when an upload has more images than allowed or an image larger than allowed."""
+
+
+def list_uploaded_images(uploads, max_images=1000, max_image_bytes=50 << 20):
+    """
+    Lists images of uploaded files without reading them, zip archives are listed by their central directory,
+    so limits are checked before any image is processed.
+    :param uploads: [list of tuple] name and path of every saved upload, an image or a zip archive of images
+    :param max_images: [int] maximum number of images
+    :param max_image_bytes: [int] maximum size of an image
+    :return: [tuple] list of name and function reading bytes of every image, and list of opened archives
+    """
+    images, archives = [], []
+    for name, path in uploads:
+        if zipfile.is_zipfile(path):
+            archive = zipfile.ZipFile(path)
+            archives.append(archive)
+            members = [info for info in archive.infolist() if not info.filename.endswith('/')
+                       and os.path.splitext(info.filename)[1].lower() in IMAGE_EXTENSIONS]
+            for info in members:
+                if info.file_size > max_image_bytes:
+                    raise BatchLimitError('Image {} is larger than {} bytes.'.format(info.filename, max_image_bytes))
+            images.extend((info.filename, functools.partial(archive.read, info)) for info in members)
+        else:
+            if os.path.getsize(path) > max_image_bytes:
+                raise BatchLimitError('Image {} is larger than {} bytes.'.format(name, max_image_bytes))
+            images.append((name, functools.partial(_read_file, path)))
+        if len(images) > max_images:
+            raise BatchLimitError('Upload has more than {} images.'.format(max_images))
+    return images, archives
+
+
+def _read_file(path):
+    with open(path, 'rb') as image_file:
+        return image_file.read()
+
+
+def output_name(index, name):
+    """
+    :param index: [int] number of the image in the upload
+    :param name: [str] name of the image in the upload, may contain directories of an archive
+    :return: [str] unique name of the processed image in the result archive
+    """
+    name = secure_filename(os.path.basename(name)) or 'image'
+    if os.path.splitext(name)[1].lower() not in IMAGE_EXTENSIONS:
+        name = '{}.jpg'.format(name)
+    return 'processed/{:05d}_{}'.format(index, name)
+
+
+class _ZipStream:
+    """File-like object, that collects bytes written by ZipFile, so they can be sent before the archive is done."""
+
+    def __init__(self):
+        self._chunks = []
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def pop(self):
+        """
+        :return: [bytes] bytes written since the last call
+        """
+        data = b''.join(self._chunks)
+        self._chunks = []
+        return data
+
+
+class BatchImageProcessor:
+    """
+    Class, that detects persons and faces of many images and gives a zip archive of drawn images with manifest.json,
+    the list of detections of every image (see Frame.to_dict) or its error.
+    detect_persons takes a list of Frames of the same size and sets their persons (and faces, if detect_faces
+    is None); detect_faces takes one Frame with persons and sets its faces, it runs in threads of the pool.
+    While a batch is detected, the next one is decoded.
+    """
+
+    def __init__(self, detect_persons, detect_faces=None, batch_size=8, threads=4, group_key=None):
+        self.detect_persons = detect_persons
+        self.detect_faces = detect_faces
+        self.batch_size = max(1, batch_size)
+        self.threads = max(1, threads)
+        # Images of one call of detect_persons have the same key, the image shape by default
+        self.group_key = group_key or (lambda image: image.shape)
+
+    def process(self, images):
+        """
+        :param images: [list of tuple] name and function reading bytes of every image (see list_uploaded_images)
+        :return: [generator of tuple] index, name, Frame (None if the image can not be decoded) and encoded image
+        """
+        images = iter(images)
+        with ThreadPoolExecutor(max_workers=self.threads) as executor:
+            batch = self.__decode_next(executor, images, 0)
+            while batch:
+                decoded = [(index, name, future.result()) for index, name, future in batch]
+                batch = self.__decode_next(executor, images, decoded[-1][0] + 1)
+                frames = [(index, name, Frame(image) if image is not None else None) for index, name, image in decoded]
+                self.__detect(executor, [current_frame for _, _, current_frame in frames if current_frame is not None])
+                encoded = [executor.submit(self.__draw_and_encode, current_frame, name) if current_frame is not None
+                           else None for _, name, current_frame in frames]
+                for (index, name, current_frame), future in zip(frames, encoded):
+                    yield index, name, current_frame, future.result() if future is not None else None
+
+    def zip_archive(self, images):
+        """
+        :param images: [list of tuple] name and function reading bytes of every image (see list_uploaded_images)
+        :return: [generator of bytes] zip archive with processed images and manifest.json
+        """
+        stream = _ZipStream()
+        archive = zipfile.ZipFile(stream, 'w', zipfile.ZIP_STORED)
+        manifest = []
+        for index, name, current_frame, data in self.process(images):
+            entry = OrderedDict([('index', index), ('name', name)])
+            if current_frame is None or data is None:
+                entry['error'] = 'Image can not be decoded.' if current_frame is None else 'Image can not be encoded.'
+            else:
+                entry['file'] = output_name(index, name)
+                entry['persons'] = current_frame.to_dict(index)['persons']
+                # Images are already compressed
+                archive.writestr(entry['file'], data)
+            manifest.append(entry)
+            yield stream.pop()
+        archive.writestr(zipfile.ZipInfo('manifest.json'), json.dumps(manifest), zipfile.ZIP_DEFLATED)
+        archive.close()
+        logging.log(logging.INFO, 'Batch of {} images processed, {} failed.'.format(
+            len(manifest), sum(1 for entry in manifest if 'error' in entry)))
+        yield stream.pop()
+
+    def __decode_next(self, executor, images, first_index):
+        batch = []
+        for index in range(first_index, first_index + self.batch_size):
+            item = next(images, None)
+            if item is None:
+                break
+            name, read = item
+            # Images are read one by one in this thread, archives are not shared between threads
+            batch.append((index, name, executor.submit(self.__decode, read())))
+        return batch
+
+    @staticmethod
+    def __decode(data):
+        with STAGE_SECONDS.time(('decode',)):
+            return cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_COLOR)
+
+    def __detect(self, executor, frames):
+        groups = OrderedDict()
+        for current_frame in frames:
+            groups.setdefault(self.group_key(current_frame.image), []).append(current_frame)
+        for group in groups.values():
+            with STAGE_SECONDS.time(('person_inference',)):
+                self.detect_persons(group)
+        if self.detect_faces is not None:
+            list(executor.map(self.__detect_faces, frames))
+        FRAMES.inc(len(frames))
+
+    def __detect_faces(self, current_frame):
+        with STAGE_SECONDS.time(('face_detection',)):
+            self.detect_faces(current_frame)
+
+    @staticmethod
+    def __draw_and_encode(current_frame, name):
+        extension = os.path.splitext(output_name(0, name))[1]
+        with STAGE_SECONDS.time(('draw',)):
+            current_frame.draw_all_labeled_bounding_boxes()
+        with STAGE_SECONDS.time(('encode',)):
+            is_encoded, data = cv2.imencode(extension if extension in IMAGE_EXTENSIONS else '.jpg',
+                                            current_frame.image)
+        return data.tobytes() if is_encoded else None
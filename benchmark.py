@@ -0,0 +1,591 @@
+"""
+Benchmarks of person detection pipeline, results are printed as JSON.
+
+    python benchmark.py faces [--image test_data/images/test_image_1.jpg] [--persons 1 2 4 8 16] [--repeat 5]
+    python benchmark.py face-roi [--images test_data/images] [--persons 1 4 16] [--repeat 5]
+    python benchmark.py draw [--persons 1 8 32] [--frames 200] [--resolution 1280x720]
+    python benchmark.py pipeline [--resolutions 640x360 1280x720] [--persons 1 8] [--frames 100]
+                                 [--person-latency 0.01] [--face-latency 0.001] [--real-models]
+                                 [--output results.json] [--baseline results.json] [--tolerance 0.1]
+    python benchmark.py backends [--backends tensorflow opencv] [--image test_data/images/test_image_1.jpg]
+                                 [--batch-size 1] [--repeat 20]
+
+faces - compares face search in every person crop with a single face search per frame
+        as the number of persons per frame grows.
+face-roi - compares face detection time per person of the whole person crop with one upsampling
+           and of the head region with upsampling chosen from its height, on every image and on synthetic crowds.
+draw - measures time and memory allocated by drawing boxes and labels of persons and faces on a frame.
+pipeline - runs synthetic videos and images of several resolutions and person densities through
+           ModelManager and Frame drawing, video_processor and Flask endpoints. Detectors are deterministic
+           stubs with given latency (or real models with --real-models), so overhead of the pipeline is measured
+           without model weights. Reports FPS, percentiles of per-frame latency, per-stage breakdown and peak RSS
+           of every case, measured in a separate process;
+           with --baseline exits with code 1 if FPS or latency of a case is worse than the baseline beyond tolerance.
+backends - loads the model with every inference backend in a separate process and compares load time,
+           latency of person detection, found persons and peak RSS.
+"""
+import argparse
+import io
+import json
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+from collections import OrderedDict
+from time import time, sleep
+
+import cv2
+import numpy as np
+
+from face_detector import FaceDetector
+from frame import Frame
+from model_manager import ModelManager
+
+# Cases of benchmark_pipeline measured for every resolution and number of persons
+PIPELINE_CASES = ('frames', 'video', 'endpoint-json', 'endpoint-job')
+
+
+def synthetic_crowd(image, face_boxes, persons):
+    """
+    Builds a frame with given number of persons: the image is tiled horizontally and person boxes
+    are derived from faces found on it (a body is about 3 faces wide and 7 faces high).
+    :param image: [numpy array] BGR image with people
+    :param face_boxes: [numpy array] int32 array [M, 4] of (x1, y1, x2, y2) faces on image
+    :param persons: [int] number of persons in the frame
+    :return: [tuple] frame image and int32 array [persons, 4] of (top, left, bottom, right) boxes
+    """
+    height, width = image.shape[:2]
+    tiles = int(np.ceil(float(persons) / len(face_boxes)))
+    frame_image = np.concatenate([image] * tiles, axis=1)
+
+    boxes = []
+    for tile in range(tiles):
+        for x1, y1, x2, y2 in face_boxes.tolist():
+            face_w, face_h = x2 - x1, y2 - y1
+            boxes.append([max(0, y1 - face_h // 2),
+                          tile * width + max(0, x1 - face_w),
+                          min(height, y1 + 7 * face_h),
+                          tile * width + min(width, x2 + face_w)])
+    return frame_image, np.array(boxes[:persons], dtype=np.int32)
+
+
+def benchmark_face_strategies(image, persons_counts, repeat=5, threshold_face=0.1):
+    """
+    Measures face detection time per frame of both ModelManager face modes.
+    :param image: [numpy array] BGR image with people
+    :param persons_counts: [list of int] numbers of persons per frame to measure
+    :param repeat: [int] number of runs of every measurement
+    :param threshold_face: [float] threshold of face detection algorithm
+    :return: [list of dict] mean seconds per frame and found faces of each mode for every number of persons
+    """
+    model_manager = ModelManager(models={'face_detector': FaceDetector()})
+    face_boxes, _ = model_manager.models['face_detector'].detect_faces_scored(image, threshold_face)
+    if not len(face_boxes):
+        raise ValueError('No faces found on benchmark image.')
+
+    results = []
+    for persons in persons_counts:
+        frame_image, person_boxes = synthetic_crowd(image, face_boxes, persons)
+        result = {'persons': persons}
+        for face_mode in ('person', 'frame'):
+            elapsed = []
+            for _ in range(repeat):
+                frame = Frame(frame_image)
+                frame.set_person_boxes(person_boxes)
+                start = time()
+                model_manager.put_face_predictions_into_frame(frame, threshold_face, face_mode)
+                elapsed.append(time() - start)
+            result[face_mode] = {
+                'seconds_per_frame': float(np.mean(elapsed)),
+                'faces': int(np.sum(frame.person_faces >= 0)),
+            }
+        results.append(result)
+    return results
+
+
+def benchmark_face_roi(images, persons_counts, repeat=5, threshold_face=0.1):
+    """
+    Measures face detection time per person in person crops and in their head regions.
+    Persons are derived from faces found on every image (see synthetic_crowd).
+    :param images: [list of tuple] name and BGR image with people
+    :param persons_counts: [list of int] numbers of persons of synthetic crowds made of every image
+    :param repeat: [int] number of runs of every measurement
+    :param threshold_face: [float] threshold of face detection algorithm
+    :return: [list of dict] mean seconds per person and found faces of both searches for every case
+    """
+    searches = OrderedDict([
+        ('whole_crop', FaceDetector(upsample=1)),
+        ('head_roi', FaceDetector(head_ratio=0.4, min_crop_size=20)),
+    ])
+    results = []
+    for name, image in images:
+        face_boxes, _ = searches['whole_crop'].detect_faces_scored(image, threshold_face)
+        if not len(face_boxes):
+            continue
+        for persons in [len(face_boxes)] + list(persons_counts):
+            frame_image, person_boxes = synthetic_crowd(image, face_boxes, persons)
+            result = OrderedDict([('image', name), ('persons', len(person_boxes))])
+            for search, face_detector in searches.items():
+                model_manager = ModelManager(models={'face_detector': face_detector})
+                elapsed = []
+                for _ in range(repeat):
+                    frame = Frame(frame_image)
+                    frame.set_person_boxes(person_boxes)
+                    start = time()
+                    model_manager.put_face_predictions_into_frame(frame, threshold_face)
+                    elapsed.append(time() - start)
+                result[search] = {
+                    'seconds_per_person': float(np.mean(elapsed)) / len(person_boxes),
+                    'faces': int(np.sum(frame.person_faces >= 0)),
+                }
+            result['speedup'] = result['whole_crop']['seconds_per_person'] / result['head_roi']['seconds_per_person']
+            results.append(result)
+    return results
+
+
+def benchmark_draw(persons_counts, frames=200, resolution=(1280, 720)):
+    """
+    Measures Frame drawing of persons and faces (every second person has a face) and memory it allocates.
+    :param persons_counts: [list of int] numbers of persons per frame
+    :param frames: [int] number of drawn frames of every case
+    :param resolution: [tuple] width and height of frames
+    :return: [list of dict] mean seconds per frame and peak traced allocations per frame for every case
+    """
+    import tracemalloc
+    width, height = resolution
+    image = synthetic_image(width, height, max(persons_counts))
+    results = []
+    for persons in persons_counts:
+        step = max(width // persons, 1)
+        person_boxes = np.array([[height // 8, i * step, height - height // 8, i * step + step // 2]
+                                 for i in range(persons)], dtype=np.int32)
+        person_scores = np.linspace(0.99, 0.5, persons).astype(np.float32)
+        face_boxes = np.array([[left, top, left + step // 4, top + step // 4]
+                               for top, left, _, _ in person_boxes[::2].tolist()], dtype=np.int32).reshape(-1, 4)
+        person_faces = np.where(np.arange(persons) % 2 == 0, np.arange(persons) // 2, -1).astype(np.int32)
+
+        def draw(frame_image):
+            frame = Frame(frame_image)
+            frame.set_person_boxes(person_boxes)
+            frame.set_person_scores(person_scores)
+            frame.set_faces(face_boxes, person_faces)
+            frame.draw_all_labeled_bounding_boxes()
+
+        elapsed = 0.0
+        for _ in range(frames):
+            frame_image = image.copy()
+            start = time()
+            draw(frame_image)
+            elapsed += time() - start
+        tracemalloc.start()
+        draw(frame_image)
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        results.append(OrderedDict([
+            ('persons', persons),
+            ('seconds_per_frame', elapsed / frames),
+            ('peak_allocated_bytes', peak),
+        ]))
+    return results
+
+
+class StubPersonDetector:
+    """
+    Class with interface of PersonDetector, that finds the same persons on every frame: a row of boxes
+    across the frame with scores from 0.95 down. Sleeps latency seconds per frame instead of inference.
+    """
+
+    def __init__(self, persons=4, latency=0.0):
+        self.persons = persons
+        self.latency = latency
+        self.model_hash = 'stub'
+        self.inference_size = None
+
+    def build_graph(self):
+        return OrderedDict()
+
+    def predict_persons(self, frame, threshold):
+        return self.predict_persons_batch([frame], threshold)[0]
+
+    def predict_persons_batch(self, frames, threshold):
+        sleep(self.latency * len(frames))
+        results = []
+        for frame in frames:
+            height, width = frame.shape[:2]
+            step = width // max(self.persons, 1)
+            boxes = np.array([[height // 8, i * step, height - height // 8, (i + 1) * step - 1]
+                              for i in range(self.persons)], dtype=np.int32).reshape(-1, 4)
+            scores = np.linspace(0.95, 0.55, self.persons).astype(np.float32)
+            selected = scores > threshold
+            results.append((boxes[selected], scores[selected]))
+        return results
+
+
+class StubFaceDetector:
+    """
+    Class with interface of FaceDetector, that finds a face in the top part of every person.
+    Sleeps latency seconds per detector run: per person crop, or per frame in 'frame' face mode.
+    """
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.face_size = None
+        self.frame_scale = 1.0
+
+    def copy(self):
+        return StubFaceDetector(self.latency)
+
+    def detect_face_candidates(self, person):
+        sleep(self.latency)
+        (top, left), (bottom, right) = person[1]
+        return self.__face_of(top, left, bottom, right)
+
+    def detect_face_candidates_of_persons(self, image, person_boxes):
+        sleep(self.latency)
+        return [self.__face_of(*box) for box in person_boxes.tolist()]
+
+    @staticmethod
+    def __face_of(top, left, bottom, right):
+        size = max((right - left) // 3, 1)
+        x1 = left + (right - left - size) // 2
+        return np.array([[x1, top, x1 + size, top + size]], dtype=np.int32), np.array([0.9], dtype=np.float32)
+
+
+def synthetic_image(width, height, persons, shift=0):
+    """
+    :param width: [int] width of image
+    :param height: [int] height of image
+    :param persons: [int] number of person-like figures
+    :param shift: [int] horizontal shift of figures in pixels, so frames of a video differ
+    :return: [numpy array] BGR image with a row of figures on noise background
+    """
+    image = np.random.RandomState(shift).randint(0, 64, (height, width, 3)).astype(np.uint8)
+    step = width // max(persons, 1)
+    for i in range(persons):
+        left = (i * step + shift) % width
+        cv2.rectangle(image, (left, height // 8), (left + step // 2, height - height // 8), (60, 120, 200), -1)
+        cv2.circle(image, (left + step // 4, height // 8 + step // 6), max(step // 8, 1), (150, 180, 220), -1)
+    return image
+
+
+def synthetic_video(path, width, height, persons, frames, fps=25):
+    """
+    Writes a video with figures moving horizontally.
+    :param path: [str] path to .avi file
+    :return: [str] path
+    """
+    writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*'MJPG'), fps, (width, height))
+    for i in range(frames):
+        writer.write(synthetic_image(width, height, persons, shift=2 * i))
+    writer.release()
+    return path
+
+
+def latency_percentiles(latencies):
+    """
+    :param latencies: [list of float] seconds
+    :return: [OrderedDict] 50th, 95th and 99th percentiles
+    """
+    p50, p95, p99 = np.percentile(latencies, [50, 95, 99]).tolist() if len(latencies) else (0.0, 0.0, 0.0)
+    return OrderedDict([('p50', p50), ('p95', p95), ('p99', p99)])
+
+
+def peak_rss_mb():
+    """
+    :return: [float or None] peak resident memory of the process in MiB, None if it is not known
+    """
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return peak / (1024.0 * 1024.0) if sys.platform == 'darwin' else peak / 1024.0
+
+
+def create_model_manager(persons, args):
+    """
+    :return: [ModelManager obj] manager with real models or stubs finding given number of persons
+    """
+    if args.real_models:
+        model_manager = ModelManager()
+        model_manager.build_graph()
+        return model_manager
+    return ModelManager(models={
+        'person_detector': StubPersonDetector(persons=persons, latency=args.person_latency),
+        'face_detector': StubFaceDetector(latency=args.face_latency),
+    })
+
+
+def benchmark_frames(model_manager, image, frames, threshold_person=0.5, threshold_face=0.1):
+    """
+    Measures ModelManager.put_all_predictions_into_frame and Frame drawing frame by frame.
+    :return: [dict] FPS, latency percentiles and time of both steps
+    """
+    detect, draw = [], []
+    start = time()
+    for _ in range(frames):
+        frame = Frame(image.copy())
+        step_start = time()
+        model_manager.put_all_predictions_into_frame(frame, threshold_person, threshold_face)
+        detect.append(time() - step_start)
+        step_start = time()
+        frame.draw_all_labeled_bounding_boxes()
+        draw.append(time() - step_start)
+    elapsed = time() - start
+    return OrderedDict([
+        ('fps', frames / elapsed),
+        ('latency', latency_percentiles(np.add(detect, draw))),
+        ('stages', OrderedDict([
+            ('detect', {'busy_time': float(np.sum(detect)), 'latency': latency_percentiles(detect)}),
+            ('draw', {'busy_time': float(np.sum(draw)), 'latency': latency_percentiles(draw)}),
+        ])),
+    ])
+
+
+def benchmark_video(model_manager, video_path, output_path, batch_size):
+    """
+    Runs video_processor with model_manager.
+    :return: [dict] FPS, latency percentiles and per-stage breakdown, see VideoPipeline.stats
+    """
+    import main
+    main.model_manager = model_manager
+    stats = main.video_processor(video_path, output_path, 'video', 0.5, 0.1, batch_size=batch_size)
+    return OrderedDict([
+        ('fps', stats['fps']),
+        ('latency', stats['latency']),
+        ('stages', OrderedDict((name, {'busy_time': stage['busy_time'], 'throughput': stage['throughput']})
+                               for name, stage in stats['stages'].items())),
+    ])
+
+
+def benchmark_endpoints(model_manager, image, requests_count, names=('json', 'job')):
+    """
+    Measures uploads of an image through Flask test client: detections returned in the response ('json')
+    and a processing job polled until it is done ('job'). Thresholds of jobs differ, so results are not cached.
+    :return: [dict] requests per second and latency percentiles of every kind of uploads in names
+    """
+    import main
+    main.model_manager = model_manager
+    main.is_ready = True
+    client = main.app.test_client()
+    _, encoded = cv2.imencode('.jpg', image)
+
+    def upload(**form):
+        form['file'] = (io.BytesIO(encoded.tobytes()), 'benchmark.jpg')
+        return client.post('/', data=dict(form, file_type='image'), content_type='multipart/form-data')
+
+    results = OrderedDict()
+    for name in names:
+        latencies = []
+        start = time()
+        for i in range(requests_count):
+            request_start = time()
+            if name == 'json':
+                response = upload(output_format='json')
+            else:
+                response = upload(threshold_person=str(0.5 + 1e-6 * i))
+                status_url = response.get_json()['status_url']
+                while response.get_json()['status'] not in ('done', 'failed'):
+                    sleep(0.001)
+                    response = client.get(status_url)
+            if response.status_code != 200:
+                raise RuntimeError('Upload failed with status {}.'.format(response.status_code))
+            latencies.append(time() - request_start)
+        results[name] = OrderedDict([
+            ('fps', requests_count / (time() - start)),
+            ('latency', latency_percentiles(latencies)),
+        ])
+    return results
+
+
+def measure_case(kind, resolution, persons, args, video_path, output_path):
+    """
+    Measures one case of benchmark_pipeline, runs in a separate process of benchmark_pipeline.
+    :param kind: [str] one of PIPELINE_CASES
+    :return: [dict] measurements of the case and peak RSS of its process
+    """
+    width, height = [int(side) for side in resolution.split('x')]
+    model_manager = create_model_manager(persons, args)
+    image = synthetic_image(width, height, persons)
+    if kind == 'frames':
+        result = benchmark_frames(model_manager, image, args.frames)
+    elif kind == 'video':
+        result = benchmark_video(model_manager, video_path, output_path, args.batch_size)
+    else:
+        name = kind[len('endpoint-'):]
+        result = benchmark_endpoints(model_manager, image, args.requests, names=(name,))[name]
+    result['peak_rss_mb'] = peak_rss_mb()
+    return result
+
+
+def benchmark_pipeline(args):
+    """
+    Runs all benchmark cases for every resolution and number of persons.
+    :return: [dict] configuration and list of cases with their measurements and peak RSS
+    """
+    context = multiprocessing.get_context('spawn')
+    cases = []
+    work_dir = tempfile.mkdtemp(prefix='benchmark_')
+    try:
+        for resolution in args.resolutions:
+            width, height = [int(side) for side in resolution.split('x')]
+            for persons in args.persons:
+                suffix = '{}-{}p'.format(resolution, persons)
+                video_path = synthetic_video(os.path.join(work_dir, 'input_{}.avi'.format(suffix)),
+                                             width, height, persons, args.frames)
+                output_path = os.path.join(work_dir, 'output_{}.avi'.format(suffix))
+                for kind in PIPELINE_CASES:
+                    # A fresh process for every case, so peak RSS of one does not include the others
+                    pool = context.Pool(1)
+                    try:
+                        result = pool.apply(measure_case, (kind, resolution, persons, args, video_path, output_path))
+                    finally:
+                        pool.close()
+                        pool.join()
+                    result['name'] = '{}-{}'.format(kind, suffix)
+                    cases.append(result)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    config = {key: value for key, value in vars(args).items() if key not in ('output', 'baseline')}
+    return OrderedDict([('config', config), ('cases', cases)])
+
+
+def measure_backend(name, image_path, repeat, batch_size):
+    """
+    Measures one inference backend of PersonDetector, runs in a separate process of benchmark_backends.
+    :return: [dict] load time, latency percentiles of a batch, FPS, persons found on the image and peak RSS
+    """
+    from inference_backends import create_backend
+    from person_detector import PersonDetector
+
+    detector = PersonDetector(backend=create_backend(name))
+    start = time()
+    load_times = detector.build_graph()
+    load_seconds = time() - start
+    frames = [cv2.imread(image_path)] * batch_size
+    detector.predict_persons_batch(frames, 0.5)
+    latencies = []
+    for _ in range(repeat):
+        start = time()
+        predictions = detector.predict_persons_batch(frames, 0.5)
+        latencies.append(time() - start)
+    return OrderedDict([
+        ('backend', name),
+        ('load_seconds', load_seconds),
+        ('load_times', load_times),
+        ('fps', batch_size * repeat / sum(latencies)),
+        ('latency', latency_percentiles(latencies)),
+        ('persons', len(predictions[0][0])),
+        ('peak_rss_mb', peak_rss_mb()),
+    ])
+
+
+def benchmark_backends(names, image_path, repeat=20, batch_size=1):
+    """
+    :param names: [list of str] names of backends, see inference_backends.BACKENDS
+    :param image_path: [str] image to detect persons on
+    :param repeat: [int] number of measured batches
+    :param batch_size: [int] number of copies of the image in a batch
+    :return: [list of dict] results of measure_backend, or error, for every backend
+    """
+    context = multiprocessing.get_context('spawn')
+    results = []
+    for name in names:
+        # A fresh process for every backend, so peak RSS of one does not include the other
+        pool = context.Pool(1)
+        try:
+            results.append(pool.apply(measure_backend, (name, image_path, repeat, batch_size)))
+        except Exception as e:
+            results.append(OrderedDict([('backend', name), ('error', str(e))]))
+        finally:
+            pool.close()
+            pool.join()
+    return results
+
+
+def find_regressions(results, baseline, tolerance):
+    """
+    Compares cases with the same name: FPS must not drop and p95 latency must not grow by more than tolerance.
+    :param results: [dict] results of benchmark_pipeline
+    :param baseline: [dict] results of an earlier run
+    :param tolerance: [float] allowed relative change
+    :return: [list of str] descriptions of regressions
+    """
+    baseline_cases = {case['name']: case for case in baseline['cases']}
+    regressions = []
+    for case in results['cases']:
+        old = baseline_cases.get(case['name'])
+        if old is None:
+            continue
+        if case['fps'] < old['fps'] * (1 - tolerance):
+            regressions.append('{}: FPS {:.2f} < {:.2f}'.format(case['name'], case['fps'], old['fps']))
+        if case['latency']['p95'] > old['latency']['p95'] * (1 + tolerance):
+            regressions.append('{}: p95 latency {:.4f} s > {:.4f} s'.format(
+                case['name'], case['latency']['p95'], old['latency']['p95']))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Person detection benchmarks.')
+    subparsers = parser.add_subparsers(dest='benchmark')
+    faces = subparsers.add_parser('faces', help='compare face detection strategies')
+    faces.add_argument('--image', default='test_data/images/test_image_1.jpg')
+    faces.add_argument('--persons', type=int, nargs='+', default=[1, 2, 4, 8, 16])
+    faces.add_argument('--repeat', type=int, default=5)
+    face_roi = subparsers.add_parser('face-roi', help='compare face search in person crops and head regions')
+    face_roi.add_argument('--images', default='test_data/images')
+    face_roi.add_argument('--persons', type=int, nargs='+', default=[1, 4, 16])
+    face_roi.add_argument('--repeat', type=int, default=5)
+    draw = subparsers.add_parser('draw', help='measure drawing of boxes and labels')
+    draw.add_argument('--persons', type=int, nargs='+', default=[1, 8, 32])
+    draw.add_argument('--frames', type=int, default=200)
+    draw.add_argument('--resolution', default='1280x720')
+    pipeline = subparsers.add_parser('pipeline', help='measure throughput and latency of the whole pipeline')
+    pipeline.add_argument('--resolutions', nargs='+', default=['640x360', '1280x720'])
+    pipeline.add_argument('--persons', type=int, nargs='+', default=[1, 8])
+    pipeline.add_argument('--frames', type=int, default=100)
+    pipeline.add_argument('--requests', type=int, default=20)
+    pipeline.add_argument('--batch-size', type=int, default=8)
+    pipeline.add_argument('--person-latency', type=float, default=0.01, help='seconds per frame of stub detector')
+    pipeline.add_argument('--face-latency', type=float, default=0.001, help='seconds per run of stub detector')
+    pipeline.add_argument('--real-models', action='store_true', help='use models from model_data instead of stubs')
+    pipeline.add_argument('--output', help='file to save results to')
+    pipeline.add_argument('--baseline', help='results of an earlier run to compare with')
+    pipeline.add_argument('--tolerance', type=float, default=0.1)
+    backends = subparsers.add_parser('backends', help='compare inference backends of person detector')
+    backends.add_argument('--backends', nargs='+', default=['tensorflow', 'opencv'])
+    backends.add_argument('--image', default='test_data/images/test_image_1.jpg')
+    backends.add_argument('--batch-size', type=int, default=1)
+    backends.add_argument('--repeat', type=int, default=20)
+    args = parser.parse_args()
+
+    regressions = []
+    if args.benchmark == 'faces':
+        results = benchmark_face_strategies(cv2.imread(args.image), args.persons, args.repeat)
+    elif args.benchmark == 'face-roi':
+        images = [(name, cv2.imread(os.path.join(args.images, name))) for name in sorted(os.listdir(args.images))]
+        results = benchmark_face_roi(images, args.persons, args.repeat)
+    elif args.benchmark == 'draw':
+        results = benchmark_draw(args.persons, args.frames, [int(side) for side in args.resolution.split('x')])
+    elif args.benchmark == 'backends':
+        results = benchmark_backends(args.backends, args.image, args.repeat, args.batch_size)
+    elif args.benchmark == 'pipeline':
+        results = benchmark_pipeline(args)
+        if args.output:
+            with open(args.output, 'w') as output:
+                json.dump(results, output, indent=2)
+        if args.baseline:
+            with open(args.baseline) as baseline:
+                regressions = find_regressions(results, json.load(baseline), args.tolerance)
+    else:
+        parser.error('choose a benchmark')
+    print(json.dumps(results, indent=2))
+    if regressions:
+        sys.stderr.write('Regressions:\n{}\n'.format('\n'.join(regressions)))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
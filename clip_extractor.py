@@ -0,0 +1,145 @@
+"""
+Extraction of clips with persons from long recordings. Outside of clips only every probe_interval-th frame
+is retrieved and searched for persons, other frames are only grabbed (decoded without conversion to an image).
+When a probe finds a person, the capture seeks back by the pre-padding and a clip is opened: its frames are
+retrieved, detected, drawn and written until no person was seen for the post-padding. Clips are written one after
+another to one output video, so its size and encode time depend on activity, not on length of the recording.
+"""
+import json
+import logging
+from time import time
+
+import cv2
+
+from frame import Frame
+from metrics import FRAMES
+
+
+class ClipExtractor:
+    """
+    Class, that writes clips of a video with persons and their timeline: first and next after the last frame,
+    times in the video and in the output, and the maximum number of persons of every clip.
+    has_persons takes a Frame, detects its persons without drawing and returns their number, it is called on probe
+    frames only; process_frame takes a Frame of a clip and a flag, that persons of the Frame were already detected
+    by has_persons, detects persons (or only faces) and draws them, and returns the number of persons.
+    """
+
+    def __init__(self, has_persons, process_frame, probe_interval=5, pre_padding=1.0, post_padding=2.0):
+        self.has_persons = has_persons
+        self.process_frame = process_frame
+        self.probe_interval = max(1, probe_interval)
+        self.pre_padding = pre_padding
+        self.post_padding = post_padding
+        self.grabbed = 0
+        self.retrieved = 0
+        self.written = 0
+        self.encode_time = 0.0
+        self.timeline = []
+
+    def extract(self, cap, writer, frames_total=0, progress_callback=None):
+        """
+        Reads capture to its end and writes clips with persons.
+        :param cap: [cv2.VideoCapture obj] opened capture at its first frame
+        :param writer: [cv2.VideoWriter obj] writer of clips, drawn frames of all clips are written to it
+        :param frames_total: [int] number of frames in the video (0 if unknown)
+        :param progress_callback: [callable or None] called with numbers of read and total frames
+        :return: [list of dict] timeline of clips
+        """
+        frame_rate = cap.get(cv2.CAP_PROP_FPS) or 25.0
+        pre_frames = int(round(self.pre_padding * frame_rate))
+        post_frames = max(1, int(round(self.post_padding * frame_rate)))
+        # Number of the next frame of the capture and end of the last written clip
+        position = 0
+        clip_end = 0
+        clip = None
+        while True:
+            if clip is None and position % self.probe_interval:
+                if not cap.grab():
+                    break
+                self.grabbed += 1
+                position += 1
+                continue
+
+            is_retrieved, image = cap.read()
+            if not is_retrieved:
+                break
+            self.retrieved += 1
+            position += 1
+            current_frame = Frame(image)
+
+            if clip is None:
+                if not self.has_persons(current_frame):
+                    continue
+                start = max(position - 1 - pre_frames, clip_end)
+                if start < position - 1 and cap.set(cv2.CAP_PROP_POS_FRAMES, start):
+                    # Frames of the pre-padding and the probe frame are read again as frames of the clip
+                    probe = position - 1
+                    position = int(cap.get(cv2.CAP_PROP_POS_FRAMES))
+                    clip = self.__open_clip(position, probe, frame_rate)
+                    continue
+                clip = self.__open_clip(position - 1, position - 1, frame_rate)
+                # Persons of the probe frame are not detected again
+                persons = self.process_frame(current_frame, True)
+            else:
+                persons = self.process_frame(current_frame, False)
+            if persons:
+                clip['last_seen'] = position - 1
+                clip['max_persons'] = max(clip['max_persons'], persons)
+            encode_start = time()
+            writer.write(current_frame.image)
+            self.encode_time += time() - encode_start
+            self.written += 1
+            if position - 1 - clip['last_seen'] >= post_frames:
+                clip_end = position
+                self.__close_clip(clip, clip_end, frame_rate)
+                clip = None
+            if progress_callback is not None:
+                progress_callback(position, frames_total)
+
+        if clip is not None:
+            self.__close_clip(clip, position, frame_rate)
+        if progress_callback is not None:
+            progress_callback(position, frames_total or position)
+        FRAMES.inc(position)
+        return self.timeline
+
+    def stats(self, elapsed):
+        """
+        :param elapsed: [float] seconds spent by extract
+        :return: [dict] numbers of grabbed, retrieved and written frames, encode time and timeline
+        """
+        frames = self.grabbed + self.retrieved
+        return {
+            'elapsed': elapsed,
+            'fps': frames / elapsed if elapsed else 0.0,
+            'grabbed_frames': self.grabbed,
+            'retrieved_frames': self.retrieved,
+            'written_frames': self.written,
+            'encode_time': self.encode_time,
+            'clips': len(self.timeline),
+            'timeline': self.timeline,
+        }
+
+    def save_timeline(self, path):
+        """
+        :param path: [str] path to JSON file
+        :return: [None]
+        """
+        with open(path, 'w') as timeline_file:
+            json.dump(self.timeline, timeline_file)
+
+    def __open_clip(self, start, probe, frame_rate):
+        logging.log(logging.DEBUG, 'Clip opened at frame {} for persons found at frame {}.'.format(start, probe))
+        return {'start_frame': start, 'last_seen': probe, 'max_persons': 0,
+                'clip_start': self.written / frame_rate}
+
+    def __close_clip(self, clip, end, frame_rate):
+        self.timeline.append({
+            'start_frame': clip['start_frame'],
+            'end_frame': end,
+            'start': clip['start_frame'] / frame_rate,
+            'end': end / frame_rate,
+            'clip_start': clip['clip_start'],
+            'max_persons': clip['max_persons'],
+        })
+        logging.log(logging.DEBUG, 'Clip closed: {}'.format(self.timeline[-1]))
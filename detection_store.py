@@ -0,0 +1,119 @@
+import json
+import os
+
+import numpy as np
+
+from face_detector import select_faces
+
+_ARRAYS = ('person_offsets', 'person_boxes', 'person_scores', 'person_analysed',
+           'face_offsets', 'face_boxes', 'face_scores')
+
+
+class DetectionRecorder:
+    """
+    Class, that collects raw detections of frames (Frame.raw_detections) and saves them to a directory
+    as flat .npy arrays: all person candidates with scores and all face candidates of analysed persons.
+    Frames are added in their order in a video.
+    """
+
+    def __init__(self, threshold_person):
+        self.threshold_person = threshold_person
+        self.person_counts = []
+        self.person_boxes = []
+        self.person_scores = []
+        self.person_analysed = []
+        self.face_counts = []
+        self.face_boxes = []
+        self.face_scores = []
+
+    def add(self, frame):
+        """
+        :param frame: [Frame obj] Frame with raw_detections
+        :return: [None]
+        """
+        raw = frame.raw_detections
+        analysed = raw['person_analysed']
+        candidates = iter(raw.get('face_candidates', []))
+
+        self.person_counts.append(len(analysed))
+        self.person_boxes.append(raw['person_boxes'])
+        self.person_scores.append(raw['person_scores'])
+        self.person_analysed.append(analysed)
+        for is_analysed in analysed.tolist():
+            if is_analysed:
+                boxes, scores = next(candidates)
+            else:
+                boxes, scores = np.zeros((0, 4), dtype=np.int32), np.zeros(0, dtype=np.float32)
+            self.face_counts.append(len(scores))
+            self.face_boxes.append(boxes)
+            self.face_scores.append(scores)
+
+    def extend(self, other):
+        """
+        Appends frames of another recorder, e.g. of the next segment of a video.
+        :param other: [DetectionRecorder obj] recorder of frames following frames of this one
+        :return: [None]
+        """
+        for name in ('person_counts', 'person_boxes', 'person_scores', 'person_analysed',
+                     'face_counts', 'face_boxes', 'face_scores'):
+            getattr(self, name).extend(getattr(other, name))
+
+    def save(self, directory):
+        """
+        :param directory: [str] directory to save arrays to
+        :return: [None]
+        """
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        arrays = {
+            'person_offsets': np.concatenate([[0], np.cumsum(self.person_counts)]).astype(np.int64),
+            'person_boxes': np.concatenate(self.person_boxes or [np.zeros((0, 4))]).astype(np.int32),
+            'person_scores': np.concatenate(self.person_scores or [np.zeros(0)]).astype(np.float32),
+            'person_analysed': np.concatenate(self.person_analysed or [np.zeros(0)]).astype(bool),
+            'face_offsets': np.concatenate([[0], np.cumsum(self.face_counts)]).astype(np.int64),
+            'face_boxes': np.concatenate(self.face_boxes or [np.zeros((0, 4))]).astype(np.int32),
+            'face_scores': np.concatenate(self.face_scores or [np.zeros(0)]).astype(np.float32),
+        }
+        for name, array in arrays.items():
+            np.save(os.path.join(directory, '{}.npy'.format(name)), array)
+        with open(os.path.join(directory, 'meta.json'), 'w') as meta:
+            json.dump({'frames': len(self.person_counts), 'threshold_person': self.threshold_person}, meta)
+
+
+class DetectionStore:
+    """
+    Class, that gives detections of recorded frames for new thresholds without running detectors.
+    Arrays are memory-mapped, so only the frames that are read are loaded from disk.
+    Persons below the threshold of the recording were not searched for faces, so they have no faces.
+    """
+
+    def __init__(self, directory):
+        for name in _ARRAYS:
+            setattr(self, name, np.load(os.path.join(directory, '{}.npy'.format(name)), mmap_mode='r'))
+        with open(os.path.join(directory, 'meta.json')) as meta:
+            self.meta = json.load(meta)
+
+    def __len__(self):
+        return self.meta['frames']
+
+    def put_detections_into_frame(self, frame, frame_index, threshold_person, threshold_face):
+        """
+        Sets person_boxes, person_scores and faces of Frame selected with given thresholds.
+        :param frame: [Frame obj] decoded frame
+        :param frame_index: [int] number of the frame in a video
+        :param threshold_person: [float] threshold of person detection algorithm
+        :param threshold_face: [float] threshold of face detection algorithm
+        :return: [None]
+        """
+        start, end = int(self.person_offsets[frame_index]), int(self.person_offsets[frame_index + 1])
+        selected = np.flatnonzero(np.asarray(self.person_scores[start:end]) > threshold_person) + start
+
+        candidates = []
+        for person in selected.tolist():
+            face_start, face_end = int(self.face_offsets[person]), int(self.face_offsets[person + 1])
+            candidates.append((np.asarray(self.face_boxes[face_start:face_end]),
+                               np.asarray(self.face_scores[face_start:face_end])))
+
+        frame.set_person_boxes(np.asarray(self.person_boxes[selected]))
+        frame.set_person_scores(np.asarray(self.person_scores[selected]))
+        frame.set_faces(*select_faces(candidates, threshold_face))
@@ -1,77 +1,183 @@
-import dlib
 import cv2
 import numpy as np
-import logging
+
+# dlib frontal face detector finds faces of about 80x80 pixels and larger without upsampling
+DLIB_MIN_FACE_SIZE = 80
+# Conservative estimate of face size relative to the smaller side of a person box
+FACE_TO_PERSON_RATIO = 0.25
+# Height of an upright person in face heights
+FACE_HEIGHTS_PER_PERSON = 7
+# Maximum number of upsampling of person crops
+MAX_UPSAMPLE = 2
 
 
 class FaceDetector:
     """
     Class, that uses dlib face detector to detect faces.
-    Method detect_face_of_person takes a cropped picture of a person and finds a face on it;
-    returns coordinates of a face on image.
-    Method detect_faces_from_image takes a picture/frame and finds all faces on it(above threshold);
-    returns an array of coordinates of faces on image.
+    Method detect_face_candidates takes a cropped picture of a person and finds face candidates on it;
+    returns their coordinates on image and scores.
+    Method detect_faces_scored takes a picture/frame and finds all faces on it (above threshold).
+    Method detect_face_candidates_of_persons runs detector once on a whole frame (downscaled by frame_scale)
+    and assigns found faces to person boxes; returns the same candidates as detect_face_candidates per person.
+    The best candidate of every person is chosen by select_faces.
+    Faces of persons are searched only in the head region: head_ratio of person box height from its top.
+    Head regions with a side smaller than min_crop_size pixels are not searched.
+    Upsampling of detector is chosen from the region height, so small persons are upsampled and large ones
+    are not (or fixed to upsample if given). If face_size is set, person crops are downscaled so that
+    expected face is about face_size pixels.
     """
-    def __init__(self):
+    def __init__(self, frame_scale=1.0, face_size=None, head_ratio=1.0, min_crop_size=0, upsample=None):
+        # dlib is imported with the first detector, so modules using FaceDetector can be imported without it
+        import dlib
         self.face_detector = dlib.get_frontal_face_detector()
+        self.frame_scale = frame_scale
+        self.face_size = face_size
+        self.head_ratio = head_ratio
+        self.min_crop_size = min_crop_size
+        self.upsample = upsample
+
+    def copy(self):
+        """
+        :return: [FaceDetector obj] new detector with the same settings, for use in another thread
+        """
+        return FaceDetector(frame_scale=self.frame_scale, face_size=self.face_size, head_ratio=self.head_ratio,
+                            min_crop_size=self.min_crop_size, upsample=self.upsample)
+
+    def get_crop_scale_and_upsample(self, crop_height, crop_width):
+        """
+        Chooses how to resize a person crop and how many times to upsample it in detector.
+        :param crop_height: [int] height of person crop
+        :param crop_width: [int] width of person crop
+        :return: [tuple] scale of crop (not greater than 1) and number of upsampling
+        """
+        if self.face_size:
+            expected_face = max(FACE_TO_PERSON_RATIO * min(crop_height, crop_width), 1.0)
+            scale = min(1.0, float(self.face_size) / expected_face)
+        elif self.upsample is not None:
+            return 1.0, self.upsample
+        else:
+            # Head region is head_ratio of person height, a face is 1 / FACE_HEIGHTS_PER_PERSON of it
+            roi_height = crop_height * self.head_ratio
+            expected_face = max(roi_height / max(FACE_HEIGHTS_PER_PERSON * self.head_ratio, 1.0), 1.0)
+            scale = 1.0
+        upsample = 0
+        while expected_face * scale * 2 ** upsample < DLIB_MIN_FACE_SIZE and upsample < MAX_UPSAMPLE:
+            upsample += 1
+        return scale, upsample
 
-    def detect_face_of_person(self, person, threshold=0):
+    def detect_face_candidates(self, person):
+        """
+        Finds all face candidates with their scores on a cropped picture of a person.
+        :param person: [list] crop of person and its ((top, left), (bottom, right)) box, see Frame.crop_picture
+        :return: [tuple] int32 array [M, 4] of (x1, y1, x2, y2) face boxes in frame coordinates
+                 and float32 array [M] of their scores
+        """
         (top, left), _ = person[1]
 
+        img_h, img_w = person[0].shape[:2]
+        scale, upsample = self.get_crop_scale_and_upsample(img_h, img_w)
+        # Only the head region is searched, it starts at the top of person box as the crop does
+        crop = person[0][:max(1, int(round(img_h * self.head_ratio)))]
+        if min(crop.shape[:2]) < self.min_crop_size:
+            return np.zeros((0, 4), dtype=np.int32), np.zeros(0, dtype=np.float32)
+        img_h = crop.shape[0]
+        if scale < 1.0:
+            crop = cv2.resize(crop, (max(1, int(img_w * scale)), max(1, int(img_h * scale))),
+                              interpolation=cv2.INTER_AREA)
+
         # Change colorspace of image
-        new_image = cv2.cvtColor(person[0], cv2.COLOR_BGR2RGB)
-        img_h, img_w, _ = np.shape(new_image)
+        new_image = cv2.cvtColor(crop, cv2.COLOR_BGR2RGB)
 
-        # Run face detector, use only most accurate face or return NaN
-        dets, scores, idx = self.face_detector.run(new_image, 1, -1)
-        try:
-            max_score = max(scores)
-            if max_score > threshold:
-                for i, d in enumerate(dets):
-                    logging.info("Detection {}, score: {}, face_type:{}".format(
-                        d, scores[i], idx[i]))
-                    if scores[i] == max_score:
-                        max_i = i
-
-                coord = [dets[max_i].left(), dets[max_i].top(), dets[max_i].right() + 1, dets[max_i].bottom() + 1]
-
-                for i, item in enumerate(coord):
-                    print(item)
-                    if item < 0:
-                        coord[i] = 0
-
-                x1, y1, x2, y2 = coord
-                face_box = [(x1+left, y1+top), (x2+left, y2+top)]
-            else:
-                face_box = 'NaN'
-        except:
-            face_box = 'NaN'
-        return face_box
-
-    def detect_faces_from_image(self, image, threshold=0):
-        face_box = []
+        # Run face detector
+        dets, scores, idx = self.face_detector.run(new_image, upsample, -1)
+        coords = [[max(0, d.left()), max(0, d.top()), max(0, d.right() + 1), max(0, d.bottom() + 1)] for d in dets]
+
+        # Map coordinates back from the resized crop to the frame
+        boxes = np.array(coords, dtype=np.float32).reshape(-1, 4) / scale + [left, top, left, top]
+        return boxes.astype(np.int32), np.array(scores, dtype=np.float32)
+
+    def detect_faces_scored(self, image, threshold=None):
+        """
+        Finds all faces above threshold on a picture/frame, downscaled by frame_scale before detection.
+        :param image: [numpy array] BGR image
+        :param threshold: [float or None] confidence level of face detection, all candidates if None
+        :return: [tuple] int32 array [M, 4] of (x1, y1, x2, y2) face boxes in image coordinates
+                 and float32 array [M] of their scores
+        """
+        if self.frame_scale != 1.0:
+            image = cv2.resize(image, None, fx=self.frame_scale, fy=self.frame_scale,
+                               interpolation=cv2.INTER_AREA)
 
         # Change colorspace of image
         new_image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
-        img_h, img_w, _ = np.shape(new_image)
-
-        # Run face detector, use only most accurate face or return NaN
         dets, scores, idx = self.face_detector.run(new_image, 1, -1)
-        try:
-            for i, d in enumerate(dets):
-                print("Detection {}, score: {}, face_type:{}".format(d, scores[i], idx[i]))
-                if scores[i] > threshold:
-                    coord = [d.left(), d.top(), d.right() + 1, d.bottom() + 1]
-
-                    for i, item in enumerate(coord):
-                        if item < 0:
-                            coord[i] = 0
-
-                    x1, y1, x2, y2 = coord
-
-                    face_box.append([(x1, y1), (x2, y2)])
-                else:
-                    face_box.append('NaN')
-        except:
-            face_box.append('NaN')
-        return face_box
+
+        boxes = np.array([[d.left(), d.top(), d.right() + 1, d.bottom() + 1] for d in dets],
+                         dtype=np.float32).reshape(-1, 4)
+        scores = np.array(scores, dtype=np.float32)
+        if threshold is not None:
+            selected = scores > threshold
+            boxes, scores = boxes[selected], scores[selected]
+        boxes = np.maximum(boxes / self.frame_scale, 0).astype(np.int32)
+        return boxes, scores
+
+    def detect_face_candidates_of_persons(self, image, person_boxes):
+        """
+        Runs face detector once on a whole frame and assigns found faces to persons.
+        :param image: [numpy array] BGR frame
+        :param person_boxes: [numpy array] int32 array [N, 4] of (top, left, bottom, right) person boxes
+        :return: [list] face candidates (boxes, scores) of every person, see detect_face_candidates
+        """
+        if not len(person_boxes):
+            return []
+        face_boxes, face_scores = self.detect_faces_scored(image)
+        face_person = assign_faces_to_persons(face_boxes, person_boxes)
+        return [(face_boxes[face_person == i], face_scores[face_person == i]) for i in range(len(person_boxes))]
+
+
+def select_faces(candidates, threshold=0):
+    """
+    Selects the most confident face candidate of every person.
+    :param candidates: [list of tuple] face candidates (boxes, scores) of every person, see detect_face_candidates
+    :param threshold: [float] confidence level of face detection
+    :return: [tuple] int32 array [M, 4] of (x1, y1, x2, y2) selected faces and int32 array [N] of index
+             of face of every person in it, -1 if there is no face above threshold (see Frame.set_faces)
+    """
+    face_boxes = []
+    person_faces = np.full(len(candidates), -1, dtype=np.int32)
+    for i, (boxes, scores) in enumerate(candidates):
+        if len(scores):
+            best = int(np.argmax(scores))
+            if scores[best] > threshold:
+                person_faces[i] = len(face_boxes)
+                face_boxes.append(boxes[best])
+    return np.array(face_boxes, dtype=np.int32).reshape(-1, 4), person_faces
+
+
+def assign_faces_to_persons(face_boxes, person_boxes, min_containment=0.5):
+    """
+    Assigns every face to the person box that contains the largest part of it,
+    ties are resolved by intersection over union.
+    :param face_boxes: [numpy array] array [M, 4] of (x1, y1, x2, y2) face boxes
+    :param person_boxes: [numpy array] array [N, 4] of (top, left, bottom, right) person boxes
+    :param min_containment: [float] minimal part of face area, that has to be inside of person box
+    :return: [numpy array] int array [M] of person indexes, -1 for faces out of all persons
+    """
+    if not len(face_boxes) or not len(person_boxes):
+        return np.full(len(face_boxes), -1, dtype=np.int64)
+    faces = face_boxes.astype(np.float32)[:, None, :]
+    persons = person_boxes.astype(np.float32)[None, :, :]
+
+    inter_w = np.minimum(faces[..., 2], persons[..., 3]) - np.maximum(faces[..., 0], persons[..., 1])
+    inter_h = np.minimum(faces[..., 3], persons[..., 2]) - np.maximum(faces[..., 1], persons[..., 0])
+    intersection = np.maximum(inter_w, 0) * np.maximum(inter_h, 0)
+    face_area = (faces[..., 2] - faces[..., 0]) * (faces[..., 3] - faces[..., 1])
+    person_area = (persons[..., 3] - persons[..., 1]) * (persons[..., 2] - persons[..., 0])
+
+    containment = intersection / np.maximum(face_area, 1)
+    iou = intersection / np.maximum(face_area + person_area - intersection, 1)
+    affinity = np.where(containment >= min_containment, containment + iou, 0)
+
+    face_person = np.argmax(affinity, axis=1)
+    face_person[affinity.max(axis=1) <= 0] = -1
+    return face_person
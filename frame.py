@@ -1,70 +1,175 @@
 import cv2
+import numpy as np
+
+# Sizes of label texts by label and font, labels repeat (scores are whole percents), so they are measured once
+_text_sizes = {}
+MAX_TEXT_SIZES = 4096
+BOX_COLOR = (255, 0, 0)
+TEXT_COLOR = (255, 255, 255)
+# Coordinates of (x1, y1, x2, y2) box taken by its corners in polygon order
+_CORNERS = np.array([0, 1, 2, 1, 2, 3, 0, 3])
+# Offsets of corners of three 1 pixel rings drawing a box line 3 pixels wide: the same pixels cv2.rectangle draws
+# with thickness 2 (except rounded corners), but all boxes of a frame are drawn with one cv2.polylines call
+_RING_OFFSETS = np.array([[-1, -1, 1, 1], [0, 0, 0, 0], [1, 1, -1, -1]], dtype=np.int32)[:, _CORNERS].reshape(
+    3, 1, 4, 2)
+
+
+def _empty(shape, dtype):
+    array = np.zeros(shape, dtype=dtype)
+    array.flags.writeable = False
+    return array
+
+
+# Shared by new Frames, so a Frame without detections allocates no arrays
+_NO_BOXES = _empty((0, 4), np.int32)
+_NO_SCORES = _empty((0,), np.float32)
+_NO_INDEXES = _empty((0,), np.int32)
+
+
+def get_text_size(label, font, font_scale, thickness):
+    """
+    Cached cv2.getTextSize.
+    :return: [tuple] width and height of label
+    """
+    key = (label, font, font_scale, thickness)
+    size = _text_sizes.get(key)
+    if size is None:
+        if len(_text_sizes) >= MAX_TEXT_SIZES:
+            _text_sizes.clear()
+        size = _text_sizes[key] = cv2.getTextSize(label, font, font_scale, thickness)[0]
+    return size
+
+
+def draw_boxes(image, boxes, color=BOX_COLOR):
+    """
+    Draws outlines of all boxes at once.
+    :param image: [numpy array] BGR image
+    :param boxes: [numpy array] int32 array [N, 4] of (x1, y1, x2, y2) boxes
+    :param color: [tuple] BGR color
+    :return: [None]
+    """
+    if len(boxes):
+        corners = boxes.astype(np.int32)[:, _CORNERS].reshape(-1, 4, 2)
+        cv2.polylines(image, (corners[None] + _RING_OFFSETS).reshape(-1, 4, 2), True, color, 1)
 
 
 class Frame:
     """
     Class Frame stores image, information on bounding boxes and labels of faces and persons.
+    Person boxes are stored as int32 array [N, 4] of (top, left, bottom, right) with float32 scores [N];
+    labels are built from scores only when they are needed (get_person_labels).
+    Faces are stored as int32 array [M, 4] of (x1, y1, x2, y2) boxes and int32 array person_faces [N]
+    of index of the face of every person, -1 if the person has no face (or faces were not searched yet).
+    If persons are tracked, person_ids holds int32 array [N] of their ids, shown in labels.
+    Frames marked as static reuse detections of the last analysed frame (copy_detections).
+    raw_detections keeps all candidates of detectors, if they are recorded (see DetectionRecorder).
     Methods set_* are used for filling class attributes.
-    Method crop_picture is used for cropping persons and faces from picture,
-    and takes a string argument to signify operation type.
+    Method crop_picture gives views of persons or faces on picture, and takes a string argument to signify
+    operation type.
     Method draw_all_bounding_boxes draws labeled bboxes for persons, and, if present, for faces.
     Method draw_face_bounding_boxes draws labeled bboxes for detected faces.
     """
+    __slots__ = ('image', 'person_boxes', 'person_scores', 'person_ids', 'face_boxes', 'person_faces',
+                 'raw_detections', 'is_static')
+    person_class = 'person'
+
     def __init__(self, image):
         self.image = image
-        self.person_boxes = []
-        self.person_labels = []
-        self.face_boxes = []
+        self.person_boxes = _NO_BOXES
+        self.person_scores = _NO_SCORES
+        self.person_ids = None
+        self.face_boxes = _NO_BOXES
+        self.person_faces = _NO_INDEXES
+        self.raw_detections = None
+        self.is_static = False
 
     def set_person_boxes(self, person_boxes):
         self.person_boxes = person_boxes
 
-    def set_face_boxes(self, face_boxes):
+    def set_faces(self, face_boxes, person_faces):
         self.face_boxes = face_boxes
+        self.person_faces = person_faces
+
+    def set_person_scores(self, person_scores):
+        self.person_scores = person_scores
+
+    def copy_detections(self, frame):
+        self.person_boxes = frame.person_boxes
+        self.person_scores = frame.person_scores
+        self.person_ids = frame.person_ids
+        self.face_boxes = frame.face_boxes
+        self.person_faces = frame.person_faces
+        self.raw_detections = frame.raw_detections
+
+    def get_face_of_person(self, person_index):
+        """
+        :param person_index: [int] index of person
+        :return: [numpy array or None] int32 array [4] of (x1, y1, x2, y2) face box, None if there is no face
+        """
+        if person_index >= len(self.person_faces) or self.person_faces[person_index] < 0:
+            return None
+        return self.face_boxes[self.person_faces[person_index]]
+
+    def get_person_labels(self):
+        if self.person_ids is not None:
+            return ['{} #{}: {}% '.format(self.person_class, person_id, int(100 * score))
+                    for person_id, score in zip(self.person_ids, self.person_scores)]
+        return ['{}: {}% '.format(self.person_class, int(100 * score)) for score in self.person_scores]
 
-    def set_person_labels(self, person_labels):
-        self.person_labels = person_labels
+    def to_dict(self, frame_index=0):
+        """
+        Detections of the frame as JSON-serializable dict; faces that were not found are None.
+        :param frame_index: [int] number of the frame in a video
+        :return: [dict]
+        """
+        persons = []
+        for i, ((top, left, bottom, right), score, label) in enumerate(zip(
+                self.person_boxes.tolist(), self.person_scores.tolist(), self.get_person_labels())):
+            face = self.get_face_of_person(i)
+            if face is not None:
+                x1, y1, x2, y2 = face.tolist()
+                face = {'x1': x1, 'y1': y1, 'x2': x2, 'y2': y2}
+            persons.append({
+                'id': int(self.person_ids[i]) if self.person_ids is not None else None,
+                'box': {'top': top, 'left': left, 'bottom': bottom, 'right': right},
+                'score': score,
+                'label': label.strip(),
+                'face': face,
+            })
+        return {'frame': frame_index, 'persons': persons}
 
     def crop_picture(self, flag):
-        cropped = []
+        """
+        Gives crops one by one, as views of the image without copying.
+        :param flag: [str ('person' or 'face')] 'person' gives [crop, ((top, left), (bottom, right))] of every
+                     person, 'face' gives crop of face of every person or None if the person has no face
+        :return: [generator]
+        """
         if flag == 'person':
-            for i in range(len(self.person_boxes)):
-                box = self.person_boxes[i]
-                cropped.append([self.image[int(box[0][0]):int(box[1][0]), int(box[0][1]):int(box[1][1])],
-                                box[:2]])
+            for top, left, bottom, right in self.person_boxes.tolist():
+                yield [self.image[top:bottom, left:right], ((top, left), (bottom, right))]
         elif flag == 'face':
-            for i in range(len(self.face_boxes)):
-                box = self.face_boxes[i]
-                if box != 'NaN':
-                    cropped.append(cv2.resize(self.image[int(box[0][1]):int(box[1][1]) + 1,
-                                              int(box[0][0]):int(box[1][0]) + 1, :], (64, 64)))
+            for i in range(len(self.person_boxes)):
+                face = self.get_face_of_person(i)
+                if face is None:
+                    yield None
                 else:
-                    cropped.append('NaN')
-        return cropped
+                    x1, y1, x2, y2 = face.tolist()
+                    yield self.image[y1:y2 + 1, x1:x2 + 1]
 
     def draw_all_labeled_bounding_boxes(self, font=cv2.FONT_HERSHEY_DUPLEX, font_scale=0.6, thickness=1):
-        try:
-            for i in range(len(self.face_boxes)):
-                if self.face_boxes[i][0] == 'N':
-                    continue
-                x1, y1 = self.face_boxes[i][0]
-                x2, y2 = self.face_boxes[i][1]
-                cv2.rectangle(self.image, (x1, y1), (x2, y2), (255, 0, 0), 2)
-        finally:
-            for i in range(len(self.person_boxes)):
-                y1, x1 = self.person_boxes[i][0]
-                y2, x2 = self.person_boxes[i][1]
-                cv2.rectangle(self.image, (x1, y1), (x2, y2), (255, 0, 0), 2)
-                label = self.person_labels[i]
-                size = cv2.getTextSize(label, font, font_scale, thickness)[0]
-                cv2.rectangle(self.image, (x1, y1 - size[1]), (x1 + size[0], y1), (255, 0, 0), cv2.FILLED)
-                cv2.putText(self.image, label, (x1, y1), font, font_scale, (255, 255, 255), thickness)
+        """Draws boxes of all faces and persons with one call, then labels with text sizes measured once."""
+        boxes = self.person_boxes[:, [1, 0, 3, 2]]
+        if len(self.face_boxes):
+            boxes = np.concatenate([self.face_boxes, boxes])
+        draw_boxes(self.image, boxes)
+        if not len(self.person_boxes):
+            return
 
-    def draw_face_bounding_boxes(self):
+        for label, (top, left) in zip(self.get_person_labels(), self.person_boxes[:, :2].tolist()):
+            width, height = get_text_size(label, font, font_scale, thickness)
+            cv2.rectangle(self.image, (left, top - height), (left + width, top), BOX_COLOR, cv2.FILLED)
+            cv2.putText(self.image, label, (left, top), font, font_scale, TEXT_COLOR, thickness)
 
-        for i in range(len(self.face_boxes)):
-            if self.face_boxes[i][0] == 'N':
-                continue
-            x1, y1 = self.face_boxes[i][0]
-            x2, y2 = self.face_boxes[i][1]
-            cv2.rectangle(self.image, (x1, y1), (x2, y2), (255, 0, 0), 2)
+    def draw_face_bounding_boxes(self):
+        draw_boxes(self.image, self.face_boxes)
@@ -0,0 +1,19 @@
+import os
+
+# Jobs, result cache, storage index and streams are kept in memory of the process, so requests are served
+# by threads of one worker; detectors scale with INFERENCE_WORKERS processes instead
+workers = 1
+threads = int(os.environ.get('GUNICORN_THREADS', 8))
+
+
+def on_starting(server):
+    """Refuses to start several workers, that would not see jobs, cached results and pins of each other."""
+    if server.cfg.workers != 1:
+        raise RuntimeError('Jobs and storage are kept per process, run 1 worker with threads instead of {}.'.format(
+            server.cfg.workers))
+
+
+def post_fork(server, worker):
+    """Loads and warms up models in every worker process, before it accepts requests."""
+    from main import create_app
+    create_app()
@@ -0,0 +1,153 @@
+"""
+Runtimes, that run frozen SSD graph of PersonDetector. A backend loads serialized graph and runs it on a batch
+of images; its output has the format of Tensorflow object detection API, so boxes are selected the same way
+for every backend. New runtimes are added to BACKENDS.
+"""
+import os
+from collections import OrderedDict
+from time import time
+
+import cv2
+import numpy as np
+
+
+class InferenceBackend:
+    """
+    Interface of backends.
+    Method load takes serialized frozen graph and returns seconds spent on loading steps;
+    method run takes uint8 array [N, height, width, 3] of images and returns arrays of boxes [N, K, 4]
+    (ymin, xmin, ymax, xmax normalized), scores [N, K] and classes [N, K] of K detections per image.
+    """
+    name = None
+
+    def load(self, serialized_graph):
+        raise NotImplementedError
+
+    def run(self, images):
+        raise NotImplementedError
+
+
+class TensorflowBackend(InferenceBackend):
+    """
+    Class, that runs the graph in Tensorflow session.
+    intra_op_threads and inter_op_threads limit threads of the session (0 - chosen by Tensorflow).
+    """
+    name = 'tensorflow'
+
+    def __init__(self, intra_op_threads=0, inter_op_threads=0):
+        self.intra_op_threads = intra_op_threads
+        self.inter_op_threads = inter_op_threads
+        self.sess = None
+
+    def load(self, serialized_graph):
+        load_times = OrderedDict()
+        start = time()
+        import tensorflow as tf
+        load_times['import'] = time() - start
+
+        start = time()
+        self.detection_graph = tf.Graph()
+        with self.detection_graph.as_default():
+            od_graph_def = tf.GraphDef()
+            od_graph_def.ParseFromString(serialized_graph)
+            tf.import_graph_def(od_graph_def, name='')
+        load_times['graph_parse'] = time() - start
+
+        start = time()
+        # Session stays open for predictions, so it is not used as a context manager
+        config = tf.ConfigProto(intra_op_parallelism_threads=self.intra_op_threads,
+                                inter_op_parallelism_threads=self.inter_op_threads)
+        self.sess = tf.Session(graph=self.detection_graph, config=config)
+        with self.detection_graph.as_default():
+            # Definite input and output Tensors for detection_graph
+            self.image_tensor = self.detection_graph.get_tensor_by_name('image_tensor:0')
+            # Each box represents a part of the image where a particular object was detected.
+            self.detection_boxes = self.detection_graph.get_tensor_by_name('detection_boxes:0')
+            # Each score represent how level of confidence for each of the objects.
+            # Score is shown on the result image, together with the class label.
+            self.detection_scores = self.detection_graph.get_tensor_by_name('detection_scores:0')
+            self.detection_classes = self.detection_graph.get_tensor_by_name('detection_classes:0')
+        load_times['session'] = time() - start
+        return load_times
+
+    def run(self, images):
+        boxes, scores, classes = self.sess.run(
+            [self.detection_boxes, self.detection_scores, self.detection_classes],
+            feed_dict={self.image_tensor: images})
+        return boxes, scores, classes
+
+
+class OpenCVBackend(InferenceBackend):
+    """
+    Class, that runs the graph with OpenCV DNN module, without Tensorflow.
+    OpenCV needs a text description of SSD graph (config_path), generated from the frozen graph and
+    its pipeline.config by tf_text_graph_ssd.py from OpenCV samples. Images are resized to input_size.
+    intra_op_threads sets number of OpenCV threads (0 - chosen by OpenCV).
+    """
+    name = 'opencv'
+
+    def __init__(self, config_path=os.path.join('model_data', 'ssd_mobilenet_opencv.pbtxt'), input_size=(300, 300),
+                 intra_op_threads=0, inter_op_threads=0):
+        self.config_path = config_path
+        self.input_size = input_size
+        self.intra_op_threads = intra_op_threads
+        self.net = None
+
+    def load(self, serialized_graph):
+        load_times = OrderedDict()
+        start = time()
+        if not os.path.exists(self.config_path):
+            raise IOError('OpenCV graph description {} does not exist, create it with tf_text_graph_ssd.py.'.format(
+                self.config_path))
+        if self.intra_op_threads:
+            cv2.setNumThreads(self.intra_op_threads)
+        with open(self.config_path, 'rb') as config_file:
+            config = config_file.read()
+        self.net = cv2.dnn.readNetFromTensorflow(np.frombuffer(serialized_graph, dtype=np.uint8),
+                                                 np.frombuffer(config, dtype=np.uint8))
+        load_times['graph_parse'] = time() - start
+        return load_times
+
+    def run(self, images):
+        # Channels are kept in the order frames are fed to Tensorflow backend
+        blob = cv2.dnn.blobFromImages(list(images), size=self.input_size, swapRB=False, crop=False)
+        self.net.setInput(blob)
+        # Rows of [image index, class, score, xmin, ymin, xmax, ymax]
+        detections = self.net.forward().reshape(-1, 7)
+        # OpenCV gives a row with image index -1 when nothing is detected
+        detections = detections[detections[:, 0] >= 0]
+
+        image_indices = detections[:, 0].astype(np.int32)
+        counts = np.bincount(image_indices, minlength=len(images))
+        detections_per_image = max(int(counts.max()) if len(counts) else 0, 1)
+        boxes = np.zeros((len(images), detections_per_image, 4), dtype=np.float32)
+        scores = np.zeros((len(images), detections_per_image), dtype=np.float32)
+        classes = np.zeros((len(images), detections_per_image), dtype=np.float32)
+        # Position of every detection among detections of its image
+        order = np.argsort(image_indices, kind='stable')
+        positions = np.empty(len(detections), dtype=np.int64)
+        positions[order] = np.arange(len(detections)) - np.repeat(np.cumsum(counts) - counts, counts)
+        boxes[image_indices, positions] = detections[:, [4, 3, 6, 5]]
+        scores[image_indices, positions] = detections[:, 2]
+        classes[image_indices, positions] = detections[:, 1]
+        # Detections of every image by descending score, as Tensorflow gives them
+        by_score = np.argsort(-scores, axis=1, kind='stable')
+        rows = np.arange(len(images))[:, None]
+        return boxes[rows, by_score], scores[rows, by_score], classes[rows, by_score]
+
+
+BACKENDS = OrderedDict([
+    (TensorflowBackend.name, TensorflowBackend),
+    (OpenCVBackend.name, OpenCVBackend),
+])
+
+
+def create_backend(name='tensorflow', **options):
+    """
+    :param name: [str] name of backend in BACKENDS
+    :param options: keyword arguments of the backend
+    :return: [InferenceBackend obj]
+    """
+    if name not in BACKENDS:
+        raise ValueError('Unknown inference backend {}, choose one of: {}.'.format(name, ', '.join(BACKENDS)))
+    return BACKENDS[name](**options)
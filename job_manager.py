@@ -0,0 +1,185 @@
+import logging
+import uuid
+from queue import Queue, Full
+from threading import Thread, Lock
+from time import time
+
+from metrics import STAGE_SECONDS, JOBS
+
+
+class JobQueueFullError(Exception):
+    """Raised when a job is submitted to JobManager with a full queue."""
+
+
+class Job:
+    """
+    Class Job stores state of one background processing task: status, progress and result.
+    Status goes from 'queued' to 'running' and then to 'done' or 'failed'.
+    Jobs with the same key produce the same result, so a new job is not needed while one of them is active.
+    """
+
+    def __init__(self, func, kwargs, file_name, file_type, download_url=None, key=None):
+        self.job_id = uuid.uuid4().hex
+        self.key = key
+        self.func = func
+        self.kwargs = kwargs
+        self.file_name = file_name
+        self.file_type = file_type
+        self.download_url = download_url
+        self.status = 'queued'
+        self.error = None
+        self.result = None
+        self.frames_done = 0
+        self.frames_total = 0
+        self.created = time()
+        self.started = None
+        self.finished = None
+
+    def set_progress(self, frames_done, frames_total):
+        """
+        Progress callback of video_processor.
+        :param frames_done: [int] number of processed frames
+        :param frames_total: [int] number of frames in a video (0 if unknown)
+        :return: [None]
+        """
+        self.frames_done = frames_done
+        self.frames_total = frames_total
+
+    def eta(self):
+        """
+        Estimates remaining processing time from the speed of already processed frames.
+        :return: [float or None] seconds left, None if it can not be estimated yet
+        """
+        if self.status == 'done':
+            return 0.0
+        if self.status != 'running' or not self.frames_done or not self.frames_total:
+            return None
+        elapsed = time() - self.started
+        return max(0.0, elapsed / self.frames_done * (self.frames_total - self.frames_done))
+
+    def to_dict(self):
+        """
+        Public state of a job, used as JSON response of job status endpoint.
+        :return: [dict]
+        """
+        return {
+            'job_id': self.job_id,
+            'file_name': self.file_name,
+            'file_type': self.file_type,
+            'status': self.status,
+            'frames_done': self.frames_done,
+            'frames_total': self.frames_total,
+            'progress': float(self.frames_done) / self.frames_total if self.frames_total else None,
+            'eta': self.eta(),
+            'error': self.error,
+            'download_url': self.download_url if self.status == 'done' else None,
+            'stats': self.result if isinstance(self.result, dict) else None,
+        }
+
+    def run(self):
+        self.status = 'running'
+        self.started = time()
+        STAGE_SECONDS.observe(self.started - self.created, ('queue_wait',))
+        try:
+            self.result = self.func(progress_callback=self.set_progress, **self.kwargs)
+            self.status = 'done'
+        except Exception as e:
+            logging.log(logging.ERROR, 'Job {} for {} failed: {}'.format(self.job_id, self.file_name, e))
+            self.error = str(e)
+            self.status = 'failed'
+        self.finished = time()
+        JOBS.inc(labels=(self.status,))
+
+
+class JobManager:
+    """
+    Class, that runs jobs on a pool of background worker threads.
+    The queue of waiting jobs is bounded: submit raises JobQueueFullError when it is full.
+    Finished jobs are kept for job_live_time seconds, so their status can still be requested.
+    """
+
+    def __init__(self, workers=2, max_queue_size=16, job_live_time=60 * 30):
+        self.workers = workers
+        self.job_live_time = job_live_time
+        self.jobs = {}
+        self._queue = Queue(maxsize=max_queue_size)
+        self._threads = []
+        self._lock = Lock()
+
+    def submit(self, job):
+        """
+        Puts job into the queue.
+        :param job: [Job obj] job to run
+        :return: [Job obj] submitted job
+        """
+        self.__start_workers()
+        with self._lock:
+            self.__forget_old_jobs()
+            self.jobs[job.job_id] = job
+        try:
+            self._queue.put_nowait(job)
+        except Full:
+            with self._lock:
+                del self.jobs[job.job_id]
+            raise JobQueueFullError('Job queue is full ({} jobs waiting).'.format(self._queue.maxsize))
+        logging.log(logging.INFO, 'Job {} for {} queued.'.format(job.job_id, job.file_name))
+        return job
+
+    def add_finished(self, job):
+        """
+        Registers a job, whose result already exists, as done.
+        :param job: [Job obj] job, that will not be run
+        :return: [Job obj] registered job
+        """
+        job.status = 'done'
+        job.started = job.finished = time()
+        with self._lock:
+            self.__forget_old_jobs()
+            self.jobs[job.job_id] = job
+        return job
+
+    def find_active(self, key):
+        """
+        :param key: [str] key of a job
+        :return: [Job obj or None] queued or running job with given key
+        """
+        with self._lock:
+            for job in self.jobs.values():
+                if job.key == key and job.status in ('queued', 'running'):
+                    return job
+        return None
+
+    def get(self, job_id):
+        """
+        :param job_id: [str] id of a job
+        :return: [Job obj or None] job with given id
+        """
+        with self._lock:
+            return self.jobs.get(job_id)
+
+    def queue_depth(self):
+        return self._queue.qsize()
+
+    def __start_workers(self):
+        with self._lock:
+            if self._threads:
+                return
+            logging.log(logging.INFO, 'Starting {} job workers.'.format(self.workers))
+            for i in range(self.workers):
+                thread = Thread(target=self.__work, name='job-worker-{}'.format(i))
+                thread.daemon = True
+                thread.start()
+                self._threads.append(thread)
+
+    def __work(self):
+        while True:
+            job = self._queue.get()
+            logging.log(logging.INFO, 'Job {} for {} started.'.format(job.job_id, job.file_name))
+            job.run()
+            logging.log(logging.INFO, 'Job {} for {} {}.'.format(job.job_id, job.file_name, job.status))
+
+    def __forget_old_jobs(self):
+        now = time()
+        for job_id in [job_id for job_id, job in self.jobs.items()
+                       if job.finished and now - job.finished > self.job_live_time]:
+            del self.jobs[job_id]
@@ -1,19 +1,151 @@
+import functools
+import json
 import logging
 import os
-from time import time, sleep
-from threading import Thread
+import shutil
+import tempfile
+import uuid
+import zipfile
+from collections import OrderedDict
+from queue import Queue, Full
+from time import time
+from threading import Thread, Event, Lock, local
 
 import cv2
-from flask import Flask, redirect, flash, send_file, abort, request
+from flask import Flask, Response, redirect, flash, send_file, abort, request, jsonify, url_for, stream_with_context
 from werkzeug.utils import secure_filename
 
+from batch_processor import BatchImageProcessor, BatchLimitError, list_uploaded_images
+from clip_extractor import ClipExtractor
+from detection_store import DetectionRecorder, DetectionStore
 from frame import Frame
+from job_manager import Job, JobManager, JobQueueFullError
+from metrics import Gauge, STAGE_SECONDS, FRAMES, UPLOADS, render as render_metrics
+from micro_batcher import MicroBatcher
 from model_manager import ModelManager
+from motion_detector import MotionDetector
+from result_cache import ResultCache, hash_upload
+from segment_processor import process_video_segments
+from storage_manager import StorageManager
+from stream_processor import StreamProcessor
+from tracker import IouTracker
+from video_pipeline import VideoPipeline, PipelineStage, read_frames
+from worker_pool import InferencePool, put_detections_into_frame, split_cpus
 
 app = Flask(__name__)
+# Directory of uploaded, processed and recorded files
+STORAGE_DIR = os.path.abspath(os.environ.get('STORAGE_DIR', 'storage'))
+# Number of video frames passed to the person detector in one session run
+DEFAULT_BATCH_SIZE = int(os.environ.get('BATCH_SIZE', 8))
+# Maximum number of frames waiting between two stages of video pipeline
+PIPELINE_QUEUE_SIZE = int(os.environ.get('PIPELINE_QUEUE_SIZE', 16))
+# Default number of frames between keyframes processed by detectors (0 - every frame is processed)
+DEFAULT_KEYFRAME_INTERVAL = int(os.environ.get('KEYFRAME_INTERVAL', 0))
+# Default minimal changed part of a frame since the last analysed one to analyse it again (0 - disabled)
+DEFAULT_MOTION_THRESHOLD = float(os.environ.get('MOTION_THRESHOLD', 0))
+# Scale of frame passed to face detector when faces are searched once per frame
+FACE_FRAME_SCALE = float(os.environ.get('FACE_FRAME_SCALE', 1.0))
+# Size (WIDTHxHEIGHT) frames are resized to before person detection, full resolution if not set
+PERSON_INFERENCE_SIZE = tuple(int(side) for side in os.environ['PERSON_INFERENCE_SIZE'].split('x')) \
+    if os.environ.get('PERSON_INFERENCE_SIZE') else None
+# Runtime of person detection model: 'tensorflow' or 'opencv' (see inference_backends)
+PERSON_BACKEND = os.environ.get('PERSON_BACKEND', 'tensorflow')
+# Frozen graph of person detection model: 'original', 'optimized' or 'quantized' (see graph_optimizer)
+PERSON_GRAPH_VARIANT = os.environ.get('PERSON_GRAPH_VARIANT', 'original')
+# Size in pixels person crops are scaled to fit expected face for face detection, not scaled if 0
+FACE_SIZE = int(os.environ.get('FACE_SIZE', 0))
+# Part of person box height from its top searched for a face and minimal side in pixels of the searched region
+FACE_HEAD_RATIO = float(os.environ.get('FACE_HEAD_RATIO', 0.4))
+FACE_MIN_CROP_SIZE = int(os.environ.get('FACE_MIN_CROP_SIZE', 20))
+# Number of background workers processing uploaded files and maximum number of waiting jobs
+JOB_WORKERS = int(os.environ.get('JOB_WORKERS', 2))
+JOB_QUEUE_SIZE = int(os.environ.get('JOB_QUEUE_SIZE', 16))
+# Seconds a client is asked to wait before retrying an upload rejected because of a full queue
+JOB_RETRY_AFTER = int(os.environ.get('JOB_RETRY_AFTER', 30))
+# Maximum total size of processed files kept for repeated uploads
+RESULT_CACHE_BYTES = int(os.environ.get('RESULT_CACHE_BYTES', 1 << 30))
+# Seconds a stored file is kept after its last access and maximum total size of stored files
+STORAGE_LIVE_TIME = int(os.environ.get('STORAGE_LIVE_TIME', 60 * 30))
+STORAGE_MAX_BYTES = int(os.environ.get('STORAGE_MAX_BYTES', 10 << 30))
+# Number of worker processes running detectors, each with its own models (0 - detectors run in server process)
+INFERENCE_WORKERS = int(os.environ.get('INFERENCE_WORKERS', 0))
+# CPUs of inference workers: 'auto' splits available CPUs between workers, or CPU sets like '0,1;2,3'
+WORKER_CPUS = os.environ.get('WORKER_CPUS', '')
+# Tensorflow intra-op and inter-op threads of every inference worker (0 - chosen by Tensorflow)
+WORKER_INTRA_OP_THREADS = int(os.environ.get('WORKER_INTRA_OP_THREADS', 0))
+WORKER_INTER_OP_THREADS = int(os.environ.get('WORKER_INTER_OP_THREADS', 0))
+# Number and size of shared memory slots frames are passed to inference workers through
+SHARED_FRAME_SLOTS = int(os.environ.get('SHARED_FRAME_SLOTS', 0))
+SHARED_FRAME_BYTES = int(os.environ.get('SHARED_FRAME_BYTES', 1920 * 1080 * 3))
+# Videos are split into segments processed by parallel worker processes: 'auto' - one segment per available CPU,
+# a number - maximum number of segments, empty - videos are processed from start to end in the server process
+VIDEO_SEGMENTS = os.environ.get('VIDEO_SEGMENTS', '')
+# Maximum number of uploaded images of concurrent requests detected in one batch (1 - every image alone)
+# and maximum milliseconds the first image of a batch waits for others
+IMAGE_BATCH_SIZE = int(os.environ.get('IMAGE_BATCH_SIZE', 8))
+IMAGE_BATCH_WAIT_MS = float(os.environ.get('IMAGE_BATCH_WAIT_MS', 5))
+# With 'clips' output format only clips of videos with persons are written: outside of clips persons are searched
+# on every CLIP_PROBE_INTERVAL-th frame, clips start CLIP_PRE_PADDING seconds before persons are found and end
+# CLIP_POST_PADDING seconds after they were seen
+CLIP_PROBE_INTERVAL = int(os.environ.get('CLIP_PROBE_INTERVAL', 5))
+CLIP_PRE_PADDING = float(os.environ.get('CLIP_PRE_PADDING', 1.0))
+CLIP_POST_PADDING = float(os.environ.get('CLIP_POST_PADDING', 2.0))
+# Limits of images of one upload to /batch (single images and members of zip archives) and number of threads
+# decoding, detecting faces, drawing and encoding images of one upload
+BATCH_MAX_IMAGES = int(os.environ.get('BATCH_MAX_IMAGES', 1000))
+BATCH_MAX_IMAGE_BYTES = int(os.environ.get('BATCH_MAX_IMAGE_BYTES', 50 << 20))
+BATCH_THREADS = int(os.environ.get('BATCH_THREADS', 4))
+# Live sources served as MJPEG at /streams/<name>, 'name=source' pairs separated by ';', where source is a camera
+# device number or a stream URL, e.g. 'door=0;hall=rtsp://camera/stream'
+STREAM_SOURCES = OrderedDict(pair.split('=', 1) for pair in os.environ.get('STREAM_SOURCES', '').split(';')
+                             if '=' in pair)
+# Maximum milliseconds from capture of a stream frame until it is sent, older frames are dropped before analysis
+STREAM_LATENCY_BUDGET_MS = float(os.environ.get('STREAM_LATENCY_BUDGET_MS', 500))
+# 'latest' analyses only the newest frame, 'queue' analyses up to STREAM_BUFFER_FRAMES waiting frames in order
+STREAM_DROP_POLICY = os.environ.get('STREAM_DROP_POLICY', 'latest')
+STREAM_BUFFER_FRAMES = int(os.environ.get('STREAM_BUFFER_FRAMES', 4))
+STREAM_JPEG_QUALITY = int(os.environ.get('STREAM_JPEG_QUALITY', 80))
+# Batch sizes person detector is warmed up with before the first request
+WARM_UP_BATCH_SIZES = tuple(sorted({1, DEFAULT_BATCH_SIZE, IMAGE_BATCH_SIZE}))
+model_manager = None
+inference_pool = None
+image_batcher = None
+# Models are loaded and warmed up (see create_app) and seconds spent on every loading step
+is_ready = False
+startup_times = OrderedDict()
+# Error of the last failed loading of models, reported by /readyz
+startup_error = None
+_startup_lock = Lock()
+# Stream processors by source name, shared by clients of the same source
+streams = {}
+_streams_lock = Lock()
+# Clients of a source wait while it is opened or closed, other sources are not blocked by it
+_stream_start_locks = {name: Lock() for name in STREAM_SOURCES}
+job_manager = JobManager(workers=JOB_WORKERS, max_queue_size=JOB_QUEUE_SIZE)
+storage_manager = StorageManager(STORAGE_DIR, live_time=STORAGE_LIVE_TIME,
+                                 max_bytes=STORAGE_MAX_BYTES)
+
+
+def discard_result(output_file):
+    """
+    Deletes a processed file evicted from the result cache together with its timeline of clips, if it has one.
+    Files in use are left to expire (see StorageManager.discard).
+    :param output_file: [str] path to a processed file
+    :return: [None]
+    """
+    storage_manager.discard(output_file)
+    storage_manager.discard('{}.timeline.json'.format(output_file))
+
+
+result_cache = ResultCache(max_bytes=RESULT_CACHE_BYTES, on_evict=discard_result)
+Gauge('person_detection_job_queue_depth', 'Jobs waiting for a worker.', func=lambda: job_manager.queue_depth())
+Gauge('person_detection_result_cache_bytes', 'Size of cached processed files.',
+      func=lambda: result_cache.stats()['bytes'])
+Gauge('person_detection_storage_bytes', 'Size of files in storage.', func=lambda: storage_manager.stats()['bytes'])
+# Level of log messages; per-frame messages are written only with DEBUG
 logging.basicConfig(
-    level="INFO",
-    format="[%(levelname)s %(asctime)s path:%(pathname)s line:%(lineno)s] %(message)s",
+    level=os.environ.get('LOG_LEVEL', 'INFO'),
+    format="[%(levelname)s %(asctime)s %(threadName)s] %(message)s",
     datefmt="%Y/%m/%d %I:%M:%S"
 )
 
@@ -24,11 +156,122 @@ def get_local_filename(file_name):
     :param file_name: [str] file name
     :return: [str] file path in storage
     """
-    path = os.path.abspath(os.path.join('storage', file_name))
+    path = os.path.join(STORAGE_DIR, file_name)
     return path
 
 
-def video_processor(input_file, output_file, file_type, threshold_person, threshold_face):
+def get_model_options():
+    """
+    :return: [dict] keyword arguments of ModelManager set by env variables
+    """
+    return dict(face_frame_scale=FACE_FRAME_SCALE,
+                person_inference_size=PERSON_INFERENCE_SIZE,
+                face_size=FACE_SIZE,
+                face_head_ratio=FACE_HEAD_RATIO,
+                face_min_crop_size=FACE_MIN_CROP_SIZE,
+                person_backend=PERSON_BACKEND,
+                person_graph_variant=PERSON_GRAPH_VARIANT)
+
+
+def create_app(load_models=True):
+    """
+    Application factory. Loads models once per process: imports Tensorflow and dlib, builds graph and warms up
+    detectors (or starts inference workers, that do it), then indexes storage and starts deleting old files.
+    Uploads are answered with 503 and /readyz is not ready until models are loaded; /readyz reports
+    the error if loading fails.
+    :param load_models: [bool] False in the master process of a pre-fork server, workers load models after fork
+    :return: [Flask obj] application
+    """
+    global model_manager, inference_pool, image_batcher, is_ready, startup_error
+    if not load_models:
+        return app
+    with _startup_lock:
+        if is_ready:
+            return app
+        start = time()
+        model_options = get_model_options()
+        try:
+            if INFERENCE_WORKERS > 0:
+                # Models are loaded only by worker processes
+                model_options.update(intra_op_threads=WORKER_INTRA_OP_THREADS,
+                                     inter_op_threads=WORKER_INTER_OP_THREADS, warm_up_batch_sizes=WARM_UP_BATCH_SIZES)
+                inference_pool = InferencePool(workers=INFERENCE_WORKERS, model_options=model_options,
+                                               cpu_sets=split_cpus(INFERENCE_WORKERS, WORKER_CPUS),
+                                               slots=SHARED_FRAME_SLOTS, slot_bytes=SHARED_FRAME_BYTES).start()
+                startup_times['workers'] = inference_pool.load_times
+            else:
+                model_manager = ModelManager(**model_options)
+                model_manager.build_graph()
+                model_manager.warm_up(batch_sizes=WARM_UP_BATCH_SIZES)
+                startup_times.update(model_manager.load_times)
+                if IMAGE_BATCH_SIZE > 1:
+                    image_batcher = MicroBatcher(detect_persons_of_images, max_batch_size=IMAGE_BATCH_SIZE,
+                                                 max_wait=IMAGE_BATCH_WAIT_MS / 1000.0, name='image-batcher')
+        except Exception as e:
+            # The process keeps serving, so the error is seen by /readyz instead of a restarting worker
+            startup_error = '{}: {}'.format(type(e).__name__, e)
+            logging.log(logging.ERROR, 'Models can not be loaded: {}'.format(startup_error))
+            return app
+        startup_error = None
+        startup_times['total'] = time() - start
+        logging.log(logging.INFO, 'Models are ready in {:.3f} s: {}'.format(startup_times['total'], ', '.join(
+            '{} {:.3f} s'.format(step, seconds) for step, seconds in startup_times.items()
+            if isinstance(seconds, float) and step != 'total')))
+        storage_manager.start()
+        is_ready = True
+    return app
+
+
+def detect_persons_of_images(items):
+    """
+    Detects persons of images of concurrent requests in one batch (see MicroBatcher).
+    :param items: [list of tuple] Frame, person threshold and keep_raw flag of every image; images have the same
+                  size unless person detector resizes them, keep_raw is the same
+    :return: [list of Frame obj] Frames with person boxes and scores
+    """
+    frames = [current_frame for current_frame, _, _ in items]
+    model_manager.put_person_predictions_into_frames(frames, [threshold for _, threshold, _ in items],
+                                                     keep_raw=items[0][2])
+    return frames
+
+
+def models_version():
+    """
+    :return: [str] version of models, that process uploads (see ModelManager.version)
+    """
+    if inference_pool is not None:
+        return inference_pool.version
+    return model_manager.version
+
+
+def open_video(input_file, output_file):
+    """
+    Opens a video for reading and a writer of processed video with the same size and frame rate.
+    :param input_file: [str] path to a video file
+    :param output_file: [str] path to save processed video file
+    :return: [tuple] VideoCapture, VideoWriter and number of frames in the video
+    """
+    # Create a VideoCapture
+    cap = cv2.VideoCapture(input_file)
+
+    # save parameters of video
+    video_width = int(cap.get(3))
+    video_height = int(cap.get(4))
+    frame_rate = int(cap.get(5))
+    frames_total = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+    # Create a VideoWriter
+    fourcc = cv2.VideoWriter_fourcc(*'MP4V')
+    writer = cv2.VideoWriter(output_file, fourcc, frame_rate, (video_width, video_height))
+    return cap, writer, frames_total
+
+
+class StreamCancelledError(Exception):
+    """Raised in video_processor when the client of a detections stream is gone."""
+
+
+def video_processor(input_file, output_file, file_type, threshold_person, threshold_face, batch_size=1,
+                    face_mode='person', keyframe_interval=0, motion_threshold=0, detections_dir=None,
+                    progress_callback=None, output_format='media', frame_callback=None):
     """
     Main method. Process video or image. Detects persons at frames/image, detects face at person, 
     writes bounding box in person and his face.
@@ -37,96 +280,547 @@ def video_processor(input_file, output_file, file_type, threshold_person, thresh
     :param file_type: [str ('video' or 'image')] type of file
     :param threshold_person: [float] confidence level (Threshold) for person detection algorithm
     :param threshold_face: [float] confidence level (Threshold) for face detection algorithm
-    :return: [None]
+    :param batch_size: [int] number of video frames passed to person detection at once
+    :param face_mode: [str ('person' or 'frame')] search faces in every person crop or once per frame
+    :param keyframe_interval: [int] if greater than 1, detectors run only on every keyframe_interval-th
+                              frame (or earlier when tracking becomes unreliable) and persons are
+                              tracked between keyframes
+    :param motion_threshold: [float] if greater than 0, video frames whose changed part since the last
+                             analysed frame is below it reuse detections of that frame
+    :param detections_dir: [str or None] directory to record raw detections to, so the file can be rendered
+                           again with other thresholds (see rerender_processor); not recorded when tracking
+    :param progress_callback: [callable or None] called with numbers of processed and total frames
+    :param output_format: [str ('media' or 'json')] 'json' skips drawing and writing of output_file,
+                          detections of every frame are passed to frame_callback instead
+    :param frame_callback: [callable or None] called with Frame.to_dict of every frame in 'json' format
+    :return: [dict or None] pipeline statistics for a video (see VideoPipeline.stats)
     """
     logging.log(logging.INFO, 'Processing {} from {} to {}'.format(file_type, input_file, output_file))
+    only_detections = output_format == 'json'
     global model_manager
 
     if file_type == 'video':
-        # Create a VideoCapture
-        cap = cv2.VideoCapture(input_file)
-
-        # Initialise a counter
-        frame_number = 0
-        # save parameters of video
-        video_width = int(cap.get(3))
-        video_height = int(cap.get(4))
-        frame_rate = int(cap.get(5))
-        # Create a VideoWriter
-        fourcc = cv2.VideoWriter_fourcc(*'MP4V')
-        writer = cv2.VideoWriter(output_file, fourcc, frame_rate, (video_width, video_height))
-
-        start_fps = time()
-        # Going through video frame by frame
-        logging.log(logging.INFO, 'Start detection process loop for {}.'.format(os.path.split(input_file)[-1]))
-        while cap.isOpened():
+        if only_detections:
+            cap, writer = cv2.VideoCapture(input_file), None
+            frames_total = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+        else:
+            cap, writer, frames_total = open_video(input_file, output_file)
 
-            start = time()
-            logging.log(logging.INFO, "Analysing capture {}".format(frame_number))
-            frame_number += 1
+        tracker = IouTracker()
+        motion_detector = MotionDetector(threshold=motion_threshold)
+        keyframes = [0]
+        skipped = [0]
+        # The last frame that was analysed by detectors or tracker
+        last_analysed = [None]
+        recorder = DetectionRecorder(threshold_person) if detections_dir and keyframe_interval <= 1 else None
 
-            # Get next frame of input video, create Frame object
-            is_retrieved, image = cap.read()
-            if not is_retrieved:
-                break
-            current_frame = Frame(image)
+        def detect_motion(current_frame):
+            current_frame.is_static = not motion_detector.is_changed(current_frame.image)
+            skipped[0] += current_frame.is_static
+            return current_frame
 
-            model_manager.put_all_predictions_into_frame(current_frame, threshold_person, threshold_face)
-            current_frame.draw_all_labeled_bounding_boxes()
+        def track(current_frame):
+            if current_frame.is_static:
+                tracker.skip()
+                current_frame.copy_detections(last_analysed[0])
+                return current_frame
+            if tracker.needs_keyframe(keyframe_interval):
+                keyframes[0] += 1
+                if inference_pool is not None:
+                    put_detections_into_frame(current_frame, inference_pool.submit(
+                        current_frame.image, threshold_person, threshold_face, face_mode).result())
+                else:
+                    model_manager.put_all_predictions_into_frame(current_frame, threshold_person, threshold_face,
+                                                                 face_mode)
+                tracker.update(current_frame)
+            else:
+                tracker.predict(current_frame)
+            last_analysed[0] = current_frame
+            return current_frame
+
+        def detect_persons(frames):
+            analysed_frames = [current_frame for current_frame in frames if not current_frame.is_static]
+            if analysed_frames:
+                model_manager.put_person_predictions_into_frames(analysed_frames, threshold_person,
+                                                                 keep_raw=recorder is not None)
+            return frames
+
+        def detect_faces(current_frame):
+            if current_frame.is_static:
+                current_frame.copy_detections(last_analysed[0])
+                return current_frame
+            model_manager.put_face_predictions_into_frame(current_frame, threshold_face, face_mode)
+            last_analysed[0] = current_frame
+            return current_frame
+
+        def dispatch(current_frame):
+            if current_frame.is_static:
+                return current_frame, None
+            return current_frame, inference_pool.submit(current_frame.image, threshold_person, threshold_face,
+                                                        face_mode, keep_raw=recorder is not None)
+
+        def collect(item):
+            current_frame, detections = item
+            if detections is None:
+                current_frame.copy_detections(last_analysed[0])
+                return current_frame
+            put_detections_into_frame(current_frame, detections.result())
+            last_analysed[0] = current_frame
+            return current_frame
 
-            if frame_number % 5 == 0:
-                logging.log(logging.INFO, '{0:3.3f} FPS \r'.format(
-                    frame_number / (time() - start_fps)))
+        def draw(current_frame):
+            if recorder is not None:
+                recorder.add(current_frame)
+            current_frame.draw_all_labeled_bounding_boxes()
+            return current_frame
 
+        def encode(current_frame):
             writer.write(current_frame.image)
+            if progress_callback is not None:
+                progress_callback(pipeline.stages[-1].processed + 1, frames_total)
+
+        def serialize(current_frame):
+            if recorder is not None:
+                recorder.add(current_frame)
+            frame_index = pipeline.stages[-1].processed
+            frame_callback(current_frame.to_dict(frame_index))
+            if progress_callback is not None:
+                progress_callback(frame_index + 1, frames_total)
+
+        if keyframe_interval > 1:
+            analysis_stages = [PipelineStage('tracking', track)]
+        elif inference_pool is not None:
+            # Frames are detected by worker processes concurrently, collected in the order they were dispatched
+            analysis_stages = [
+                PipelineStage('dispatch', dispatch),
+                PipelineStage('inference_workers', collect),
+            ]
+        else:
+            analysis_stages = [
+                PipelineStage('person_inference', detect_persons, batch_size=batch_size),
+                PipelineStage('face_detection', detect_faces),
+            ]
+        if motion_threshold > 0:
+            analysis_stages.insert(0, PipelineStage('motion', detect_motion))
+        if only_detections:
+            output_stages = [PipelineStage('serialize', serialize)]
+        else:
+            output_stages = [PipelineStage('draw', draw), PipelineStage('encode', encode)]
+        # Decoding, inference, drawing and encoding run concurrently, joined by bounded queues
+        pipeline = VideoPipeline(read_frames(cap), analysis_stages + output_stages, queue_size=PIPELINE_QUEUE_SIZE)
+
+        logging.log(logging.INFO, 'Start detection process loop for {}.'.format(os.path.split(input_file)[-1]))
+        try:
+            stats = pipeline.run()
+        finally:
+            if writer is not None:
+                writer.release()
+            cap.release()
+        if recorder is not None:
+            recorder.save(detections_dir)
+        if keyframe_interval > 1:
+            stats['keyframes'] = keyframes[0]
+        frames_done = pipeline.stages[-1].processed
+        if motion_threshold > 0:
+            stats['skipped_frames'] = skipped[0]
+            stats['skip_ratio'] = float(skipped[0]) / frames_done if frames_done else 0.0
+        logging.log(logging.INFO, '{0:3.3f} FPS, {1} frames processed in {2:.3f} s'.format(
+            stats['fps'], frames_done, stats['elapsed']))
+        return stats
+    elif file_type == 'image':
+        with STAGE_SECONDS.time(('decode',)):
+            current_frame = Frame(cv2.imread(input_file))
+        if inference_pool is not None:
+            with STAGE_SECONDS.time(('inference_workers',)):
+                put_detections_into_frame(current_frame, inference_pool.submit(
+                    current_frame.image, threshold_person, threshold_face, face_mode,
+                    keep_raw=detections_dir is not None).result())
+        else:
+            keep_raw = detections_dir is not None
+            with STAGE_SECONDS.time(('person_inference',)):
+                if image_batcher is not None:
+                    # Images of one batch are stacked, so they are grouped by size unless detector resizes them
+                    inference_size = getattr(model_manager.models['person_detector'], 'inference_size', None)
+                    image_batcher.submit((current_frame, threshold_person, keep_raw),
+                                         group=(inference_size or current_frame.image.shape, keep_raw)).result()
+                else:
+                    model_manager.put_person_predictions_into_frames([current_frame], threshold_person,
+                                                                     keep_raw=keep_raw)
+            with STAGE_SECONDS.time(('face_detection',)):
+                model_manager.put_face_predictions_into_frame(current_frame, threshold_face, face_mode)
+        if detections_dir is not None:
+            recorder = DetectionRecorder(threshold_person)
+            recorder.add(current_frame)
+            recorder.save(detections_dir)
+        if only_detections:
+            frame_callback(current_frame.to_dict())
+        else:
+            with STAGE_SECONDS.time(('draw',)):
+                current_frame.draw_all_labeled_bounding_boxes()
+            with STAGE_SECONDS.time(('encode',)):
+                cv2.imwrite(output_file, current_frame.image)
+        FRAMES.inc()
+        if progress_callback is not None:
+            progress_callback(1, 1)
+
+
+def segment_video_processor(input_file, output_file, file_type, threshold_person, threshold_face, batch_size=1,
+                            face_mode='person', detections_dir=None, progress_callback=None):
+    """
+    Processes a video in segments by parallel worker processes (see segment_processor), each with its own models.
+    Arguments are the same as of video_processor; tracking and motion detection are not used.
+    A video too short for several segments, or with unknown number of frames, is processed by video_processor.
+    :return: [dict] statistics of segments (see process_video_segments) or of video_processor
+    """
+    logging.log(logging.INFO, 'Processing {} from {} to {} in segments'.format(file_type, input_file, output_file))
+    return process_video_segments(input_file, output_file, threshold_person, threshold_face, batch_size=batch_size,
+                                  face_mode=face_mode, detections_dir=detections_dir,
+                                  progress_callback=progress_callback,
+                                  segments=0 if VIDEO_SEGMENTS == 'auto' else int(VIDEO_SEGMENTS),
+                                  model_options=dict(get_model_options(), warm_up_batch_sizes=(batch_size,)),
+                                  queue_size=PIPELINE_QUEUE_SIZE,
+                                  fallback=functools.partial(video_processor, input_file, output_file, file_type,
+                                                             threshold_person, threshold_face, batch_size=batch_size,
+                                                             face_mode=face_mode, detections_dir=detections_dir,
+                                                             progress_callback=progress_callback))
+
+
+def clip_processor(input_file, output_file, file_type, threshold_person, threshold_face, face_mode='person',
+                   probe_interval=CLIP_PROBE_INTERVAL, pre_padding=CLIP_PRE_PADDING, post_padding=CLIP_POST_PADDING,
+                   timeline_file=None, progress_callback=None):
+    """
+    Writes only clips of a video with persons, drawn, and saves their timeline (see ClipExtractor).
+    :param input_file: [str] path to a video file
+    :param output_file: [str] path to save clips to
+    :param file_type: [str ('video')] type of file
+    :param threshold_person: [float] confidence level (Threshold) for person detection algorithm
+    :param threshold_face: [float] confidence level (Threshold) for face detection algorithm
+    :param face_mode: [str ('person' or 'frame')] search faces in every person crop or once per frame
+    :param probe_interval: [int] persons are searched on every probe_interval-th frame outside of clips
+    :param pre_padding: [float] seconds of a clip before persons are found
+    :param post_padding: [float] seconds of a clip after persons were seen
+    :param timeline_file: [str or None] path to save timeline of clips as JSON
+    :param progress_callback: [callable or None] called with numbers of read and total frames
+    :return: [dict] numbers of grabbed, retrieved and written frames and timeline of clips
+    """
+    logging.log(logging.INFO, 'Extracting clips with persons of {} {} to {}'.format(
+        file_type, input_file, output_file))
+    start = time()
 
-            finish = time() - start
-            logging.log(logging.INFO, "Analysing ended in %f" % finish)
+    def has_persons(current_frame):
+        if inference_pool is not None:
+            # Workers detect faces too, they are kept for the frame if it opens a clip
+            put_detections_into_frame(current_frame, inference_pool.submit(
+                current_frame.image, threshold_person, threshold_face, face_mode).result())
+        else:
+            model_manager.put_person_predictions_into_frames([current_frame], threshold_person)
+        return len(current_frame.person_boxes)
 
+    def detect(current_frame, is_probed):
+        if inference_pool is not None:
+            if not is_probed:
+                has_persons(current_frame)
+        elif is_probed:
+            model_manager.put_face_predictions_into_frame(current_frame, threshold_face, face_mode)
+        else:
+            model_manager.put_all_predictions_into_frame(current_frame, threshold_person, threshold_face, face_mode)
+        current_frame.draw_all_labeled_bounding_boxes()
+        return len(current_frame.person_boxes)
+
+    extractor = ClipExtractor(has_persons, detect, probe_interval=probe_interval, pre_padding=pre_padding,
+                              post_padding=post_padding)
+    cap, writer, frames_total = open_video(input_file, output_file)
+    try:
+        extractor.extract(cap, writer, frames_total, progress_callback)
+    finally:
         writer.release()
         cap.release()
+    if timeline_file is not None:
+        extractor.save_timeline(timeline_file)
+    stats = extractor.stats(time() - start)
+    logging.log(logging.INFO, '{} clips with {} of {} frames extracted in {:.3f} s'.format(
+        stats['clips'], stats['written_frames'], stats['grabbed_frames'] + stats['retrieved_frames'],
+        stats['elapsed']))
+    return stats
+
+
+def rerender_processor(input_file, output_file, file_type, detections_dir, threshold_person, threshold_face,
+                       progress_callback=None):
+    """
+    Draws recorded detections of a video or image selected with new thresholds, without running detectors.
+    :param input_file: [str] path to a video or image file
+    :param output_file: [str] path to save processed video/image file
+    :param file_type: [str ('video' or 'image')] type of file
+    :param detections_dir: [str] directory with detections recorded by video_processor
+    :param threshold_person: [float] confidence level (Threshold) for person detection algorithm
+    :param threshold_face: [float] confidence level (Threshold) for face detection algorithm
+    :param progress_callback: [callable or None] called with numbers of processed and total frames
+    :return: [dict or None] pipeline statistics for a video (see VideoPipeline.stats)
+    """
+    logging.log(logging.INFO, 'Rendering {} from {} to {} with recorded detections'.format(
+        file_type, input_file, output_file))
+    store = DetectionStore(detections_dir)
+
+    if file_type == 'video':
+        cap, writer, frames_total = open_video(input_file, output_file)
+        frames_total = min(frames_total, len(store)) if frames_total else len(store)
+
+        def select_detections(current_frame):
+            frame_index = pipeline.stages[0].processed
+            if frame_index < len(store):
+                store.put_detections_into_frame(current_frame, frame_index, threshold_person, threshold_face)
+            return current_frame
+
+        def draw(current_frame):
+            current_frame.draw_all_labeled_bounding_boxes()
+            return current_frame
+
+        def encode(current_frame):
+            writer.write(current_frame.image)
+            if progress_callback is not None:
+                progress_callback(pipeline.stages[-1].processed + 1, frames_total)
+
+        pipeline = VideoPipeline(read_frames(cap), [
+            PipelineStage('detections', select_detections),
+            PipelineStage('draw', draw),
+            PipelineStage('encode', encode),
+        ], queue_size=PIPELINE_QUEUE_SIZE)
+        try:
+            stats = pipeline.run()
+        finally:
+            writer.release()
+            cap.release()
+        return stats
     elif file_type == 'image':
         current_frame = Frame(cv2.imread(input_file))
-        model_manager.put_all_predictions_into_frame(current_frame, threshold_person, threshold_face)
+        store.put_detections_into_frame(current_frame, 0, threshold_person, threshold_face)
         current_frame.draw_all_labeled_bounding_boxes()
         cv2.imwrite(output_file, current_frame.image)
+        if progress_callback is not None:
+            progress_callback(1, 1)
 
 
-def start_delete_old_files_daemon(live_time=60):
+def get_job_files(kwargs):
     """
-    Creates util thread that deleting files that "live time" is greater than given.
-    :param live_time: [int] maximum live time of file
-    :return: [None]
+    :param kwargs: arguments of video_processor or rerender_processor
+    :return: [list of str] paths of input, output, detections and timeline of clips in storage
     """
+    return [kwargs[name] for name in ('input_file', 'output_file', 'detections_dir', 'timeline_file')
+            if kwargs.get(name)]
+
+
+def process_and_cache(cache_key, processor=video_processor, **kwargs):
+    """
+    Runs processor, adds its output to storage index and to the result cache.
+    Files of the job are pinned by submit_job and unpinned here when the job is finished.
+    :param cache_key: [str] key of the result, see ResultCache.make_key
+    :param processor: [callable] video_processor or rerender_processor
+    :param kwargs: arguments of processor
+    :return: [dict or None] result of processor
+    """
+    try:
+        result = processor(**kwargs)
+        storage_manager.add(kwargs['output_file'])
+        for name in ('detections_dir', 'timeline_file'):
+            if kwargs.get(name):
+                storage_manager.add(kwargs[name])
+        result_cache.put(cache_key, kwargs['output_file'])
+    finally:
+        storage_manager.unpin(get_job_files(kwargs))
+    return result
+
+
+def stream_detections(kwargs):
+    """
+    Runs video_processor in 'json' format in a background thread and gives detections of every frame
+    as soon as the frame is processed. If the client stops reading, processing is cancelled.
+    The input file is pinned by the caller and unpinned when processing ends.
+    :param kwargs: arguments of video_processor
+    :return: [generator] JSON Lines, one line per frame; the last line has pipeline statistics or error
+    """
+    lines = Queue(maxsize=PIPELINE_QUEUE_SIZE)
+    cancelled = Event()
+
+    def put_line(item):
+        while not cancelled.is_set():
+            try:
+                lines.put(item, timeout=0.1)
+                return
+            except Full:
+                pass
+        raise StreamCancelledError('Client of detections stream for {} is gone.'.format(kwargs['input_file']))
+
+    def process():
+        try:
+            try:
+                stats = video_processor(output_format='json', frame_callback=lambda detections: put_line(
+                    json.dumps(detections)), **kwargs)
+                last_line = {'stats': stats}
+            except StreamCancelledError:
+                raise
+            except Exception as e:
+                logging.log(logging.ERROR, 'Streaming detections of {} failed: {}'.format(kwargs['input_file'], e))
+                last_line = {'error': str(e)}
+            finally:
+                storage_manager.unpin([kwargs['input_file']])
+            put_line(json.dumps(last_line))
+            put_line(None)
+        except StreamCancelledError as e:
+            logging.log(logging.INFO, str(e))
 
-    def delete_old_files():
-        storage_dir = os.path.abspath('storage')
+    thread = Thread(target=process, name='detections-stream')
+    thread.daemon = True
+    thread.start()
+    try:
         while True:
-            logging.log(logging.INFO, 'Checking and deleting old files.')
-            for root, dirs, files in os.walk(storage_dir):
-                for file_name in files:
-                    file_path = os.path.join(root, file_name)
-                    file_live_time = time() - os.path.getmtime(file_path)
-                    if live_time <= file_live_time:
-                        logging.log(logging.INFO, 'Deleting {} with live time {} file.'.format(file_name,
-                                                                                               file_live_time))
-                        os.remove(file_path)
-            sleep(live_time // 2)
+            line = lines.get()
+            if line is None:
+                break
+            yield line + '\n'
+    finally:
+        cancelled.set()
+
+
+def acquire_stream(name, threshold_person, threshold_face, face_mode):
+    """
+    Gives the running processor of a stream source to a new client, starting it if the source is not processed.
+    Thresholds and face mode of the first client are used until the last client of the source leaves.
+    :param name: [str] name of a source from STREAM_SOURCES
+    :param threshold_person: [float] threshold of person detection algorithm
+    :param threshold_face: [float] threshold of face detection algorithm
+    :param face_mode: [str ('person' or 'frame')] face detection strategy
+    :return: [StreamProcessor obj] running processor
+    """
+    with _stream_start_locks[name]:
+        with _streams_lock:
+            processor = streams.get(name)
+            if processor is not None and processor.is_running():
+                processor.clients += 1
+                return processor
+        if inference_pool is not None:
+            def detect_persons(current_frame):
+                put_detections_into_frame(current_frame, inference_pool.submit(
+                    current_frame.image, threshold_person, threshold_face, face_mode).result())
+            detect_faces = None
+        else:
+            def detect_persons(current_frame):
+                model_manager.put_person_predictions_into_frames([current_frame], threshold_person)
+
+            def detect_faces(current_frame):
+                model_manager.put_face_predictions_into_frame(current_frame, threshold_face, face_mode)
+        # Opening of a network source may take long, so streams are not locked meanwhile
+        processor = StreamProcessor(STREAM_SOURCES[name], detect_persons, detect_faces,
+                                    latency_budget=STREAM_LATENCY_BUDGET_MS / 1000.0,
+                                    drop_policy=STREAM_DROP_POLICY, buffer_size=STREAM_BUFFER_FRAMES,
+                                    jpeg_quality=STREAM_JPEG_QUALITY, name=name).start()
+        with _streams_lock:
+            streams[name] = processor
+            processor.clients += 1
+    return processor
+
+
+def release_stream(processor):
+    """
+    Stops the processor of a stream source when its last client leaves.
+    :param processor: [StreamProcessor obj] processor given by acquire_stream
+    :return: [None]
+    """
+    # A new client of the source waits until it is released, so it is not opened twice
+    with _stream_start_locks[processor.name]:
+        with _streams_lock:
+            processor.clients -= 1
+            is_last = processor.clients == 0
+            if is_last and streams.get(processor.name) is processor:
+                # New clients start another processor instead of joining the stopping one
+                del streams[processor.name]
+        if is_last:
+            processor.stop()
+    if is_last:
+        logging.log(logging.INFO, 'Stream {} stopped: {}'.format(processor.name, processor.stats()))
+
 
-    logging.log(logging.INFO, 'Starting old file monitoring.')
-    Thread(target=delete_old_files).start()
+def stream_frames(processor):
+    """
+    :param processor: [StreamProcessor obj] processor given by acquire_stream
+    :return: [generator] parts of MJPEG response until the source ends or the client leaves
+    """
+    try:
+        for part in processor.mjpeg():
+            yield part
+    finally:
+        release_stream(processor)
+
+
+def get_download_url(output_file):
+    """
+    :param output_file: [str] path to a processed file in storage
+    :return: [str] URL of the file (see return_processed_file)
+    """
+    return url_for('return_processed_file', path=os.path.basename(output_file)[len('processed_'):], _external=True)
+
+
+def submit_job(job):
+    """
+    Queues a job, unless the same result is already being processed or is cached.
+    :param job: [Job obj] job with key of its result (see ResultCache.make_key)
+    :return: [Response obj] 202 with id and status URL of the job, 200 if the result is cached,
+             503 if the job queue is full
+    """
+    active_job = job_manager.find_active(job.key)
+    cached_path = result_cache.get(job.key) if active_job is None else None
+    if active_job is not None:
+        logging.log(logging.INFO, 'File {} is already being processed by job {}.'.format(
+            job.file_name, active_job.job_id))
+        job = active_job
+    elif cached_path is not None:
+        storage_manager.touch(cached_path)
+        logging.log(logging.INFO, 'File {} was already processed, returning cached result.'.format(job.file_name))
+        # The same content may have been uploaded under another name, so the cached file has that name
+        job.kwargs['output_file'] = cached_path
+        if job.kwargs.get('timeline_file'):
+            job.kwargs['timeline_file'] = '{}.timeline.json'.format(cached_path)
+        job.download_url = get_download_url(cached_path)
+        job = job_manager.add_finished(job)
+        status_url = url_for('job_status', job_id=job.job_id, _external=True)
+        return jsonify({'job_id': job.job_id, 'status': job.status, 'status_url': status_url,
+                        'download_url': job.download_url})
+    else:
+        # Files of a queued or running job are never deleted from storage
+        storage_manager.pin(get_job_files(job.kwargs))
+        try:
+            job_manager.submit(job)
+        except JobQueueFullError as e:
+            storage_manager.unpin(get_job_files(job.kwargs))
+            logging.log(logging.WARNING, 'File {} rejected: {}'.format(job.file_name, e))
+            response = jsonify({'error': str(e)})
+            response.status_code = 503
+            response.headers['Retry-After'] = str(JOB_RETRY_AFTER)
+            return response
+
+    status_url = url_for('job_status', job_id=job.job_id, _external=True)
+    response = jsonify({'job_id': job.job_id, 'status': job.status, 'status_url': status_url})
+    response.status_code = 202
+    response.headers['Location'] = status_url
+    return response
 
 
 @app.route('/', methods=['GET', 'POST'])
 def upload_file():
     """
-    Method uploads file to local storage and runs person detection algorithm.
-    :return: [str] URL to a processed video/image
+    Method uploads file to local storage and queues a person detection job for it.
+    With output_format 'json' detections are returned instead: for an image as JSON object,
+    for a video as JSON Lines streamed while frames are processed.
+    :return: [json] id and status URL of the queued job, or detections
     """
     if request.method == 'POST':
         if 'file' not in request.files:
             flash('No file part')
             return redirect(request.url)
+        if not is_ready:
+            response = jsonify({'error': 'Models are not loaded yet.'})
+            response.status_code = 503
+            response.headers['Retry-After'] = str(JOB_RETRY_AFTER)
+            return response
         file_to_process = request.files['file']
         file_name = secure_filename(file_to_process.filename)
         file_type = request.form.get('file_type')
@@ -134,37 +828,95 @@ def upload_file():
 
         threshold_person = float(request.form.get('threshold_person') or 0.5)
         threshold_face = float(request.form.get('threshold_face') or 0.1)
+        batch_size = max(1, int(request.form.get('batch_size') or DEFAULT_BATCH_SIZE))
+        output_format = request.form.get('output_format')
+        if output_format not in ('json', 'clips') or output_format == 'clips' and file_type != 'video':
+            output_format = 'media'
+        # Parameters, that change result of processing
+        options = dict(
+            threshold_person=threshold_person,
+            threshold_face=threshold_face,
+            face_mode='frame' if request.form.get('face_mode') == 'frame' else 'person',
+            keyframe_interval=max(0, int(request.form.get('keyframe_interval') or DEFAULT_KEYFRAME_INTERVAL)),
+            motion_threshold=max(0.0, float(request.form.get('motion_threshold') or DEFAULT_MOTION_THRESHOLD)),
+        )
+
+        upload_path = get_local_filename(os.path.join('input_files', 'upload_{}'.format(uuid.uuid4().hex)))
+        output_dir = get_local_filename('output_files')
+        if not os.path.exists(os.path.dirname(upload_path)):
+            os.makedirs(os.path.dirname(upload_path))
+        if not os.path.exists(output_dir):
+            os.makedirs(output_dir)
+        with STAGE_SECONDS.time(('upload_save',)):
+            content_hash = hash_upload(file_to_process, upload_path)
+        UPLOADS.inc(labels=(file_type,))
+
+        # Names of stored files depend on content and parameters, so different files with the same name
+        # do not overwrite each other
+        input_path = get_local_filename(os.path.join('input_files', '{}_{}'.format(content_hash[:16], file_name)))
+        os.replace(upload_path, input_path)
+        # The upload is pinned before it is indexed, so eviction by add does not delete it before its job pins it
+        storage_manager.pin([input_path])
+        is_pin_passed = False
+        try:
+            storage_manager.add(input_path)
+
+            if output_format == 'json':
+                # Detections are returned in the response, nothing is rendered or stored for download
+                kwargs = dict(input_file=input_path, output_file=None, file_type=file_type, batch_size=batch_size,
+                              **options)
+                logging.log(logging.INFO, 'Returning detections of {} {} file'.format(file_name, file_type))
+                if file_type == 'video':
+                    # The pin is released by the stream when the video is processed
+                    is_pin_passed = True
+                    return Response(stream_with_context(stream_detections(kwargs)), mimetype='application/x-ndjson')
+                detections = []
+                video_processor(frame_callback=detections.append, output_format='json', **kwargs)
+                return jsonify(detections[0])
 
-        input_path = get_local_filename(os.path.join('input_files', file_name))
-        output_path = get_local_filename(os.path.join('output_files', 'processed_{}'.format(file_name)))
-        if not os.path.exists(os.path.dirname(input_path)):
-            os.makedirs(os.path.dirname(input_path))
-        if not os.path.exists(os.path.dirname(output_path)):
-            os.makedirs(os.path.dirname(output_path))
-        file_to_process.save(input_path)
-
-        logging.log(logging.INFO,
-                    'Starting to process {} {} file with {} person threshold and {} face threshold'
-                    .format(
-                        file_name,
-                        file_type,
-                        threshold_person,
-                        threshold_face
-                    ))
-        video_processor(input_path,
-                        output_path,
-                        file_type,
-                        threshold_person,
-                        threshold_face)
-
-        download_url = '{}processed/{}'.format(request.base_url, file_name)
-        logging.log(logging.INFO, 'File {} uploaded and processed successfully.'.format(file_name))
-        return '''
-        <!doctype html>
-        <title>Processed file</title>
-        <h1>Processed file</h1>
-        <a href="{}" download>{}</a>
-        '''.format(download_url, file_name)
+            if output_format == 'clips':
+                # Clips are always written with every frame analysed, so tracking and motion options do not apply
+                del options['keyframe_interval'], options['motion_threshold']
+                options.update(
+                    output_format=output_format,
+                    probe_interval=max(1, int(request.form.get('probe_interval') or CLIP_PROBE_INTERVAL)),
+                    pre_padding=max(0.0, float(request.form.get('pre_padding') or CLIP_PRE_PADDING)),
+                    post_padding=max(0.0, float(request.form.get('post_padding') or CLIP_POST_PADDING)),
+                )
+            cache_key = ResultCache.make_key(content_hash, file_type, options, models_version())
+            processed_name = '{}_{}'.format(cache_key[:16], file_name)
+            output_path = get_local_filename(os.path.join('output_files', 'processed_{}'.format(processed_name)))
+            download_url = get_download_url(output_path)
+
+            if output_format == 'clips':
+                del options['output_format']
+                kwargs = dict(input_file=input_path, output_file=output_path, file_type=file_type,
+                              timeline_file='{}.timeline.json'.format(output_path), **options)
+                logging.log(logging.INFO, 'Queueing clip extraction of {} with {} person threshold'.format(
+                    file_name, threshold_person))
+                return submit_job(Job(process_and_cache, dict(kwargs, cache_key=cache_key, processor=clip_processor),
+                                      file_name, file_type, download_url=download_url, key=cache_key))
+
+            kwargs = dict(input_file=input_path, output_file=output_path, file_type=file_type, batch_size=batch_size,
+                          detections_dir=get_local_filename(os.path.join('detections', cache_key[:16])), **options)
+            processor = video_processor
+            if file_type == 'video' and VIDEO_SEGMENTS and options['keyframe_interval'] <= 1 \
+                    and not options['motion_threshold']:
+                processor = segment_video_processor
+                del kwargs['keyframe_interval'], kwargs['motion_threshold']
+            logging.log(logging.INFO,
+                        'Queueing {} {} file with {} person threshold and {} face threshold'
+                        .format(
+                            file_name,
+                            file_type,
+                            threshold_person,
+                            threshold_face
+                        ))
+            return submit_job(Job(process_and_cache, dict(kwargs, cache_key=cache_key, processor=processor), file_name,
+                                  file_type, download_url=download_url, key=cache_key))
+        finally:
+            if not is_pin_passed:
+                storage_manager.unpin([input_path])
     return '''
     <!doctype html>
     <title>Person detection</title>
@@ -178,10 +930,258 @@ def upload_file():
          <input type=submit value=Upload>
       <p>Threshold for person detection  </p><input type="text" name="threshold_person">
       <p>Threshold for face detection    </p><input type="text" name="threshold_face">
+      <p>Frames per inference batch      </p><input type="text" name="batch_size">
+      <p>Face search                     </p><select name="face_mode">
+           <option value="person">In every person</option>
+           <option value="frame">Once per frame</option>
+         </select>
+      <p>Keyframe interval (track persons between keyframes)</p><input type="text" name="keyframe_interval">
+      <p>Motion threshold (skip static frames)</p><input type="text" name="motion_threshold">
+      <p>Output                          </p><select name="output_format">
+           <option value="media">Processed file</option>
+           <option value="json">Detections (JSON)</option>
+           <option value="clips">Clips with persons (video)</option>
+         </select>
+      <p>Seconds of clips before and after persons</p><input type="text" name="pre_padding">
+         <input type="text" name="post_padding">
     </form>
     '''
 
 
+def _any_size_key(image):
+    """
+    Group key of BatchImageProcessor, that puts images of all sizes into the same group.
+    :param image: [numpy array] BGR image
+    :return: [None]
+    """
+    return None
+
+
+@app.route('/batch', methods=['POST'])
+def batch_upload():
+    """
+    Method detects persons and faces of many images uploaded as 'files' fields, each an image or a zip archive
+    of images, and streams back a zip archive of drawn images with manifest.json of their detections.
+    :return: [obj] zip archive, 400 if there are no images or an archive is broken, 413 if limits are exceeded,
+             503 if models are not loaded
+    """
+    files = [uploaded for uploaded in request.files.getlist('files') if uploaded.filename]
+    if not files:
+        response = jsonify({'error': 'No files uploaded.'})
+        response.status_code = 400
+        return response
+    if not is_ready:
+        response = jsonify({'error': 'Models are not loaded yet.'})
+        response.status_code = 503
+        response.headers['Retry-After'] = str(JOB_RETRY_AFTER)
+        return response
+    # Uploads are saved, so images are read one by one while the response is streamed
+    input_dir = get_local_filename('input_files')
+    if not os.path.exists(input_dir):
+        os.makedirs(input_dir)
+    batch_dir = tempfile.mkdtemp(prefix='batch_', dir=input_dir)
+    uploads = []
+    try:
+        with STAGE_SECONDS.time(('upload_save',)):
+            for i, uploaded in enumerate(files):
+                uploads.append((uploaded.filename, os.path.join(batch_dir, str(i))))
+                uploaded.save(uploads[-1][1])
+        images, archives = list_uploaded_images(uploads, max_images=BATCH_MAX_IMAGES,
+                                                max_image_bytes=BATCH_MAX_IMAGE_BYTES)
+    except (BatchLimitError, zipfile.BadZipFile) as e:
+        shutil.rmtree(batch_dir, ignore_errors=True)
+        logging.log(logging.WARNING, 'Batch upload rejected: {}'.format(e))
+        response = jsonify({'error': str(e)})
+        response.status_code = 413 if isinstance(e, BatchLimitError) else 400
+        return response
+    except Exception:
+        shutil.rmtree(batch_dir, ignore_errors=True)
+        raise
+    UPLOADS.inc(len(images), ('batch',))
+
+    threshold_person = float(request.form.get('threshold_person') or 0.5)
+    threshold_face = float(request.form.get('threshold_face') or 0.1)
+    face_mode = 'frame' if request.form.get('face_mode') == 'frame' else 'person'
+    batch_size = max(1, int(request.form.get('batch_size') or DEFAULT_BATCH_SIZE))
+    if inference_pool is not None:
+        # Workers detect persons and faces of every image, images of a batch are detected concurrently
+        def detect_persons(frames):
+            futures = [inference_pool.submit(current_frame.image, threshold_person, threshold_face, face_mode)
+                       for current_frame in frames]
+            for current_frame, future in zip(frames, futures):
+                put_detections_into_frame(current_frame, future.result())
+        detect_faces = None
+    else:
+        def detect_persons(frames):
+            model_manager.put_person_predictions_into_frames(frames, threshold_person)
+
+        thread_managers = local()
+
+        def detect_faces(current_frame):
+            # Faces are searched by threads of the batch, each with its own dlib detector
+            thread_manager = getattr(thread_managers, 'model_manager', None)
+            if thread_manager is None:
+                thread_manager = thread_managers.model_manager = model_manager.copy_for_thread()
+            thread_manager.put_face_predictions_into_frame(current_frame, threshold_face, face_mode)
+    # Detector that resizes images detects images of any size together
+    group_key = _any_size_key if inference_pool is None and getattr(
+        model_manager.models['person_detector'], 'inference_size', None) else None
+    logging.log(logging.INFO, 'Processing batch of {} images with {} person threshold and {} face threshold'.format(
+        len(images), threshold_person, threshold_face))
+    processor = BatchImageProcessor(detect_persons, detect_faces, batch_size=batch_size, threads=BATCH_THREADS,
+                                    group_key=group_key)
+
+    def stream_archive():
+        try:
+            for chunk in processor.zip_archive(images):
+                yield chunk
+        finally:
+            for archive in archives:
+                archive.close()
+            shutil.rmtree(batch_dir, ignore_errors=True)
+
+    response = Response(stream_with_context(stream_archive()), mimetype='application/zip')
+    response.headers['Content-Disposition'] = 'attachment; filename=processed_images.zip'
+    return response
+
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+def job_status(job_id):
+    """
+    Method gives status, progress, ETA and (when done) download URL of a processing job.
+    :param job_id: [str] id of a job returned by upload
+    :return: [json] state of the job
+    """
+    job = job_manager.get(job_id)
+    if job is None:
+        abort(404)
+    return jsonify(job.to_dict())
+
+
+@app.route('/jobs/<job_id>/rerender', methods=['POST'])
+def rerender_job(job_id):
+    """
+    Method queues rendering of a processed file again with new thresholds, using detections recorded by the job.
+    :param job_id: [str] id of a finished job
+    :return: [json] id and status URL of the rendering job
+    """
+    job = job_manager.get(job_id)
+    if job is None:
+        abort(404)
+    detections_dir = (job.kwargs or {}).get('detections_dir')
+    if job.status != 'done' or not detections_dir or not os.path.exists(os.path.join(detections_dir, 'meta.json')) \
+            or not os.path.exists(job.kwargs['input_file']):
+        response = jsonify({'error': 'Job {} has no recorded detections.'.format(job_id)})
+        response.status_code = 409
+        return response
+
+    thresholds = dict(
+        threshold_person=float(request.form.get('threshold_person') or 0.5),
+        threshold_face=float(request.form.get('threshold_face') or 0.1),
+    )
+    cache_key = ResultCache.make_key(job.key, 'rerender', thresholds, None)
+    processed_name = '{}_{}'.format(cache_key[:16], job.file_name)
+    output_path = get_local_filename(os.path.join('output_files', 'processed_{}'.format(processed_name)))
+    kwargs = dict(input_file=job.kwargs['input_file'], output_file=output_path, file_type=job.file_type,
+                  detections_dir=detections_dir, **thresholds)
+    logging.log(logging.INFO, 'Queueing rendering of {} with {} person threshold and {} face threshold'.format(
+        job.file_name, thresholds['threshold_person'], thresholds['threshold_face']))
+    return submit_job(Job(process_and_cache, dict(kwargs, cache_key=cache_key, processor=rerender_processor),
+                          job.file_name, job.file_type,
+                          download_url=get_download_url(output_path),
+                          key=cache_key))
+
+
+@app.route('/streams/<name>', methods=['GET'])
+def stream(name):
+    """
+    Method serves annotated frames of a live source from STREAM_SOURCES as MJPEG (multipart/x-mixed-replace).
+    Query arguments threshold_person, threshold_face and face_mode are used if the source is not processed yet.
+    :param name: [str] name of the source
+    :return: [obj] MJPEG stream, 404 if the source is unknown, 503 if models are not loaded
+    """
+    if name not in STREAM_SOURCES:
+        abort(404)
+    if not is_ready:
+        response = jsonify({'error': 'Models are not loaded yet.'})
+        response.status_code = 503
+        response.headers['Retry-After'] = str(JOB_RETRY_AFTER)
+        return response
+    try:
+        processor = acquire_stream(name, float(request.args.get('threshold_person') or 0.5),
+                                   float(request.args.get('threshold_face') or 0.1),
+                                   'frame' if request.args.get('face_mode') == 'frame' else 'person')
+    except IOError as e:
+        logging.log(logging.ERROR, str(e))
+        response = jsonify({'error': str(e)})
+        response.status_code = 502
+        return response
+    return Response(stream_with_context(stream_frames(processor)),
+                    mimetype='multipart/x-mixed-replace; boundary=frame')
+
+
+@app.route('/streams', methods=['GET'])
+def streams_stats():
+    """
+    Method gives statistics of every configured live source: dropped frames, achieved analysis FPS and latency.
+    :return: [json] statistics by source name, null for sources without clients
+    """
+    with _streams_lock:
+        processors = dict(streams)
+    return jsonify({name: processors[name].stats() if name in processors else None for name in STREAM_SOURCES})
+
+
+@app.route('/healthz', methods=['GET'])
+def healthz():
+    """
+    Method answers while the server process is alive, even if models are still loading.
+    :return: [json] status
+    """
+    return jsonify({'status': 'ok'})
+
+
+@app.route('/readyz', methods=['GET'])
+def readyz():
+    """
+    Method tells whether models are loaded and warmed up, so uploads can be processed.
+    :return: [json] readiness, version of models and seconds spent on loading steps;
+             503 with the loading error, if any, if not ready
+    """
+    if not is_ready:
+        response = jsonify({'ready': False, 'error': startup_error})
+        response.status_code = 503
+        return response
+    return jsonify({'ready': True, 'models_version': models_version(), 'startup_times': startup_times})
+
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    """
+    Method gives counters and per-stage latency histograms (decode, inference, face detection, draw, encode,
+    upload save, queue wait) in Prometheus text format.
+    :return: [str] metrics
+    """
+    return Response(render_metrics(), mimetype='text/plain; version=0.0.4')
+
+
+@app.route('/cache/stats', methods=['GET'])
+def cache_stats():
+    """
+    Method gives size, hit and miss counters of the result cache.
+    :return: [json] statistics of the cache
+    """
+    return jsonify(result_cache.stats())
+
+
+@app.route('/storage/stats', methods=['GET'])
+def storage_stats():
+    """
+    Method gives size of stored files and number of files deleted because they expired or storage was full.
+    :return: [json] statistics of storage
+    """
+    return jsonify(storage_manager.stats())
+
+
 @app.route('/processed/<path:path>', methods=['GET'])
 def return_processed_file(path):
     """
@@ -193,6 +1193,7 @@ def return_processed_file(path):
     try:
         file_path = get_local_filename(os.path.join('output_files', 'processed_{}'.format(path)))
         resp = send_file(file_path)
+        storage_manager.touch(file_path)
     except:
         logging.log(logging.ERROR, 'File {} not found.'.format(path))
         abort(500)
@@ -200,9 +1201,6 @@ def return_processed_file(path):
 
 
 if __name__ == "__main__":
-    start_delete_old_files_daemon(live_time=60*30)
-    # Create manager objects
-    model_manager = ModelManager()
-    model_manager.build_graph()
+    create_app()
     logging.log(logging.INFO, 'Starting person detection server.')
     app.run(host='0.0.0.0')
@@ -0,0 +1,158 @@
+"""
+Counters, gauges and histograms of the server exported in Prometheus text format (see render).
+Metrics are kept in memory of the process; updating one takes a lock and a few additions,
+so they can be updated for every frame. Worker processes of InferencePool are measured by the
+pipeline stage waiting for them.
+"""
+from bisect import bisect_left
+from threading import Lock
+from time import time
+
+# Upper bounds of histogram buckets in seconds
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+_registry = []
+
+
+class _Timer:
+    """Context manager, that observes time spent in its block."""
+
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+        self.start = None
+
+    def __enter__(self):
+        self.start = time()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time() - self.start, self.labels)
+
+
+class Metric:
+    """
+    Base class of metrics. Values are kept per tuple of label values, in the order of label_names.
+    Every metric is registered at creation and rendered by render.
+    """
+    type_name = None
+
+    def __init__(self, name, documentation, label_names=()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self._values = {}
+        self._lock = Lock()
+        _registry.append(self)
+
+    def samples(self):
+        """
+        :return: [list of tuple] name suffix, labels dict and value of every sample
+        """
+        raise NotImplementedError
+
+    def _labels(self, labels):
+        return dict(zip(self.label_names, labels))
+
+
+class Counter(Metric):
+    """Class, that counts events; value only grows."""
+    type_name = 'counter'
+
+    def inc(self, amount=1, labels=()):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            return [('_total', self._labels(labels), value) for labels, value in sorted(self._values.items())]
+
+
+class Gauge(Metric):
+    """Class, that keeps current value; if func is given, the value is read from it on every render."""
+    type_name = 'gauge'
+
+    def __init__(self, name, documentation, label_names=(), func=None):
+        super(Gauge, self).__init__(name, documentation, label_names)
+        self.func = func
+
+    def set(self, value, labels=()):
+        with self._lock:
+            self._values[labels] = value
+
+    def samples(self):
+        if self.func is not None:
+            return [('', {}, self.func())]
+        with self._lock:
+            return [('', self._labels(labels), value) for labels, value in sorted(self._values.items())]
+
+
+class Histogram(Metric):
+    """Class, that counts observed values in buckets and keeps their sum."""
+    type_name = 'histogram'
+
+    def __init__(self, name, documentation, label_names=(), buckets=DEFAULT_BUCKETS):
+        super(Histogram, self).__init__(name, documentation, label_names)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, labels=(), count=1):
+        """
+        :param value: [float] observed value
+        :param labels: [tuple] label values
+        :param count: [int] number of observations of the same value, e.g. frames of a batch
+        :return: [None]
+        """
+        bucket = bisect_left(self.buckets, value)
+        with self._lock:
+            values = self._values.get(labels)
+            if values is None:
+                values = self._values[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            values[0][bucket] += count
+            values[1] += value * count
+            values[2] += count
+
+    def time(self, labels=()):
+        """
+        :param labels: [tuple] label values
+        :return: [context manager] observes seconds spent in its block
+        """
+        return _Timer(self, labels)
+
+    def samples(self):
+        samples = []
+        with self._lock:
+            for labels, (counts, total, count) in sorted(self._values.items()):
+                cumulative = 0
+                for bound, bucket_count in zip(self.buckets + (float('inf'),), counts):
+                    cumulative += bucket_count
+                    bucket_labels = self._labels(labels)
+                    bucket_labels['le'] = '+Inf' if bound == float('inf') else repr(bound)
+                    samples.append(('_bucket', bucket_labels, cumulative))
+                samples.append(('_sum', self._labels(labels), total))
+                samples.append(('_count', self._labels(labels), count))
+        return samples
+
+
+def render():
+    """
+    :return: [str] all metrics in Prometheus text exposition format
+    """
+    lines = []
+    for metric in _registry:
+        lines.append('# HELP {} {}'.format(metric.name, metric.documentation))
+        lines.append('# TYPE {} {}'.format(metric.name, metric.type_name))
+        for suffix, labels, value in metric.samples():
+            label_text = ','.join('{}="{}"'.format(name, str(label).replace('\\', '\\\\').replace('"', '\\"'))
+                                  for name, label in sorted(labels.items()))
+            lines.append('{}{}{} {}'.format(metric.name, suffix, '{' + label_text + '}' if label_text else '',
+                                            value if isinstance(value, int) else repr(float(value))))
+    return '\n'.join(lines) + '\n'
+
+
+# Metrics of the server
+STAGE_SECONDS = Histogram('person_detection_stage_seconds',
+                          'Seconds spent on a processing stage per frame or request.', ['stage'])
+FRAMES = Counter('person_detection_frames', 'Frames processed by detection pipelines.')
+UPLOADS = Counter('person_detection_uploads', 'Uploaded files.', ['file_type'])
+JOBS = Counter('person_detection_jobs', 'Finished processing jobs.', ['status'])
+STORAGE_EVICTIONS = Counter('person_detection_storage_evictions', 'Files deleted from storage.', ['reason'])
@@ -0,0 +1,87 @@
+import logging
+from collections import OrderedDict
+from concurrent.futures import Future
+from queue import Queue, Empty
+from threading import Thread
+from time import time
+
+from metrics import Histogram
+
+BATCH_SIZES = Histogram('person_detection_micro_batch_size', 'Items run together by a micro-batcher.',
+                        ['batcher'], buckets=(1, 2, 4, 8, 16, 32, 64))
+BATCH_WAIT_SECONDS = Histogram('person_detection_micro_batch_wait_seconds',
+                               'Seconds an item waited for its micro-batch to start.', ['batcher'])
+
+
+class MicroBatcher:
+    """
+    Class, that joins items submitted by concurrent requests into batches, so a model runs once for all of them.
+    A batch is started when max_batch_size items are waiting or max_wait seconds after its first item arrived.
+    Items of a batch are split by their group (e.g. image resolution), func runs once per group:
+    it takes a list of items and returns a list of their results in the same order.
+    """
+
+    def __init__(self, func, max_batch_size=8, max_wait=0.005, name='micro-batcher'):
+        self.func = func
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.name = name
+        self._items = Queue()
+        self._thread = Thread(target=self.__run, name=name)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def submit(self, item, group=None):
+        """
+        :param item: item passed to func in a list with other items of its group
+        :param group: [hashable] items of different groups are never passed to func together
+        :return: [Future obj] Future of result of the item
+        """
+        future = Future()
+        self._items.put((item, group, future, time()))
+        return future
+
+    def close(self):
+        """Stops the batching thread after already submitted items."""
+        self._items.put(None)
+
+    def __collect(self):
+        first = self._items.get()
+        if first is None:
+            return None
+        batch = [first]
+        deadline = first[3] + self.max_wait
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - time()
+            try:
+                entry = self._items.get(timeout=timeout) if timeout > 0 else self._items.get_nowait()
+            except Empty:
+                break
+            if entry is None:
+                self._items.put(None)
+                break
+            batch.append(entry)
+        return batch
+
+    def __run(self):
+        while True:
+            batch = self.__collect()
+            if batch is None:
+                break
+            started = time()
+            groups = OrderedDict()
+            for entry in batch:
+                groups.setdefault(entry[1], []).append(entry)
+            for entries in groups.values():
+                BATCH_SIZES.observe(len(entries), (self.name,))
+                for _, _, _, submitted in entries:
+                    BATCH_WAIT_SECONDS.observe(started - submitted, (self.name,))
+                try:
+                    results = self.func([item for item, _, _, _ in entries])
+                except Exception as e:
+                    logging.log(logging.ERROR, 'Batch of {} items of {} failed: {}'.format(len(entries), self.name, e))
+                    for _, _, future, _ in entries:
+                        future.set_exception(e)
+                    continue
+                for (_, _, future, _), result in zip(entries, results):
+                    future.set_result(result)
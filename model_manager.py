@@ -1,53 +1,178 @@
-from face_detector import FaceDetector
+from collections import OrderedDict
+from time import time
+
+import numpy as np
+
+from face_detector import FaceDetector, select_faces
+from frame import Frame
+from inference_backends import create_backend
 from person_detector import PersonDetector
 
 
 class ModelManager:
-    """Class, that manages models of use."""
+    """
+    Class, that manages models of use.
+    load_times keeps seconds spent on creation of detectors, building of graph and warm-up.
+    """
 
-    def __init__(self):
-        self.models = {
-            'person_detector': PersonDetector(),
-            'face_detector': FaceDetector(),
+    def __init__(self, face_frame_scale=1.0, person_inference_size=None, face_size=None, person_backend='tensorflow',
+                 person_graph_variant='original', intra_op_threads=0, inter_op_threads=0, face_head_ratio=1.0,
+                 face_min_crop_size=0, models=None):
+        self.load_times = OrderedDict()
+        start = time()
+        self.models = models or {
+            'person_detector': PersonDetector(inference_size=person_inference_size,
+                                              backend=create_backend(person_backend,
+                                                                     intra_op_threads=intra_op_threads,
+                                                                     inter_op_threads=inter_op_threads),
+                                              graph_variant=person_graph_variant),
+            'face_detector': FaceDetector(frame_scale=face_frame_scale, face_size=face_size,
+                                          head_ratio=face_head_ratio, min_crop_size=face_min_crop_size),
         }
+        self.load_times['detectors'] = time() - start
+
+    @property
+    def version(self):
+        """
+        Version of models and their settings, that changes when results of processing may change.
+        :return: [str]
+        """
+        person_detector = self.models.get('person_detector')
+        face_detector = self.models.get('face_detector')
+        return '{}-{}-{}-{}-{}-{}-{}'.format(
+            (getattr(person_detector, 'model_hash', None) or 'unknown')[:16],
+            getattr(getattr(person_detector, 'backend', None), 'name', None),
+            getattr(person_detector, 'inference_size', None),
+            getattr(face_detector, 'face_size', None),
+            getattr(face_detector, 'frame_scale', None),
+            getattr(face_detector, 'head_ratio', None),
+            getattr(face_detector, 'min_crop_size', None),
+        )
 
     def build_graph(self):
         """
         Builds tensorflow graph of pre-trained model.
-        :return: [None]
+        :return: [OrderedDict] load_times updated with loading steps of PersonDetector.build_graph
+        """
+        self.load_times.update(self.models['person_detector'].build_graph())
+        return self.load_times
+
+    def copy_for_thread(self):
         """
-        self.models['person_detector'].build_graph()
+        Manager for another thread, that runs face detection concurrently: dlib detector is not thread safe,
+        so the copy has its own face detector with the same settings and shares the person detector.
+        :return: [ModelManager obj]
+        """
+        return ModelManager(models=dict(self.models, face_detector=self.models['face_detector'].copy()))
+
+    def warm_up(self, frame_size=(640, 480), batch_sizes=(1,)):
+        """
+        Runs both detectors on blank frames, so Tensorflow allocates its memory before the first request.
+        :param frame_size: [tuple] width and height of blank frames
+        :param batch_sizes: [tuple of int] numbers of frames passed to person detector at once
+        :return: [float] seconds spent, also kept in load_times
+        """
+        start = time()
+        width, height = frame_size
+        for batch_size in batch_sizes:
+            frames = [Frame(np.zeros((height, width, 3), dtype=np.uint8)) for _ in range(batch_size)]
+            self.put_person_predictions_into_frames(frames, 1.0)
+        # Face detector gets a person of the whole frame, blank frames have no persons
+        frame = Frame(np.zeros((height, width, 3), dtype=np.uint8))
+        frame.set_person_boxes(np.array([[0, 0, height, width]], dtype=np.int32))
+        frame.set_person_scores(np.ones(1, dtype=np.float32))
+        self.put_face_predictions_into_frame(frame, 1.0)
+        self.load_times['warm_up'] = time() - start
+        return self.load_times['warm_up']
 
-    def put_all_predictions_into_frame(self, frame, threshold_person, threshold_face):
+    def put_all_predictions_into_frame(self, frame, threshold_person, threshold_face, face_mode='person'):
         """
         Creates a pipe, that sets all Frame's fields to detected/predicted values.
         
         :param frame: [Frame obj] Frame of video or image
         :param threshold_person: [float] threshold of person detection algorithm
         :param threshold_face: [float] threshold of face detection algorithm
+        :param face_mode: [str ('person' or 'frame')] search face in every person crop
+                          or once in the whole frame (see put_face_predictions_into_frame)
         :return: [None]
         """
-        img = frame.image
-        face_boxes = []
+        self.put_all_predictions_into_frames([frame], threshold_person, threshold_face, face_mode)
 
-        # start prediction pipe
-        person_boxes, person_labels = self.models['person_detector'].predict_persons(img, threshold_person)
-        frame.set_person_boxes(person_boxes)
-        frame.set_person_labels(person_labels)
+    def put_all_predictions_into_frames(self, frames, threshold_person, threshold_face, face_mode='person'):
+        """
+        Same pipe as put_all_predictions_into_frame, but runs person detection for all frames
+        in one batch. Frames must have the same size.
 
-        for person in frame.crop_picture('person'):
-            face_boxes.append(self.models['face_detector'].detect_face_of_person(person, threshold_face))
-        frame.set_face_boxes(face_boxes)
+        :param frames: [list of Frame obj] Frames of video
+        :param threshold_person: [float] threshold of person detection algorithm
+        :param threshold_face: [float] threshold of face detection algorithm
+        :param face_mode: [str ('person' or 'frame')] face detection strategy
+        :return: [None]
+        """
+        self.put_person_predictions_into_frames(frames, threshold_person)
+        for frame in frames:
+            self.put_face_predictions_into_frame(frame, threshold_face, face_mode)
+
+    def put_person_predictions_into_frames(self, frames, threshold_person, keep_raw=False):
+        """
+        Sets person_boxes and person_scores of Frames, person detection runs for all frames in one batch.
+
+        :param frames: [list of Frame obj] Frames of video of the same size
+        :param threshold_person: [float or list of float] threshold of person detection algorithm,
+                                 or one threshold per Frame (e.g. images of different requests)
+        :param keep_raw: [bool] keep all person candidates in raw_detections of Frames,
+                         so detections can be selected again with another threshold
+        :return: [None]
+        """
+        images = [frame.image for frame in frames]
+        thresholds = threshold_person if isinstance(threshold_person, list) else [threshold_person] * len(frames)
+        threshold = 0.0 if keep_raw else min(thresholds)
+        predictions = self.models['person_detector'].predict_persons_batch(images, threshold)
+        for frame, frame_threshold, (person_boxes, person_scores) in zip(frames, thresholds, predictions):
+            if keep_raw:
+                analysed = person_scores > frame_threshold
+                frame.raw_detections = {
+                    'person_boxes': person_boxes,
+                    'person_scores': person_scores,
+                    'person_analysed': analysed,
+                }
+                person_boxes, person_scores = person_boxes[analysed], person_scores[analysed]
+            elif frame_threshold > threshold:
+                selected = person_scores > frame_threshold
+                person_boxes, person_scores = person_boxes[selected], person_scores[selected]
+            frame.set_person_boxes(person_boxes)
+            frame.set_person_scores(person_scores)
+
+    def put_face_predictions_into_frame(self, frame, threshold_face, face_mode='person'):
+        """
+        Sets faces of Frame, that already has person_boxes set.
+        In 'person' mode face detector runs on every person crop; in 'frame' mode it runs
+        once on the whole frame and faces are assigned to persons, that is cheaper for crowded frames.
+        If Frame keeps raw_detections, all face candidates of persons are kept there too.
+
+        :param frame: [Frame obj] Frame of video or image
+        :param threshold_face: [float] threshold of face detection algorithm
+        :param face_mode: [str ('person' or 'frame')] face detection strategy
+        :return: [None]
+        """
+        face_detector = self.models['face_detector']
+        if face_mode == 'frame':
+            candidates = face_detector.detect_face_candidates_of_persons(frame.image, frame.person_boxes)
+        else:
+            candidates = [face_detector.detect_face_candidates(person) for person in frame.crop_picture('person')]
+        if frame.raw_detections is not None:
+            frame.raw_detections['face_candidates'] = candidates
+        frame.set_faces(*select_faces(candidates, threshold_face))
 
     def get_person_boxes(self, frame, threshold_person):
         """
-        Method only sets person_boxes and person_labels in Frame;
+        Method only sets person_boxes and person_scores in Frame;
         :param frame: 
         :param threshold_person: 
         :return: 
         """
         img = frame.image
 
-        person_boxes, person_labels = self.models['person_detector'].predict_persons(img, threshold_person)
+        person_boxes, person_scores = self.models['person_detector'].predict_persons(img, threshold_person)
         frame.set_person_boxes(person_boxes)
-        frame.set_person_labels(person_labels)
+        frame.set_person_scores(person_scores)
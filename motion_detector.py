@@ -0,0 +1,30 @@
+import cv2
+import numpy as np
+
+
+class MotionDetector:
+    """
+    Class, that decides whether a frame changed enough since the last analysed frame to be analysed again.
+    Frames are compared as downscaled grayscale copies: the changed part is the share of pixels
+    whose brightness differs by more than pixel_threshold.
+    """
+
+    def __init__(self, threshold=0.01, size=(64, 36), pixel_threshold=25):
+        self.threshold = threshold
+        self.size = size
+        self.pixel_threshold = pixel_threshold
+        self.reference = None
+
+    def is_changed(self, image):
+        """
+        Compares image with the last analysed one; if it changed, image becomes the new reference.
+        :param image: [numpy array] BGR frame
+        :return: [bool] True if the frame has to be analysed
+        """
+        small = cv2.cvtColor(cv2.resize(image, self.size, interpolation=cv2.INTER_AREA), cv2.COLOR_BGR2GRAY)
+        if self.reference is not None:
+            changed = np.count_nonzero(cv2.absdiff(small, self.reference) > self.pixel_threshold) / float(small.size)
+            if changed < self.threshold:
+                return False
+        self.reference = small
+        return True
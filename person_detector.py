@@ -1,139 +1,155 @@
 import os
-import sys
+import re
+import hashlib
 import logging
+from collections import OrderedDict
+from time import time
 
+import cv2
 import numpy as np
-import tensorflow as tf
-from utils import label_map_util
 
+from inference_backends import TensorflowBackend
+
+MODEL_NAME = 'model_data'
+# Path to frozen detection graph. This is the actual model that is used for the object detection.
+PATH_TO_CKPT = os.path.join(MODEL_NAME, 'frozen_inference_graph.pb')
+# List of the strings that is used to add correct label for each box.
+PATH_TO_LABELS = os.path.join(MODEL_NAME, 'mscoco_label_map.pbtxt')
+NUM_CLASSES = 90
+
+# Content and SHA-256 of frozen graphs read by preload_graph
+_graphs = {}
+
+
+def preload_graph(path=PATH_TO_CKPT):
+    """
+    Reads a frozen graph into memory once per process, without importing Tensorflow.
+    When called in the master process of a pre-fork server, its workers share the bytes
+    instead of reading the file again.
+    :param path: [str] path to frozen graph
+    :return: [tuple] bytes of the graph and their SHA-256 hex digest
+    """
+    if path not in _graphs:
+        with open(path, 'rb') as graph_file:
+            serialized_graph = graph_file.read()
+        _graphs[path] = (serialized_graph, hashlib.sha256(serialized_graph).hexdigest())
+    return _graphs[path]
 
-class PersonDetector:
-    """Class that contains all about person detection process on Frame."""
 
-    def __init__(self):
+class PersonDetector:
+    """
+    Class that contains all about person detection process on Frame.
+    If inference_size (width, height) is set, frames are resized to it before they are fed to the model;
+    boxes are still returned in coordinates of the original frames.
+    The graph is run by backend (see inference_backends), Tensorflow session by default.
+    graph_variant chooses the frozen graph as shipped ('original') or prepared by graph_optimizer.
+    """
+
+    def __init__(self, inference_size=None, backend=None, graph_variant='original'):
+        self.inference_size = inference_size
+        self.backend = backend or TensorflowBackend()
+        self.graph_variant = graph_variant
         self.category_index = None
         self.det_classes = ['person']
-        self.detection_graph = None
         self.detect = None
+        self.model_hash = None
 
     def build_graph(self):
-        """Builds Tensorflow graph, load model and labels."""
-        # Download the mobile net model and ckpts.
-        sys.path.append(".")
-        MODEL_NAME = 'model_data'
-
-        # Path to frozen detection graph. This is the actual model that is used for the object detection.
-        PATH_TO_CKPT = os.path.join(MODEL_NAME, 'frozen_inference_graph.pb')
-
-        # List of the strings that is used to add correct label for each box.
-        PATH_TO_LABELS = os.path.join(MODEL_NAME, 'mscoco_label_map.pbtxt')
-        NUM_CLASSES = 90
-
-        # Load Tensorflow model into memory
-        self.detection_graph = tf.Graph()
-        with self.detection_graph.as_default():
-            od_graph_def = tf.GraphDef()
-            with tf.gfile.GFile(PATH_TO_CKPT, 'rb') as fid:
-                serialized_graph = fid.read()
-                od_graph_def.ParseFromString(serialized_graph)
-                tf.import_graph_def(od_graph_def, name='')
+        """
+        Loads model into backend and labels.
+        Runtime of backend is imported here, so modules using PersonDetector can be imported without it.
+        :return: [OrderedDict] seconds spent on reading of the graph and loading steps of backend
+                 (import, graph parse, session creation)
+        """
+        load_times = OrderedDict()
+        if self.graph_variant != 'original':
+            from graph_optimizer import get_graph_path
+            start = time()
+            graph_path = get_graph_path(self.graph_variant, PATH_TO_CKPT)
+            load_times['graph_prepare'] = time() - start
+        else:
+            graph_path = PATH_TO_CKPT
+        start = time()
+        serialized_graph, self.model_hash = preload_graph(graph_path)
+        load_times['graph_read'] = time() - start
+
+        load_times.update(self.backend.load(serialized_graph))
 
         # Load lebel_map
         self.__load_label(PATH_TO_LABELS, NUM_CLASSES, use_disp_name=True)
         # Cut label map
         self.detect = self.__classes_to_detect()
-        # print(self.category_index)
-
-        with self.detection_graph.as_default():
-            with tf.Session(graph=self.detection_graph) as self.sess:
-                # Definite input and output Tensors for detection_graph
-                self.image_tensor = self.detection_graph.get_tensor_by_name('image_tensor:0')
-                # Each box represents a part of the image where a particular object was detected.
-                self.detection_boxes = self.detection_graph.get_tensor_by_name('detection_boxes:0')
-                # Each score represent how level of confidence for each of the objects.
-                # Score is shown on the result image, together with the class label.
-                self.detection_scores = self.detection_graph.get_tensor_by_name('detection_scores:0')
-                self.detection_classes = self.detection_graph.get_tensor_by_name('detection_classes:0')
-                self.num_detections = self.detection_graph.get_tensor_by_name('num_detections:0')
+        return load_times
 
     def predict_persons(self, frame, threshold):
         """
             Predicts person in frame with threshold level of confidence
-            Returns list with top-left, bottom-right coordinates and list with labels, confidence in %
+            Returns array of boxes [N, 4] (top, left, bottom, right in pixels, int32)
+            and array of their confidences [N] (float32)
         """
-        logging.log(logging.INFO, "Starting predictions.")
+        return self.predict_persons_batch([frame], threshold)[0]
 
-        # Expand dimensions since the model expects images to have shape: [1, None, None, 3]
-        image_np_expanded = np.expand_dims(frame, axis=0)
-        # Actual detection.
-        (boxes, scores, classes, num) = self.sess.run(
-                [self.detection_boxes, self.detection_scores, self.detection_classes, self.num_detections],
-                feed_dict={self.image_tensor: image_np_expanded})
+    def predict_persons_batch(self, frames, threshold):
+        """
+            Predicts persons in several frames with a single session run. Frames must have the same size
+            unless inference_size is set.
+            Returns list of (boxes, scores) tuples, one per frame, in the same format as predict_persons.
+        """
+        logging.log(logging.DEBUG, 'Starting predictions for %d frame(s).', len(frames))
 
-        # Select classes to detect
-        scores, classes = self.__det_selection(classes, scores)
+        image_sizes = np.array([frame.shape[:2] for frame in frames], dtype=np.float32)
+        if self.inference_size is not None:
+            frames = [cv2.resize(frame, self.inference_size, interpolation=cv2.INTER_AREA) for frame in frames]
+        # Stack frames since the model expects images to have shape: [N, None, None, 3]
+        images_np = np.stack(frames, axis=0)
+        # Actual detection.
+        boxes, scores, classes = self.backend.run(images_np)
 
-        # Find detected boxes coordinates
+        # Find detected boxes coordinates of classes to detect
         return self.__boxes_coordinates(
-            frame,
-            np.squeeze(boxes),
-            np.squeeze(classes).astype(np.int32),
-            np.squeeze(scores),
+            image_sizes,
+            boxes,
+            classes.astype(np.int32),
+            scores,
             min_score_thresh=threshold,
         )
 
     def __boxes_coordinates(self,
-                            image,
+                            image_sizes,
                             boxes,
                             classes,
                             scores,
                             max_boxes_to_draw=20,
                             min_score_thresh=.5):
         """
-          This function groups boxes that correspond to the same location
-          and creates a display string for each detection and overlays these
-          on the image.
+          This function selects boxes of classes to detect with score above threshold
+          and scales them from normalized to pixel coordinates of the original images.
 
           Args:
-            image: uint8 numpy array with shape (img_height, img_width, 3)
-            boxes: a numpy array of shape [N, 4]
-            classes: a numpy array of shape [N]
-            scores: a numpy array of shape [N] or None.  If scores=None, then
-              this function assumes that the boxes to be plotted are groundtruth
-              boxes and plot all boxes as black with no classes or scores.
-            category_index: a dict containing category dictionaries (each holding
-              category index `id` and category name `name`) keyed by category indices.
-            use_normalized_coordinates: whether boxes is to be interpreted as
-              normalized coordinates or not.
-            max_boxes_to_draw: maximum number of boxes to visualize.  If None, draw
+            image_sizes: a numpy array of shape [batch, 2] of (img_height, img_width)
+            boxes: a numpy array of shape [batch, N, 4] (ymin, xmin, ymax, xmax normalized)
+            classes: a numpy array of shape [batch, N]
+            scores: a numpy array of shape [batch, N]
+            max_boxes_to_draw: maximum number of boxes to take from each image.  If None, take
               all boxes.
-            min_score_thresh: minimum score threshold for a box to be visualized
+            min_score_thresh: minimum score threshold for a box to be selected
+
+          Returns:
+            list of (boxes, scores) per image: int32 array [M, 4] of (top, left, bottom, right)
+            and float32 array [M] of scores
         """
+        if max_boxes_to_draw:
+            boxes = boxes[:, :max_boxes_to_draw]
+            classes = classes[:, :max_boxes_to_draw]
+            scores = scores[:, :max_boxes_to_draw]
+
+        mask = np.isin(classes, self.detect) & (scores > min_score_thresh)
+
+        size = np.concatenate([image_sizes, image_sizes], axis=1)[:, None, :]
+        pixel_boxes = np.clip(boxes * size, 0, size).astype(np.int32)
+        scores = scores.astype(np.float32)
 
-        if not max_boxes_to_draw:
-            max_boxes_to_draw = boxes.shape[0]
-        number_boxes = min(max_boxes_to_draw, boxes.shape[0])
-        person_boxes = []
-        person_labels = []
-        for i in range(number_boxes):
-            if scores is None or scores[i] > min_score_thresh:
-                box = tuple(boxes[i].tolist())
-                ymin, xmin, ymax, xmax = box
-
-                im_height, im_width, _ = image.shape
-                left, right, top, bottom = [int(z) for z in (xmin * im_width, xmax * im_width,
-                                                             ymin * im_height, ymax * im_height)]
-
-                if classes[i] in self.category_index.keys():
-                    class_name = self.category_index[classes[i]]['name']
-                else:
-                    class_name = 'N/A'
-                display_str = '{}: {}% '.format(class_name,
-                                                int(100 * scores[i]))
-                # print([(top, left),(bottom, right),display_str])
-                person_boxes.append([(top, left),(bottom, right),display_str])
-                person_labels.append(display_str)
-        return person_boxes, person_labels
+        return [(pixel_boxes[i][mask[i]], scores[i][mask[i]]) for i in range(mask.shape[0])]
 
     def __classes_to_detect(self):
         """
@@ -147,23 +163,20 @@ class PersonDetector:
                     category_index_p[i] = en_value
             except:
                 continue
-        return np.array(list(category_index_p.keys()))
+        return np.array(list(category_index_p.keys()), dtype=np.int32)
 
     def __load_label(self, path, num_c, use_disp_name=True):
         """
-            Loads labels
+            Loads labels. Label map is parsed here instead of object detection API utils,
+            that import Tensorflow, so backends without Tensorflow do not need it.
         """
-        label_map = label_map_util.load_labelmap(path)
-        categories = label_map_util.convert_label_map_to_categories(label_map, max_num_classes=num_c,
-                                                                    use_display_name=use_disp_name)
-        self.category_index = label_map_util.create_category_index(categories)
-
-    def __det_selection(self, classes, scores):
-        """
-            Function that find detection classes at processed matrix
-        """
-        null_values = np.where(np.in1d(classes, self.detect) == False)
-        classes[:, null_values] = 0
-        scores[:, null_values] = 0
-
-        return scores, classes
\ No newline at end of file
+        with open(path) as label_file:
+            label_map = label_file.read()
+        self.category_index = {}
+        for item in re.findall(r'item\s*{(.*?)}', label_map, re.S):
+            fields = dict(re.findall(r'(\w+)\s*:\s*"?([^"\n]*)"?', item))
+            category_id = int(fields['id'])
+            if category_id > num_c:
+                continue
+            name = fields['display_name'] if use_disp_name and 'display_name' in fields else fields['name']
+            self.category_index[category_id] = {'id': category_id, 'name': name}
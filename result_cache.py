@@ -0,0 +1,116 @@
+import hashlib
+import json
+import logging
+import os
+from collections import OrderedDict
+from threading import Lock
+
+
+def hash_upload(file_to_process, output_path, chunk_size=1 << 20):
+    """
+    Saves uploaded file chunk by chunk and hashes its content on the way.
+    :param file_to_process: [FileStorage obj] uploaded file
+    :param output_path: [str] path to save the file to
+    :param chunk_size: [int] number of bytes read at once
+    :return: [str] SHA-256 hex digest of the file content
+    """
+    digest = hashlib.sha256()
+    with open(output_path, 'wb') as output:
+        while True:
+            chunk = file_to_process.stream.read(chunk_size)
+            if not chunk:
+                break
+            digest.update(chunk)
+            output.write(chunk)
+    return digest.hexdigest()
+
+
+class ResultCache:
+    """
+    Class, that maps uploads to already processed files.
+    Key of a result is made of content hash of the upload, file type, processing parameters and model version
+    (make_key). Total size of cached files is bounded by max_bytes: the least recently used files are deleted,
+    by on_evict if it is given (e.g. StorageManager.discard, which keeps files in use).
+    """
+
+    def __init__(self, max_bytes=1 << 30, on_evict=None):
+        self.max_bytes = max_bytes
+        self.on_evict = on_evict
+        self.entries = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = Lock()
+
+    @staticmethod
+    def make_key(content_hash, file_type, options, model_version):
+        """
+        :param content_hash: [str] hash of the uploaded file content
+        :param file_type: [str] 'video' or 'image'
+        :param options: [dict] processing parameters (thresholds, modes)
+        :param model_version: [str] version of models, see ModelManager.version
+        :return: [str] cache key
+        """
+        description = json.dumps([content_hash, file_type, options, model_version], sort_keys=True)
+        return hashlib.sha256(description.encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        """
+        :param key: [str] cache key
+        :return: [str or None] path to processed file, None if it is not cached
+        """
+        with self._lock:
+            entry = self.entries.get(key)
+            if entry is not None and not os.path.exists(entry[0]):
+                # The file was deleted from storage by somebody else
+                self.__remove(key)
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, path):
+        """
+        Adds processed file to the cache and evicts the least recently used files above the size limit.
+        :param key: [str] cache key
+        :param path: [str] path to processed file
+        :return: [None]
+        """
+        file_size = os.path.getsize(path)
+        with self._lock:
+            if key in self.entries:
+                self.__remove(key)
+            self.entries[key] = (path, file_size)
+            self.size += file_size
+            while self.size > self.max_bytes and len(self.entries) > 1:
+                evicted_key = next(iter(self.entries))
+                evicted_path = self.entries[evicted_key][0]
+                self.__remove(evicted_key)
+                self.evictions += 1
+                logging.log(logging.INFO, 'Evicting {} from result cache.'.format(evicted_path))
+                if self.on_evict is not None:
+                    self.on_evict(evicted_path)
+                elif os.path.exists(evicted_path):
+                    os.remove(evicted_path)
+
+    def stats(self):
+        """
+        :return: [dict] number of entries, their size in bytes, hits, misses and evictions
+        """
+        with self._lock:
+            return {
+                'entries': len(self.entries),
+                'bytes': self.size,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+            }
+
+    def __remove(self, key):
+        _, file_size = self.entries.pop(key)
+        self.size -= file_size
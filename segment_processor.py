@@ -0,0 +1,264 @@
+"""
+Processing of a long video in independent time segments, each in its own worker process with its own
+VideoCapture, ModelManager and VideoWriter, so one video uses all cores. Segment boundaries are moved to
+keyframes when ffprobe can list them, so seeking to a segment does not decode frames of the previous one.
+Processed segments are joined into the output file in frame order.
+"""
+import itertools
+import logging
+import multiprocessing
+import os
+import shutil
+import subprocess
+import tempfile
+from queue import Empty
+from time import time
+
+import cv2
+
+from detection_store import DetectionRecorder
+from metrics import FRAMES
+from video_pipeline import VideoPipeline, PipelineStage, read_frames
+from worker_pool import create_model_manager
+
+# Segments shorter than this are not worth loading models of one more worker
+MIN_SEGMENT_FRAMES = 500
+
+
+def available_cpus():
+    """
+    :return: [int] number of CPUs the process may run on
+    """
+    if hasattr(os, 'sched_getaffinity'):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+def find_keyframes(input_file):
+    """
+    Numbers of keyframes of a video, read from packet flags without decoding.
+    :param input_file: [str] path to a video file
+    :return: [list of int] keyframe numbers, empty if ffprobe is not installed or fails
+    """
+    if shutil.which('ffprobe') is None:
+        return []
+    try:
+        output = subprocess.check_output(
+            ['ffprobe', '-v', 'error', '-select_streams', 'v:0', '-show_entries', 'packet=flags',
+             '-of', 'csv=p=0', input_file], timeout=120)
+    except (subprocess.SubprocessError, OSError) as e:
+        logging.log(logging.WARNING, 'Keyframes of {} are not found: {}'.format(input_file, e))
+        return []
+    return [i for i, flags in enumerate(output.decode('ascii', 'ignore').split()) if 'K' in flags]
+
+
+def split_segments(frames_total, segments, keyframes=()):
+    """
+    Splits frames of a video into segments of about the same length.
+    :param frames_total: [int] number of frames in a video, 0 or less if it is not known
+    :param segments: [int] number of segments
+    :param keyframes: [list of int] sorted keyframe numbers, boundaries are moved to the nearest of them
+    :return: [list of tuple] first and next after the last frame number of every segment, empty if there are no frames
+    """
+    if frames_total <= 0:
+        return []
+    boundaries = {0, frames_total}
+    for i in range(1, segments):
+        boundary = frames_total * i // segments
+        if keyframes:
+            boundary = min(keyframes, key=lambda keyframe: abs(keyframe - boundary))
+        if 0 < boundary < frames_total:
+            boundaries.add(boundary)
+    boundaries = sorted(boundaries)
+    return list(zip(boundaries[:-1], boundaries[1:]))
+
+
+def concatenate_videos(segment_files, output_file, frame_rate, frame_size):
+    """
+    Joins processed segments into one video. Streams are copied by ffmpeg if it is installed,
+    otherwise frames are read and written again with OpenCV.
+    :param segment_files: [list of str] paths to segments in frame order
+    :param output_file: [str] path to joined video
+    :param frame_rate: [int] frame rate of segments
+    :param frame_size: [tuple] width and height of segments
+    :return: [None]
+    """
+    if shutil.which('ffmpeg') is not None:
+        list_file = '{}.txt'.format(output_file)
+        with open(list_file, 'w') as segment_list:
+            segment_list.writelines("file '{}'\n".format(path) for path in segment_files)
+        try:
+            subprocess.check_call(['ffmpeg', '-v', 'error', '-y', '-f', 'concat', '-safe', '0', '-i', list_file,
+                                   '-c', 'copy', '-f', 'mp4', output_file])
+            return
+        except (subprocess.SubprocessError, OSError) as e:
+            logging.log(logging.WARNING, 'Joining segments with ffmpeg failed, using OpenCV: {}'.format(e))
+        finally:
+            os.remove(list_file)
+
+    writer = cv2.VideoWriter(output_file, cv2.VideoWriter_fourcc(*'MP4V'), frame_rate, frame_size)
+    try:
+        for segment_file in segment_files:
+            cap = cv2.VideoCapture(segment_file)
+            for frame in read_frames(cap):
+                writer.write(frame.image)
+            cap.release()
+    finally:
+        writer.release()
+
+
+def _process_segment(segment_index, start, end, input_file, segment_file, frame_rate, frame_size, options,
+                     manager_factory, model_options, progress, results):
+    """
+    Main function of a segment worker process: detects and draws persons of frames from start to end.
+    The last segment has end None and is read until the end of the video, the number of frames reported
+    by a container may be only an estimate.
+    """
+    try:
+        model_manager = manager_factory(**model_options)
+        cap = cv2.VideoCapture(input_file)
+        cap.set(cv2.CAP_PROP_POS_FRAMES, start)
+        writer = cv2.VideoWriter(segment_file, cv2.VideoWriter_fourcc(*'MP4V'), frame_rate, frame_size)
+        recorder = DetectionRecorder(options['threshold_person']) if options['record_detections'] else None
+
+        def detect_persons(frames):
+            model_manager.put_person_predictions_into_frames(frames, options['threshold_person'],
+                                                             keep_raw=recorder is not None)
+            return frames
+
+        def detect_faces(current_frame):
+            model_manager.put_face_predictions_into_frame(current_frame, options['threshold_face'],
+                                                          options['face_mode'])
+            return current_frame
+
+        def draw(current_frame):
+            if recorder is not None:
+                recorder.add(current_frame)
+            current_frame.draw_all_labeled_bounding_boxes()
+            return current_frame
+
+        def encode(current_frame):
+            writer.write(current_frame.image)
+            progress[segment_index] += 1
+
+        frames = read_frames(cap) if end is None else itertools.islice(read_frames(cap), end - start)
+        pipeline = VideoPipeline(frames, [
+            PipelineStage('person_inference', detect_persons, batch_size=options['batch_size']),
+            PipelineStage('face_detection', detect_faces),
+            PipelineStage('draw', draw),
+            PipelineStage('encode', encode),
+        ], queue_size=options['queue_size'])
+        try:
+            stats = pipeline.run()
+        finally:
+            writer.release()
+            cap.release()
+        results.put((segment_index, stats, recorder, None))
+    except Exception as e:
+        results.put((segment_index, None, None, '{}: {}'.format(type(e).__name__, e)))
+
+
+def process_video_segments(input_file, output_file, threshold_person, threshold_face, batch_size=1,
+                           face_mode='person', detections_dir=None, progress_callback=None, segments=0,
+                           model_options=None, manager_factory=create_model_manager, queue_size=16, fallback=None):
+    """
+    Detects persons and faces of a video in parallel segments and writes the processed video.
+    :param input_file: [str] path to a video file
+    :param output_file: [str] path to save processed video file
+    :param threshold_person: [float] threshold of person detection algorithm
+    :param threshold_face: [float] threshold of face detection algorithm
+    :param batch_size: [int] number of frames passed to person detection at once
+    :param face_mode: [str ('person' or 'frame')] face detection strategy
+    :param detections_dir: [str or None] directory to record raw detections to (see DetectionRecorder)
+    :param progress_callback: [callable or None] called with numbers of processed frames of all segments
+                              and total frames
+    :param segments: [int] maximum number of segments (0 - number of available CPUs)
+    :param model_options: [dict] keyword arguments of ModelManager of every worker
+    :param manager_factory: [callable] creates ModelManager of a worker from model_options
+    :param queue_size: [int] maximum number of frames between stages of a segment pipeline
+    :param fallback: [callable or None] processes the video in this process instead, called without arguments
+                     when the video has less than two segments or its number of frames is not known
+    :return: [dict] elapsed time, FPS, segment boundaries and pipeline statistics of every segment,
+             or result of fallback
+    """
+    start_time = time()
+    cap = cv2.VideoCapture(input_file)
+    frame_size = (int(cap.get(cv2.CAP_PROP_FRAME_WIDTH)), int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT)))
+    frame_rate = int(cap.get(cv2.CAP_PROP_FPS))
+    frames_total = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+    cap.release()
+
+    cpus = available_cpus()
+    segments = max(1, min(segments or cpus, frames_total // MIN_SEGMENT_FRAMES))
+    bounds = split_segments(frames_total, segments, find_keyframes(input_file) if segments > 1 else ())
+    if len(bounds) <= 1 and fallback is not None:
+        # A worker process would only add loading of its models
+        logging.log(logging.INFO, 'Processing {} of {} frames without segments.'.format(input_file, frames_total))
+        return fallback()
+    if not bounds:
+        raise ValueError('Number of frames of {} is not known.'.format(input_file))
+    # CPUs are shared between workers, so their Tensorflow sessions do not compete for all of them
+    model_options = dict(model_options or {}, intra_op_threads=max(1, cpus // len(bounds)))
+    logging.log(logging.INFO, 'Processing {} in {} segments: {}'.format(input_file, len(bounds), bounds))
+
+    context = multiprocessing.get_context('spawn')
+    progress = context.RawArray('q', len(bounds))
+    results = context.Queue()
+    segment_dir = tempfile.mkdtemp(prefix='segments_', dir=os.path.dirname(os.path.abspath(output_file)))
+    segment_files = [os.path.join(segment_dir, '{:04d}.mp4'.format(i)) for i in range(len(bounds))]
+    options = dict(threshold_person=threshold_person, threshold_face=threshold_face, face_mode=face_mode,
+                   batch_size=batch_size, queue_size=queue_size, record_detections=detections_dir is not None)
+    processes = []
+    try:
+        for i, (start, end) in enumerate(bounds):
+            # The last segment is read to the end, frames after the reported count are not lost
+            process = context.Process(
+                target=_process_segment, name='segment-worker-{}'.format(i),
+                args=(i, start, end if i < len(bounds) - 1 else None, input_file, segment_files[i], frame_rate,
+                      frame_size, options, manager_factory, model_options, progress, results))
+            process.daemon = True
+            process.start()
+            processes.append(process)
+
+        segment_stats = [None] * len(bounds)
+        recorders = [None] * len(bounds)
+        finished = 0
+        while finished < len(bounds):
+            try:
+                segment_index, stats, recorder, error = results.get(timeout=0.5)
+            except Empty:
+                if any(not process.is_alive() and process.exitcode for process in processes):
+                    raise RuntimeError('Segment worker of {} died.'.format(input_file))
+            else:
+                if error is not None:
+                    raise RuntimeError('Segment {} of {} failed: {}'.format(segment_index, input_file, error))
+                segment_stats[segment_index] = stats
+                recorders[segment_index] = recorder
+                finished += 1
+            if progress_callback is not None:
+                progress_callback(sum(progress), frames_total)
+
+        concatenate_videos(segment_files, output_file, frame_rate, frame_size)
+    finally:
+        for process in processes:
+            if process.is_alive():
+                process.terminate()
+            process.join()
+        shutil.rmtree(segment_dir, ignore_errors=True)
+
+    if detections_dir is not None:
+        recorder = recorders[0]
+        for other in recorders[1:]:
+            recorder.extend(other)
+        recorder.save(detections_dir)
+    frames_done = sum(progress)
+    FRAMES.inc(frames_done)
+    elapsed = time() - start_time
+    logging.log(logging.INFO, '{0:3.3f} FPS, {1} frames processed in {2} segments in {3:.3f} s'.format(
+        frames_done / elapsed if elapsed else 0.0, frames_done, len(bounds), elapsed))
+    return {
+        'elapsed': elapsed,
+        'fps': frames_done / elapsed if elapsed else 0.0,
+        'segments': [list(bound) for bound in bounds],
+        'segment_stats': segment_stats,
+    }
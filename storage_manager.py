@@ -0,0 +1,239 @@
+import heapq
+import logging
+import os
+import shutil
+from collections import OrderedDict
+from contextlib import contextmanager
+from threading import Thread, Lock, Event
+from time import time
+
+from metrics import STORAGE_EVICTIONS
+
+
+def _size_of(path):
+    if os.path.isdir(path):
+        return sum(os.path.getsize(os.path.join(root, name)) for root, _, names in os.walk(path) for name in names)
+    return os.path.getsize(path)
+
+
+class StorageManager:
+    """
+    Class, that keeps an index of stored files and deletes them by time to live and by total size.
+    Items of the index are children of directories in root (input_files/..., output_files/..., detections/...):
+    a file or a directory deleted as a whole. The index is built by scan once and then updated by add,
+    touch and forget, so the disk is not walked again.
+    An item expires live_time seconds after its last access; expiry times are kept in a heap, so the thread
+    of start wakes up only when the next item expires. When total size exceeds max_bytes, the least recently
+    accessed items are deleted. Pinned items (files of queued and running jobs) are never deleted.
+    """
+
+    def __init__(self, root, live_time=60 * 30, max_bytes=10 << 30, check_interval=60):
+        self.root = root
+        self.live_time = live_time
+        self.max_bytes = max_bytes
+        self.check_interval = check_interval
+        # path -> [size, created, last accessed], in order of access
+        self.entries = OrderedDict()
+        self.size = 0
+        self.evictions = 0
+        self.evicted_bytes = 0
+        self._expiry = []
+        self._pins = {}
+        self._lock = Lock()
+        self._wake_up = Event()
+        self._thread = None
+
+    def start(self):
+        """
+        Builds the index from files in root and starts a daemon thread deleting expired items.
+        :return: [StorageManager obj] self
+        """
+        self.scan()
+        logging.log(logging.INFO, 'Starting storage monitoring: {} items, {} bytes.'.format(
+            len(self.entries), self.size))
+        self._thread = Thread(target=self.__expire_loop, name='storage-manager')
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def scan(self):
+        """Adds every item in root to the index, with modification time as time of creation and access."""
+        if not os.path.exists(self.root):
+            return
+        for category in os.listdir(self.root):
+            category_path = os.path.join(self.root, category)
+            paths = [os.path.join(category_path, name) for name in os.listdir(category_path)] \
+                if os.path.isdir(category_path) else [category_path]
+            for path in paths:
+                modified = os.path.getmtime(path)
+                self.add(path, created=modified, evict=False)
+        self.evict()
+
+    def add(self, path, created=None, evict=True):
+        """
+        Adds a stored file or directory to the index; deletes other items if storage is over its size limit.
+        :param path: [str] path to file or directory in root
+        :param created: [float or None] time of creation, now if not given
+        :param evict: [bool] delete items above size limit at once
+        :return: [None]
+        """
+        path = os.path.abspath(path)
+        if not os.path.exists(path):
+            return
+        size = _size_of(path)
+        created = time() if created is None else created
+        with self._lock:
+            # A path added again keeps its heap item, which is pushed again with the new time when it is popped
+            if self.__remove(path) is None:
+                heapq.heappush(self._expiry, (created + self.live_time, path))
+            self.entries[path] = [size, created, created]
+            self.size += size
+        if evict:
+            self.evict()
+        self._wake_up.set()
+
+    def touch(self, path):
+        """
+        Marks an item as accessed: it expires later and is deleted later when storage is full.
+        :param path: [str] path to file or directory in root
+        :return: [None]
+        """
+        with self._lock:
+            entry = self.entries.get(os.path.abspath(path))
+            if entry is not None:
+                entry[2] = time()
+                self.entries.move_to_end(os.path.abspath(path))
+
+    def forget(self, path):
+        """
+        Removes an item deleted by somebody else from the index.
+        :param path: [str] path to file or directory in root
+        :return: [None]
+        """
+        with self._lock:
+            self.__remove(os.path.abspath(path))
+
+    def discard(self, path):
+        """
+        Deletes an item at once, unless it is pinned: then it is left to expire.
+        :param path: [str] path to file or directory in root
+        :return: [None]
+        """
+        path = os.path.abspath(path)
+        with self._lock:
+            if path in self._pins:
+                return
+            entry = self.__remove(path)
+        self.__delete(path, entry[0] if entry is not None else 0, 'discarded')
+
+    def pin(self, paths):
+        """
+        Protects items from deletion until they are unpinned as many times as they were pinned.
+        :param paths: [list of str] paths to files or directories
+        :return: [None]
+        """
+        with self._lock:
+            for path in paths:
+                path = os.path.abspath(path)
+                self._pins[path] = self._pins.get(path, 0) + 1
+
+    def unpin(self, paths):
+        """
+        :param paths: [list of str] paths to files or directories pinned before
+        :return: [None]
+        """
+        with self._lock:
+            for path in paths:
+                path = os.path.abspath(path)
+                count = self._pins.pop(path, 0) - 1
+                if count > 0:
+                    self._pins[path] = count
+        self.evict()
+
+    @contextmanager
+    def pinned(self, paths):
+        """Context manager, that keeps items pinned in its block."""
+        self.pin(paths)
+        try:
+            yield
+        finally:
+            self.unpin(paths)
+
+    def evict(self, now=None):
+        """
+        Deletes expired items, then the least recently accessed items while storage is over its size limit.
+        :param now: [float or None] current time
+        :return: [int] number of deleted items
+        """
+        now = time() if now is None else now
+        to_delete = []
+        with self._lock:
+            while self._expiry and self._expiry[0][0] <= now:
+                _, path = heapq.heappop(self._expiry)
+                entry = self.entries.get(path)
+                if entry is None:
+                    continue
+                expires = entry[2] + self.live_time
+                if expires > now or path in self._pins:
+                    # Accessed since it was pushed or still in use, checked again later
+                    heapq.heappush(self._expiry, (max(expires, now + self.check_interval), path))
+                    continue
+                to_delete.append((path, self.__remove(path)[0], 'expired'))
+
+            if self.size > self.max_bytes:
+                for path in list(self.entries):
+                    if self.size <= self.max_bytes:
+                        break
+                    if path not in self._pins:
+                        to_delete.append((path, self.__remove(path)[0], 'quota'))
+
+        for path, size, reason in to_delete:
+            self.__delete(path, size, reason)
+        return len(to_delete)
+
+    def stats(self):
+        """
+        :return: [dict] number of items, their size in bytes, size limit, pinned items and deleted items and bytes
+        """
+        with self._lock:
+            return {
+                'entries': len(self.entries),
+                'bytes': self.size,
+                'max_bytes': self.max_bytes,
+                'pinned': len(self._pins),
+                'evictions': self.evictions,
+                'evicted_bytes': self.evicted_bytes,
+            }
+
+    def __remove(self, path):
+        entry = self.entries.pop(path, None)
+        if entry is not None:
+            self.size -= entry[0]
+        return entry
+
+    def __delete(self, path, size, reason):
+        if not os.path.exists(path):
+            return
+        try:
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+            else:
+                os.remove(path)
+        except OSError as e:
+            logging.log(logging.ERROR, 'Deleting {} failed: {}'.format(path, e))
+            return
+        with self._lock:
+            self.evictions += 1
+            self.evicted_bytes += size
+        STORAGE_EVICTIONS.inc(labels=(reason,))
+        logging.log(logging.INFO, 'Deleted {} {} ({} bytes) from storage.'.format(reason, path, size))
+
+    def __expire_loop(self):
+        while True:
+            with self._lock:
+                next_expiry = self._expiry[0][0] if self._expiry else None
+            timeout = self.check_interval if next_expiry is None else min(
+                max(next_expiry - time(), 0), self.check_interval)
+            self._wake_up.wait(timeout)
+            self._wake_up.clear()
+            self.evict()
@@ -0,0 +1,304 @@
+"""
+Real-time processing of a live video source: a camera device or a stream URL opened by cv2.VideoCapture.
+A reader thread grabs frames as fast as the source gives them, so frames do not pile up in buffers of the source,
+and keeps only the newest ones (see FrameBuffer). An analysis thread detects persons and faces of the newest frame,
+draws them and encodes the frame to JPEG for MJPEG clients. Frames replaced by newer ones before analysis, or that
+would be shown later than the latency budget, are dropped; face detection is skipped while it would make a frame
+late. Every client gets the newest encoded frame, so a slow client does not delay the others.
+"""
+import logging
+import os
+from collections import deque
+from threading import Thread, Condition, Event
+from time import time, sleep
+
+import cv2
+import numpy as np
+
+from frame import Frame
+from metrics import Counter, Histogram
+
+STREAM_FRAMES = Counter('person_detection_stream_frames', 'Frames of live streams.', ['stream', 'result'])
+STREAM_LATENCY_SECONDS = Histogram('person_detection_stream_latency_seconds',
+                                   'Seconds from capture of a stream frame until it is encoded.', ['stream'])
+
+DROP_POLICIES = ('latest', 'queue')
+# Weight of the last measurement in moving averages of analysis times
+_SMOOTHING = 0.2
+# Number of the last frames latency percentiles are computed from
+_LATENCY_WINDOW = 1000
+
+
+def open_source(source):
+    """
+    :param source: [str] camera device number (e.g. '0'), stream URL or path to a video file
+    :return: [cv2.VideoCapture obj] opened capture
+    """
+    cap = cv2.VideoCapture(int(source) if source.isdigit() else source)
+    if not cap.isOpened():
+        raise IOError('Stream source {} can not be opened.'.format(source))
+    return cap
+
+
+class FrameBuffer:
+    """
+    Class, that passes captured frames with their capture times from the reader to the analysis thread.
+    With 'latest' policy only the newest frame is kept, a frame that was not taken before the next one arrived
+    is dropped; with 'queue' policy up to size frames wait in order and the oldest one is dropped when it is full.
+    """
+
+    def __init__(self, policy='latest', size=1):
+        if policy not in DROP_POLICIES:
+            raise ValueError('Unknown drop policy {}, expected one of {}.'.format(policy, ', '.join(DROP_POLICIES)))
+        self.size = 1 if policy == 'latest' else max(size, 1)
+        self.dropped = 0
+        self.closed = False
+        self._frames = deque()
+        self._condition = Condition()
+
+    def put(self, image, captured):
+        """
+        :param image: [numpy array] BGR image
+        :param captured: [float] time the image was captured
+        :return: [bool] True if an older frame was dropped
+        """
+        with self._condition:
+            is_dropped = len(self._frames) >= self.size
+            if is_dropped:
+                self._frames.popleft()
+                self.dropped += 1
+            self._frames.append((image, captured))
+            self._condition.notify()
+        return is_dropped
+
+    def get(self, timeout=None):
+        """
+        :param timeout: [float or None] seconds to wait for a frame
+        :return: [tuple or None] the oldest kept image and its capture time, None if there is no frame
+        """
+        with self._condition:
+            if not self._frames and not self.closed:
+                self._condition.wait(timeout)
+            if not self._frames:
+                return None
+            return self._frames.popleft()
+
+    def waiting(self):
+        """
+        :return: [int] number of kept frames
+        """
+        return len(self._frames)
+
+    def close(self):
+        """Wakes up the analysis thread after the last frame of the source."""
+        with self._condition:
+            self.closed = True
+            self._condition.notify_all()
+
+
+class StreamProcessor:
+    """
+    Class, that detects persons of a live source in real time and serves annotated frames as MJPEG.
+    detect_persons takes a Frame and sets its persons (and faces, if detect_faces is None);
+    detect_faces takes a Frame with persons and sets its faces. Latency of a frame is the time from its capture
+    until its JPEG is ready. Video files are read at their frame rate (realtime), so they can stand in for cameras.
+    Method start runs reader and analysis threads, stop ends them; frames and mjpeg give encoded frames to clients.
+    """
+
+    def __init__(self, source, detect_persons, detect_faces=None, latency_budget=0.5, drop_policy='latest',
+                 buffer_size=1, jpeg_quality=80, realtime=None, name='stream'):
+        self.source = source
+        self.detect_persons = detect_persons
+        self.detect_faces = detect_faces
+        self.latency_budget = latency_budget
+        self.jpeg_quality = jpeg_quality
+        self.realtime = os.path.isfile(source) if realtime is None else realtime
+        self.name = name
+        self.clients = 0
+        self.buffer = FrameBuffer(drop_policy, buffer_size)
+        self.drop_policy = drop_policy
+        self.error = None
+        self.started = None
+        self.finished = None
+        self.captured = 0
+        self.analysed = 0
+        self.dropped_stale = 0
+        self.faces_skipped = 0
+        self.over_budget = 0
+        self.latencies = deque(maxlen=_LATENCY_WINDOW)
+        self._person_time = 0.0
+        self._face_time = 0.0
+        self._jpeg = None
+        self._sequence = 0
+        self._output = Condition()
+        self._stop = Event()
+        self._cap = None
+        self._threads = []
+
+    def start(self):
+        """
+        Opens the source and starts reader and analysis threads.
+        :return: [StreamProcessor obj] self
+        """
+        self._cap = open_source(self.source)
+        self.started = time()
+        self._threads = [Thread(target=self.__read, name='{}-reader'.format(self.name)),
+                         Thread(target=self.__analyse, name='{}-analysis'.format(self.name))]
+        for thread in self._threads:
+            thread.daemon = True
+            thread.start()
+        logging.log(logging.INFO, 'Stream {} from {} started with {} drop policy and {:.3f} s latency budget.'.format(
+            self.name, self.source, self.drop_policy, self.latency_budget))
+        return self
+
+    def stop(self, timeout=5.0):
+        """
+        Stops reading the source and waits for the threads.
+        :param timeout: [float] seconds to wait for every thread, reading of a network source may hang
+        :return: [None]
+        """
+        self._stop.set()
+        self.buffer.close()
+        for thread in self._threads:
+            thread.join(timeout)
+
+    def is_running(self):
+        """
+        :return: [bool] True until the source ends or the stream is stopped
+        """
+        return self.finished is None
+
+    def frames(self, timeout=1.0):
+        """
+        Gives every new encoded frame; frames encoded while a client was sending the previous one are skipped.
+        :param timeout: [float] seconds to wait for a new frame before checking that the stream is running
+        :return: [generator of bytes] JPEG images
+        """
+        sequence = 0
+        while True:
+            with self._output:
+                if self._sequence == sequence and self.is_running():
+                    self._output.wait(timeout)
+                if self._sequence == sequence:
+                    if not self.is_running():
+                        return
+                    continue
+                sequence, jpeg = self._sequence, self._jpeg
+            yield jpeg
+
+    def mjpeg(self, boundary='frame'):
+        """
+        :param boundary: [str] boundary of multipart/x-mixed-replace response
+        :return: [generator of bytes] parts of MJPEG response
+        """
+        for jpeg in self.frames():
+            yield b''.join([b'--', boundary.encode('ascii'), b'\r\nContent-Type: image/jpeg\r\nContent-Length: ',
+                            str(len(jpeg)).encode('ascii'), b'\r\n\r\n', jpeg, b'\r\n'])
+
+    def stats(self):
+        """
+        :return: [dict] numbers of captured, analysed and dropped frames, achieved capture and analysis FPS,
+                 latency percentiles of the last frames and number of frames that exceeded the latency budget
+        """
+        elapsed = ((self.finished or time()) - self.started) if self.started else 0.0
+        latencies = list(self.latencies)
+        p50, p95, p99 = np.percentile(latencies, [50, 95, 99]).tolist() if latencies else (0.0, 0.0, 0.0)
+        return {
+            'source': self.source,
+            'running': self.started is not None and self.is_running(),
+            'clients': self.clients,
+            'drop_policy': self.drop_policy,
+            'latency_budget': self.latency_budget,
+            'elapsed': elapsed,
+            'captured_frames': self.captured,
+            'analysed_frames': self.analysed,
+            'dropped_frames': self.buffer.dropped + self.dropped_stale,
+            'dropped_replaced': self.buffer.dropped,
+            'dropped_stale': self.dropped_stale,
+            'faces_skipped': self.faces_skipped,
+            'over_budget': self.over_budget,
+            'capture_fps': self.captured / elapsed if elapsed else 0.0,
+            'analysis_fps': self.analysed / elapsed if elapsed else 0.0,
+            'latency': {'p50': p50, 'p95': p95, 'p99': p99},
+            'error': self.error,
+        }
+
+    def __read(self):
+        frame_time = 1.0 / (self._cap.get(cv2.CAP_PROP_FPS) or 25.0)
+        next_frame = time()
+        try:
+            while not self._stop.is_set():
+                if self.realtime:
+                    # A file is read at its frame rate, as a camera would give it
+                    delay = next_frame - time()
+                    if delay > 0:
+                        sleep(delay)
+                    next_frame = max(next_frame + frame_time, time() - frame_time)
+                is_retrieved, image = self._cap.read()
+                if not is_retrieved:
+                    logging.log(logging.INFO, 'Stream {} from {} ended.'.format(self.name, self.source))
+                    break
+                self.captured += 1
+                STREAM_FRAMES.inc(1, (self.name, 'captured'))
+                if self.buffer.put(image, time()):
+                    STREAM_FRAMES.inc(1, (self.name, 'dropped_replaced'))
+        except Exception as e:
+            logging.log(logging.ERROR, 'Reading stream {} failed: {}'.format(self.name, e))
+            self.error = str(e)
+        finally:
+            self._cap.release()
+            self.buffer.close()
+
+    def __analyse(self):
+        try:
+            while True:
+                item = self.buffer.get(timeout=0.5)
+                if item is None:
+                    if self.buffer.closed:
+                        break
+                    continue
+                image, captured = item
+                start = time()
+                # A frame that would be late is dropped if a newer one waits, otherwise it is shown late
+                if start - captured > self.latency_budget or (
+                        start - captured + self._person_time > self.latency_budget and self.buffer.waiting()):
+                    self.dropped_stale += 1
+                    STREAM_FRAMES.inc(1, (self.name, 'dropped_stale'))
+                    continue
+                self.__process(Frame(image), captured, start)
+        except Exception as e:
+            logging.log(logging.ERROR, 'Analysis of stream {} failed: {}'.format(self.name, e))
+            self.error = str(e)
+            self._stop.set()
+            self.buffer.close()
+        finally:
+            with self._output:
+                self.finished = time()
+                self._output.notify_all()
+
+    def __process(self, current_frame, captured, start):
+        self.detect_persons(current_frame)
+        persons_done = time()
+        self._person_time += _SMOOTHING * (persons_done - start - self._person_time)
+        if self.detect_faces is not None and len(current_frame.person_boxes):
+            if persons_done - captured + self._face_time <= self.latency_budget:
+                self.detect_faces(current_frame)
+                self._face_time += _SMOOTHING * (time() - persons_done - self._face_time)
+            else:
+                # Estimate is lowered, so faces are searched again when the stream keeps up
+                self._face_time *= 1 - _SMOOTHING
+                self.faces_skipped += 1
+        current_frame.draw_all_labeled_bounding_boxes()
+        is_encoded, jpeg = cv2.imencode('.jpg', current_frame.image, [cv2.IMWRITE_JPEG_QUALITY, self.jpeg_quality])
+        if not is_encoded:
+            raise IOError('Frame of stream {} can not be encoded.'.format(self.name))
+        latency = time() - captured
+        self.analysed += 1
+        self.latencies.append(latency)
+        self.over_budget += latency > self.latency_budget
+        STREAM_FRAMES.inc(1, (self.name, 'analysed'))
+        STREAM_LATENCY_SECONDS.observe(latency, (self.name,))
+        with self._output:
+            self._jpeg = jpeg.tobytes()
+            self._sequence += 1
+            self._output.notify_all()
@@ -1,7 +1,30 @@
+import io
+import json
 import os
 import main
+import shutil
 import unittest
 import tempfile
+import zipfile
+from time import sleep, time
+from unittest import mock
+from urllib.parse import urlparse
+
+import cv2
+import numpy as np
+
+import segment_processor
+from benchmark import StubPersonDetector, StubFaceDetector
+from clip_extractor import ClipExtractor
+from face_detector import select_faces
+from frame import Frame
+from micro_batcher import MicroBatcher
+from model_manager import ModelManager
+from result_cache import ResultCache
+from segment_processor import process_video_segments, split_segments
+from storage_manager import StorageManager
+from stream_processor import FrameBuffer, StreamProcessor
+from tracker import IouTracker
 
 
 class FlaskBookshelfTests(unittest.TestCase):
@@ -15,9 +38,20 @@ class FlaskBookshelfTests(unittest.TestCase):
         self.app = main.app.test_client()
         # propagate the exceptions to the test client
         self.app.testing = True
+        # uploaded and processed files are stored in a temporary directory
+        self.storage_dir = tempfile.mkdtemp()
+        self.patches = [
+            mock.patch.object(main, 'STORAGE_DIR', self.storage_dir),
+            mock.patch.object(main, 'storage_manager', StorageManager(self.storage_dir)),
+            mock.patch.object(main, 'result_cache', ResultCache(on_evict=main.discard_result)),
+        ]
+        for patch in self.patches:
+            patch.start()
 
     def tearDown(self):
-        pass
+        for patch in self.patches:
+            patch.stop()
+        shutil.rmtree(self.storage_dir)
 
     def test_upload_file__get__status_code(self):
         # sends HTTP GET request to the application
@@ -44,6 +78,555 @@ class FlaskBookshelfTests(unittest.TestCase):
         )
         self.assertEqual(response.status_code, 200)
 
+    def test_job_status__unknown_job__not_found(self):
+        result = self.app.get('/jobs/unknown')
+
+        self.assertEqual(result.status_code, 404)
+
+    def test_healthz__status_code(self):
+        result = self.app.get('/healthz')
+
+        self.assertEqual(result.status_code, 200)
+
+    def test_readyz__models_not_loaded__service_unavailable(self):
+        result = self.app.get('/readyz')
+
+        self.assertEqual(result.status_code, 503)
+
+    def test_readyz__models_not_loadable__reports_error(self):
+        person_backend = main.PERSON_BACKEND
+        main.PERSON_BACKEND = 'unknown'
+        try:
+            main.create_app()
+            result = self.app.get('/readyz')
+        finally:
+            main.PERSON_BACKEND = person_backend
+            main.startup_error = None
+
+        self.assertEqual(result.status_code, 503)
+        self.assertIn('Unknown inference backend', result.get_json()['error'])
+
+    def test_metrics__prometheus_format(self):
+        result = self.app.get('/metrics')
+
+        self.assertEqual(result.status_code, 200)
+        self.assertIn(b'# TYPE person_detection_stage_seconds histogram', result.data)
+
+    def test_storage_stats__status_code(self):
+        result = self.app.get('/storage/stats')
+
+        self.assertEqual(result.status_code, 200)
+        self.assertIn(b'evictions', result.data)
+
+    def wait_for_job(self, status_url):
+        status_path = urlparse(status_url).path
+        for _ in range(100):
+            status = self.app.get(status_path).get_json()
+            if status['status'] not in ('queued', 'running'):
+                break
+            sleep(0.1)
+        return status
+
+    def test_upload_file__storage_over_quota__upload_processed(self):
+        main.model_manager = create_stub_manager()
+        main.is_ready = True
+        try:
+            with mock.patch.object(main, 'storage_manager', StorageManager(self.storage_dir, max_bytes=1)):
+                with open('test_data/images/test_image_1.jpg', 'rb') as image_file:
+                    response = self.app.post('/', data=dict(file=(image_file, 'image.jpg'), file_type='image'),
+                                             content_type='multipart/form-data')
+                status = self.wait_for_job(response.get_json()['status_url'])
+        finally:
+            main.is_ready = False
+            main.model_manager = None
+
+        self.assertEqual(status['status'], 'done')
+
+    def test_upload_file__same_file_other_name__cached_download_url(self):
+        main.model_manager = ModelManager(models={'person_detector': StubPersonDetector(),
+                                                  'face_detector': StubFaceDetector()})
+        main.is_ready = True
+        try:
+            with open('test_data/images/test_image_1.jpg', 'rb') as image_file:
+                content = image_file.read()
+            first = self.app.post('/', data=dict(file=(io.BytesIO(content), 'first.jpg'), file_type='image'),
+                                  content_type='multipart/form-data')
+            self.assertEqual(self.wait_for_job(first.get_json()['status_url'])['status'], 'done')
+
+            second = self.app.post('/', data=dict(file=(io.BytesIO(content), 'second.jpg'), file_type='image'),
+                                   content_type='multipart/form-data')
+            result = self.app.get(urlparse(second.get_json()['download_url']).path)
+
+            self.assertEqual(second.status_code, 200)
+            self.assertEqual(result.status_code, 200)
+            result.close()
+        finally:
+            main.is_ready = False
+            main.model_manager = None
+
+    def test_batch_upload__no_files__bad_request(self):
+        result = self.app.post('/batch', data={}, content_type='multipart/form-data')
+
+        self.assertEqual(result.status_code, 400)
+
+    def post_batch(self):
+        with open('test_data/images/test_image_1.jpg', 'rb') as image_file:
+            content = image_file.read()
+        archive_content = io.BytesIO()
+        with zipfile.ZipFile(archive_content, 'w') as archive:
+            archive.writestr('people/a.jpg', content)
+            archive.writestr('notes.txt', b'not an image')
+            archive.writestr('broken.jpg', b'not a jpeg')
+        archive_content.seek(0)
+        files = [(io.BytesIO(content), 'first.jpg'), (io.BytesIO(content), 'second.jpg'),
+                 (archive_content, 'images.zip')]
+        main.model_manager = create_stub_manager()
+        main.is_ready = True
+        try:
+            return self.app.post('/batch', data={'files': files}, content_type='multipart/form-data')
+        finally:
+            main.is_ready = False
+            main.model_manager = None
+
+    def test_batch_upload__images_and_archive__zip_with_manifest(self):
+        result = self.post_batch()
+        archive = zipfile.ZipFile(io.BytesIO(result.get_data()))
+        manifest = json.loads(archive.read('manifest.json'))
+
+        self.assertEqual(result.status_code, 200)
+        self.assertEqual(sorted(archive.namelist()), ['manifest.json', 'processed/00000_first.jpg',
+                                                      'processed/00001_second.jpg', 'processed/00002_a.jpg'])
+        self.assertEqual([entry['name'] for entry in manifest], ['first.jpg', 'second.jpg', 'people/a.jpg',
+                                                                 'broken.jpg'])
+        self.assertEqual(len(manifest[0]['persons']), 4)
+        self.assertEqual(manifest[3]['error'], 'Image can not be decoded.')
+        self.assertEqual(os.listdir(os.path.join(self.storage_dir, 'input_files')), [])
+
+    def test_batch_upload__too_many_images__payload_too_large(self):
+        with mock.patch.object(main, 'BATCH_MAX_IMAGES', 3):
+            result = self.post_batch()
+
+        self.assertEqual(result.status_code, 413)
+        self.assertEqual(os.listdir(os.path.join(self.storage_dir, 'input_files')), [])
+
+    def test_batch_upload__image_too_large__payload_too_large(self):
+        with mock.patch.object(main, 'BATCH_MAX_IMAGE_BYTES', 100):
+            result = self.post_batch()
+
+        self.assertEqual(result.status_code, 413)
+        self.assertEqual(os.listdir(os.path.join(self.storage_dir, 'input_files')), [])
+
+    def test_stream__unknown_source__not_found(self):
+        result = self.app.get('/streams/unknown')
+
+        self.assertEqual(result.status_code, 404)
+
+
+class FrameFacesTests(unittest.TestCase):
+
+    def test_select_faces__best_candidate_above_threshold(self):
+        candidates = [
+            (np.array([[0, 0, 10, 10], [20, 0, 30, 10]], dtype=np.int32), np.array([0.2, 0.8], dtype=np.float32)),
+            (np.zeros((0, 4), dtype=np.int32), np.zeros(0, dtype=np.float32)),
+            (np.array([[40, 0, 50, 10]], dtype=np.int32), np.array([0.05], dtype=np.float32)),
+        ]
+
+        face_boxes, person_faces = select_faces(candidates, threshold=0.1)
+
+        self.assertEqual(face_boxes.tolist(), [[20, 0, 30, 10]])
+        self.assertEqual(person_faces.tolist(), [0, -1, -1])
+
+    def test_to_dict__person_without_face__face_none(self):
+        frame = Frame(np.zeros((100, 100, 3), dtype=np.uint8))
+        frame.set_person_boxes(np.array([[10, 10, 90, 40], [10, 50, 90, 90]], dtype=np.int32))
+        frame.set_person_scores(np.array([0.9, 0.6], dtype=np.float32))
+        frame.set_faces(np.array([[55, 12, 70, 27]], dtype=np.int32), np.array([-1, 0], dtype=np.int32))
+
+        persons = frame.to_dict(3)['persons']
+
+        self.assertIsNone(frame.get_face_of_person(0))
+        self.assertEqual(frame.get_face_of_person(1).tolist(), [55, 12, 70, 27])
+        self.assertIsNone(persons[0]['face'])
+        self.assertEqual(persons[1]['face'], {'x1': 55, 'y1': 12, 'x2': 70, 'y2': 27})
+        self.assertEqual(persons[1]['box'], {'top': 10, 'left': 50, 'bottom': 90, 'right': 90})
+
+
+class ModelManagerTests(unittest.TestCase):
+
+    def test_copy_for_thread__own_face_detector__shared_person_detector(self):
+        model_manager = create_stub_manager()
+
+        copy = model_manager.copy_for_thread()
+
+        self.assertIs(copy.models['person_detector'], model_manager.models['person_detector'])
+        self.assertIsNot(copy.models['face_detector'], model_manager.models['face_detector'])
+
+
+class IouTrackerTests(unittest.TestCase):
+
+    def make_frame(self, boxes):
+        frame = Frame(np.zeros((480, 640, 3), dtype=np.uint8))
+        frame.set_person_boxes(np.array(boxes, dtype=np.int32).reshape(-1, 4))
+        frame.set_person_scores(np.full(len(boxes), 0.9, dtype=np.float32))
+        frame.set_faces(np.zeros((0, 4), dtype=np.int32), np.full(len(boxes), -1, dtype=np.int32))
+        return frame
+
+    def test_update__moved_person__keeps_id(self):
+        tracker = IouTracker()
+        first = self.make_frame([[100, 100, 300, 200]])
+        tracker.update(first)
+        second = self.make_frame([[400, 400, 470, 450], [110, 105, 310, 205]])
+        tracker.update(second)
+
+        self.assertEqual(second.person_ids.tolist(), [2, first.person_ids[0]])
+
+    def test_predict__moves_with_velocity_per_frame(self):
+        tracker = IouTracker()
+        tracker.update(self.make_frame([[100, 100, 300, 200]]))
+        tracker.predict(self.make_frame([]))
+        keyframe = self.make_frame([[100, 120, 300, 220]])
+        tracker.update(keyframe)
+        predicted = self.make_frame([])
+        tracker.predict(predicted)
+
+        self.assertEqual(predicted.person_boxes.tolist(), [[100, 130, 300, 230]])
+
+    def test_skip__static_frames__velocity_per_video_frame(self):
+        tracker = IouTracker()
+        tracker.update(self.make_frame([[100, 100, 300, 200]]))
+        tracker.skip()
+        tracker.update(self.make_frame([[100, 120, 300, 220]]))
+        predicted = self.make_frame([])
+        tracker.predict(predicted)
+
+        self.assertEqual(predicted.person_boxes.tolist(), [[100, 130, 300, 230]])
+
+    def test_needs_keyframe__person_left__ignores_missed_track(self):
+        tracker = IouTracker()
+        tracker.update(self.make_frame([[100, 100, 300, 200], [100, 400, 120, 450]]))
+        tracker.update(self.make_frame([[100, 100, 300, 200], [100, 410, 120, 460]]))
+        tracker.update(self.make_frame([[100, 100, 300, 200]]))
+        tracker.predict(self.make_frame([]))
+
+        self.assertFalse(tracker.needs_keyframe(10))
+        self.assertTrue(tracker.needs_keyframe(2))
+
+
+class StorageManagerTests(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.storage = StorageManager(self.root, live_time=10, max_bytes=10)
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def make_file(self, name, created=0):
+        path = os.path.join(self.root, name)
+        with open(path, 'wb') as stored_file:
+            stored_file.write(b'data')
+        self.storage.add(path, created=created, evict=False)
+        return path
+
+    def test_evict__expired_item__deleted(self):
+        path = self.make_file('a')
+
+        self.assertEqual(self.storage.evict(now=5), 0)
+        self.assertTrue(os.path.exists(path))
+        self.assertEqual(self.storage.evict(now=11), 1)
+        self.assertFalse(os.path.exists(path))
+        self.assertEqual(self.storage.stats()['entries'], 0)
+
+    def test_evict__over_quota__least_recently_used_deleted(self):
+        first, second = self.make_file('a', created=100), self.make_file('b', created=100)
+        self.storage.touch(first)
+        third = self.make_file('c', created=100)
+
+        self.assertEqual(self.storage.evict(now=100), 1)
+        self.assertFalse(os.path.exists(second))
+        self.assertTrue(os.path.exists(first))
+        self.assertTrue(os.path.exists(third))
+
+    def test_unpin__pinned_twice__kept_until_unpinned_twice(self):
+        path = self.make_file('a')
+        self.storage.pin([path, path])
+
+        self.storage.unpin([path])
+        self.assertEqual(self.storage.evict(now=11), 0)
+        self.assertTrue(os.path.exists(path))
+        self.storage.unpin([path])
+        # A pinned expired item is checked again after check_interval
+        self.assertEqual(self.storage.evict(now=time() + self.storage.check_interval), 1)
+        self.assertFalse(os.path.exists(path))
+
+    def test_discard__pinned_item__kept(self):
+        path = self.make_file('a')
+
+        with self.storage.pinned([path]):
+            self.storage.discard(path)
+            self.assertTrue(os.path.exists(path))
+        self.storage.discard(path)
+        self.assertFalse(os.path.exists(path))
+
+
+class MicroBatcherTests(unittest.TestCase):
+
+    def setUp(self):
+        self.batches = []
+
+    def double(self, items):
+        self.batches.append(items)
+        return [item * 2 for item in items]
+
+    def test_submit__full_batch__run_once_per_group(self):
+        batcher = MicroBatcher(self.double, max_batch_size=4, max_wait=10)
+        futures = [batcher.submit(item, group=item % 2) for item in (1, 2, 3, 4)]
+
+        self.assertEqual([future.result(timeout=1) for future in futures], [2, 4, 6, 8])
+        self.assertEqual(self.batches, [[1, 3], [2, 4]])
+        batcher.close()
+
+    def test_submit__partial_batch__run_after_max_wait(self):
+        batcher = MicroBatcher(self.double, max_batch_size=8, max_wait=0.05)
+        start = time()
+        future = batcher.submit(1)
+
+        self.assertEqual(future.result(timeout=1), 2)
+        self.assertGreaterEqual(time() - start, 0.04)
+        self.assertEqual(self.batches, [[1]])
+        batcher.close()
+
+    def test_submit__func_fails__exception_of_every_item(self):
+        def fail(items):
+            raise ValueError('failed')
+
+        batcher = MicroBatcher(fail, max_batch_size=2, max_wait=10)
+        futures = [batcher.submit(item) for item in (1, 2)]
+
+        for future in futures:
+            self.assertRaises(ValueError, future.result, 1)
+        batcher.close()
+
+
+class FakeCapture:
+    # Capture of frames filled with their numbers, 10 frames per second
+
+    def __init__(self, frames):
+        self.frames = frames
+        self.position = 0
+
+    def get(self, prop):
+        return {cv2.CAP_PROP_FPS: 10.0, cv2.CAP_PROP_POS_FRAMES: self.position}[prop]
+
+    def set(self, prop, value):
+        self.position = int(value)
+        return True
+
+    def grab(self):
+        self.position += 1
+        return self.position <= self.frames
+
+    def read(self):
+        if not self.grab():
+            return False, None
+        return True, np.full((4, 4, 3), self.position - 1, dtype=np.uint8)
+
+
+class FakeWriter:
+
+    def __init__(self):
+        self.frames = []
+
+    def write(self, image):
+        self.frames.append(int(image[0, 0, 0]))
+
+
+class ClipExtractorTests(unittest.TestCase):
+
+    def setUp(self):
+        self.probed = []
+        self.processed = []
+
+    def persons_of(self, current_frame):
+        return 1 if 12 <= current_frame.image[0, 0, 0] <= 15 else 0
+
+    def has_persons(self, current_frame):
+        self.probed.append(int(current_frame.image[0, 0, 0]))
+        return self.persons_of(current_frame)
+
+    def process_frame(self, current_frame, is_probed):
+        self.processed.append((int(current_frame.image[0, 0, 0]), is_probed))
+        return self.persons_of(current_frame)
+
+    def test_extract__persons_found__clip_with_padding(self):
+        extractor = ClipExtractor(self.has_persons, self.process_frame, probe_interval=5, pre_padding=0.2,
+                                  post_padding=0.3)
+        writer = FakeWriter()
+
+        timeline = extractor.extract(FakeCapture(30), writer)
+
+        self.assertEqual(self.probed, [0, 5, 10, 15, 20, 25])
+        self.assertEqual(writer.frames, [13, 14, 15, 16, 17, 18])
+        self.assertEqual([(clip['start_frame'], clip['end_frame'], clip['max_persons']) for clip in timeline],
+                         [(13, 19, 1)])
+        self.assertNotIn(True, [is_probed for _, is_probed in self.processed])
+
+    def test_extract__no_pre_padding__probe_frame_not_detected_again(self):
+        extractor = ClipExtractor(self.has_persons, self.process_frame, probe_interval=5, pre_padding=0,
+                                  post_padding=0.3)
+        writer = FakeWriter()
+
+        extractor.extract(FakeCapture(30), writer)
+
+        self.assertEqual(writer.frames, [15, 16, 17, 18])
+        self.assertEqual(self.processed[0], (15, True))
+        self.assertEqual(self.probed.count(15), 1)
+
+
+def write_video(path, frames, frame_rate=25, size=(32, 24)):
+    writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*'MJPG'), frame_rate, size)
+    for i in range(frames):
+        writer.write(np.full((size[1], size[0], 3), i % 256, dtype=np.uint8))
+    writer.release()
+    return path
+
+
+def create_stub_manager(**model_options):
+    return ModelManager(models={'person_detector': StubPersonDetector(), 'face_detector': StubFaceDetector()})
+
+
+class UnderCountedCapture:
+    # Capture of a container, that reports 100 frames less than it has
+    capture_class = cv2.VideoCapture
+
+    def __init__(self, *args):
+        self.cap = self.capture_class(*args)
+
+    def get(self, prop):
+        value = self.cap.get(prop)
+        return value - 100 if prop == cv2.CAP_PROP_FRAME_COUNT else value
+
+    def __getattr__(self, name):
+        return getattr(self.cap, name)
+
+
+class SegmentProcessorTests(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def test_process_video_segments__frame_count_too_low__all_frames_written(self):
+        input_file = write_video(os.path.join(self.root, 'input.avi'), 1100)
+        output_file = os.path.join(self.root, 'output.mp4')
+
+        with mock.patch.object(segment_processor.cv2, 'VideoCapture', UnderCountedCapture):
+            stats = process_video_segments(input_file, output_file, 0.5, 0.1, segments=2,
+                                           manager_factory=create_stub_manager)
+        cap = cv2.VideoCapture(output_file)
+        frames = 0
+        while cap.grab():
+            frames += 1
+        cap.release()
+
+        self.assertEqual(stats['segments'], [[0, 500], [500, 1000]])
+        self.assertEqual(frames, 1100)
+
+    def test_split_segments__frames_not_known__no_segments(self):
+        self.assertEqual(split_segments(0, 1), [])
+        self.assertEqual(split_segments(-1, 4), [])
+
+    def test_split_segments__keyframes__boundaries_moved(self):
+        self.assertEqual(split_segments(1000, 2, keyframes=[0, 480, 900]), [(0, 480), (480, 1000)])
+
+
+class FrameBufferTests(unittest.TestCase):
+
+    def test_put__latest_policy__newer_frame_replaces_older(self):
+        frame_buffer = FrameBuffer('latest', size=4)
+
+        self.assertFalse(frame_buffer.put('first', 1.0))
+        self.assertTrue(frame_buffer.put('second', 2.0))
+        self.assertEqual(frame_buffer.get(timeout=0), ('second', 2.0))
+        self.assertIsNone(frame_buffer.get(timeout=0))
+        self.assertEqual(frame_buffer.dropped, 1)
+
+    def test_put__queue_policy__bounded_in_order(self):
+        frame_buffer = FrameBuffer('queue', size=2)
+        for i in range(3):
+            frame_buffer.put(i, float(i))
+
+        self.assertEqual(frame_buffer.waiting(), 2)
+        self.assertEqual(frame_buffer.get(timeout=0), (1, 1.0))
+        self.assertEqual(frame_buffer.get(timeout=0), (2, 2.0))
+        self.assertEqual(frame_buffer.dropped, 1)
+
+    def test_get__closed__none_without_waiting(self):
+        frame_buffer = FrameBuffer()
+        frame_buffer.close()
+
+        self.assertIsNone(frame_buffer.get(timeout=10))
+
+
+class StreamProcessorTests(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def create_processor(self, frames, latency=0.0, **options):
+        model_manager = ModelManager(models={'person_detector': StubPersonDetector(persons=2, latency=latency),
+                                             'face_detector': StubFaceDetector()})
+
+        def detect_persons(current_frame):
+            model_manager.put_person_predictions_into_frames([current_frame], 0.5)
+
+        return StreamProcessor(write_video(os.path.join(self.root, 'stream.avi'), frames, frame_rate=10),
+                               detect_persons, **options)
+
+    def test_mjpeg__file_source__every_frame_analysed(self):
+        processor = self.create_processor(20, latency_budget=10.0, drop_policy='queue', buffer_size=20,
+                                          realtime=False).start()
+        parts = list(processor.mjpeg())
+        processor.stop()
+        stats = processor.stats()
+
+        self.assertEqual(stats['captured_frames'], 20)
+        self.assertEqual(stats['analysed_frames'], 20)
+        self.assertEqual(stats['dropped_frames'], 0)
+        self.assertEqual(stats['over_budget'], 0)
+        self.assertFalse(stats['running'])
+        header, jpeg = parts[-1].split(b'\r\n\r\n', 1)
+        self.assertEqual(header.split(b'\r\n')[:2], [b'--frame', b'Content-Type: image/jpeg'])
+        self.assertEqual(header.split(b'\r\n')[2], 'Content-Length: {}'.format(len(jpeg) - 2).encode('ascii'))
+        self.assertTrue(jpeg.startswith(b'\xff\xd8'))
+        self.assertTrue(jpeg.endswith(b'\xff\xd9\r\n'))
+
+    def test_stats__frames_older_than_budget__dropped_stale(self):
+        processor = self.create_processor(10, latency_budget=0.0, drop_policy='queue', buffer_size=10,
+                                          realtime=False).start()
+        list(processor.frames())
+        processor.stop()
+        stats = processor.stats()
+
+        self.assertEqual(stats['captured_frames'], 10)
+        self.assertEqual(stats['dropped_stale'], 10)
+        self.assertEqual(stats['analysed_frames'], 0)
+
+    def test_stats__slow_detector__frames_over_budget(self):
+        processor = self.create_processor(5, latency=0.05, latency_budget=0.02, realtime=True).start()
+        list(processor.frames())
+        processor.stop()
+        stats = processor.stats()
+
+        self.assertEqual(stats['captured_frames'], 5)
+        self.assertGreater(stats['over_budget'], 0)
+        self.assertEqual(stats['analysed_frames'] + stats['dropped_frames'], 5)
+
 
 if __name__ == '__main__':
     unittest.main()
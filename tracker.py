@@ -0,0 +1,169 @@
+import numpy as np
+
+
+def box_iou(boxes_a, boxes_b):
+    """
+    Intersection over union of every pair of boxes.
+    :param boxes_a: [numpy array] array [N, 4] of (top, left, bottom, right) boxes
+    :param boxes_b: [numpy array] array [M, 4] of (top, left, bottom, right) boxes
+    :return: [numpy array] float32 array [N, M]
+    """
+    a = boxes_a.astype(np.float32)[:, None, :]
+    b = boxes_b.astype(np.float32)[None, :, :]
+    inter_h = np.minimum(a[..., 2], b[..., 2]) - np.maximum(a[..., 0], b[..., 0])
+    inter_w = np.minimum(a[..., 3], b[..., 3]) - np.maximum(a[..., 1], b[..., 1])
+    intersection = np.maximum(inter_h, 0) * np.maximum(inter_w, 0)
+    area_a = (a[..., 2] - a[..., 0]) * (a[..., 3] - a[..., 1])
+    area_b = (b[..., 2] - b[..., 0]) * (b[..., 3] - b[..., 1])
+    return intersection / np.maximum(area_a + area_b - intersection, 1)
+
+
+class Track:
+    """Class that stores position, velocity and face of one tracked person."""
+
+    def __init__(self, track_id, box, score, face_box, frame_index):
+        self.track_id = track_id
+        self.box = box.astype(np.float32)
+        self.velocity = np.zeros(4, dtype=np.float32)
+        self.score = score
+        self.face_box = face_box
+        self.confidence = 1.0
+        self.misses = 0
+        self.detected_box = self.box.copy()
+        self.detected_frame = frame_index
+
+    def predict(self):
+        """Moves box and face of the track one frame forward with constant velocity."""
+        self.box += self.velocity
+        if self.face_box is not None:
+            self.face_box += self.velocity[[1, 0, 1, 0]]
+        # The faster a person moves relative to its size, the faster prediction becomes unreliable
+        height = max(self.box[2] - self.box[0], 1.0)
+        speed = np.abs((self.velocity[:2] + self.velocity[2:]) / 2).max()
+        self.confidence /= 1.0 + speed / height
+
+
+class IouTracker:
+    """
+    Class, that carries person boxes between keyframes and gives them stable ids.
+    Method update associates boxes detected on a keyframe with tracks by IoU,
+    method predict moves tracks with constant velocity on frames between keyframes.
+    Both methods take a Frame, update tracks and set person boxes, scores, ids and faces of the Frame.
+    """
+
+    def __init__(self, min_iou=0.3, max_misses=2, min_confidence=0.5):
+        self.min_iou = min_iou
+        self.max_misses = max_misses
+        self.min_confidence = min_confidence
+        self.tracks = []
+        self.next_id = 1
+        self.frame_index = -1
+        self.keyframe_index = None
+
+    def needs_keyframe(self, keyframe_interval):
+        """
+        :param keyframe_interval: [int] maximum number of frames between keyframes
+        :return: [bool] True if the next frame has to be processed by detectors
+        """
+        if self.keyframe_index is None or self.frame_index + 1 - self.keyframe_index >= keyframe_interval:
+            return True
+        # Tracks missed on the last keyframe are not shown (see predict), so they do not force keyframes
+        return any(track.confidence < self.min_confidence for track in self.tracks if not track.misses)
+
+    def skip(self):
+        """
+        Counts a static frame, that reuses detections of the previous frame, so velocities stay per video frame.
+        :return: [None]
+        """
+        self.frame_index += 1
+
+    def update(self, frame):
+        """
+        Associates detections of a keyframe with tracks.
+        :param frame: [Frame obj] Frame with detected person_boxes, person_scores and face_boxes
+        :return: [None]
+        """
+        self.frame_index += 1
+        self.keyframe_index = self.frame_index
+        for track in self.tracks:
+            track.predict()
+
+        boxes = frame.person_boxes
+        track_boxes = np.array([track.box for track in self.tracks], dtype=np.float32).reshape(-1, 4)
+        if len(self.tracks) and len(boxes):
+            iou = box_iou(track_boxes, boxes)
+        else:
+            iou = np.zeros((len(self.tracks), len(boxes)), dtype=np.float32)
+
+        # Greedy association, the most overlapping pairs first
+        matched_tracks, matched_boxes = set(), set()
+        box_tracks = [None] * len(boxes)
+        for flat in np.argsort(-iou, axis=None):
+            track_i, box_i = [int(i) for i in np.unravel_index(flat, iou.shape)]
+            if iou[track_i, box_i] < self.min_iou:
+                break
+            if track_i in matched_tracks or box_i in matched_boxes:
+                continue
+            matched_tracks.add(track_i)
+            matched_boxes.add(box_i)
+            box_tracks[box_i] = self.tracks[track_i]
+
+        for track_i, track in enumerate(self.tracks):
+            if track_i not in matched_tracks:
+                track.misses += 1
+
+        ids = np.zeros(len(boxes), dtype=np.int32)
+        for box_i, (box, score) in enumerate(zip(boxes, frame.person_scores)):
+            face = frame.get_face_of_person(box_i)
+            if face is not None:
+                face = face.astype(np.float32)
+            track = box_tracks[box_i]
+            if track is None:
+                track = Track(self.next_id, box, score, face, self.frame_index)
+                self.next_id += 1
+                self.tracks.append(track)
+            else:
+                box = box.astype(np.float32)
+                track.velocity = (box - track.detected_box) / (self.frame_index - track.detected_frame)
+                track.box = box
+                track.detected_box = box.copy()
+                track.detected_frame = self.frame_index
+                track.score = score
+                track.face_box = face
+                track.confidence = 1.0
+                track.misses = 0
+            ids[box_i] = track.track_id
+        frame.person_ids = ids
+
+        self.tracks = [track for track in self.tracks if track.misses <= self.max_misses]
+
+    def predict(self, frame):
+        """
+        Sets positions of tracks predicted for a frame between keyframes.
+        :param frame: [Frame obj] Frame without detections
+        :return: [None]
+        """
+        self.frame_index += 1
+        height, width = frame.image.shape[:2]
+        size = np.array([height, width, height, width], dtype=np.float32)
+
+        tracks = []
+        for track in self.tracks:
+            track.predict()
+            # Tracks that were not found on the last keyframe are kept only to be matched again
+            if not track.misses:
+                tracks.append(track)
+
+        boxes = np.array([track.box for track in tracks], dtype=np.float32).reshape(-1, 4)
+        frame.set_person_boxes(np.clip(boxes, 0, size).astype(np.int32))
+        frame.set_person_scores(np.array([track.score for track in tracks], dtype=np.float32))
+        frame.person_ids = np.array([track.track_id for track in tracks], dtype=np.int32)
+
+        face_boxes = []
+        person_faces = np.full(len(tracks), -1, dtype=np.int32)
+        for i, track in enumerate(tracks):
+            if track.face_box is not None:
+                person_faces[i] = len(face_boxes)
+                face_boxes.append(track.face_box)
+        face_boxes = np.array(face_boxes, dtype=np.float32).reshape(-1, 4)
+        frame.set_faces(np.clip(face_boxes, 0, size[[1, 0, 1, 0]]).astype(np.int32), person_faces)
@@ -0,0 +1,216 @@
+import logging
+from collections import OrderedDict, deque
+from queue import Queue, Empty, Full
+from threading import Thread, Event, Lock
+from time import time
+
+import numpy as np
+
+from frame import Frame
+from metrics import STAGE_SECONDS, FRAMES
+
+# Marker that is passed through the queues after the last item
+_END = object()
+# Number of the last items latency percentiles are computed from
+_LATENCY_WINDOW = 10000
+
+
+def read_frames(cap):
+    """
+    Generator of Frame objects read from a VideoCapture until the end of a video.
+    :param cap: [cv2.VideoCapture obj] opened capture
+    :return: [generator of Frame obj]
+    """
+    while cap.isOpened():
+        is_retrieved, image = cap.read()
+        if not is_retrieved:
+            break
+        yield Frame(image)
+
+
+class PipelineStage:
+    """
+    Class that describes one step of VideoPipeline.
+    Function func takes one item and returns the item passed to the next stage;
+    if batch_size is set, func takes and returns lists of up to batch_size items.
+    """
+
+    def __init__(self, name, func, batch_size=None):
+        self.name = name
+        self.func = func
+        self.batch_size = batch_size
+        self.processed = 0
+        self.busy_time = 0.0
+        self.max_queue_depth = 0
+        self.input_queue = None
+
+
+class VideoPipeline:
+    """
+    Class, that runs a source (decoding) and a chain of stages, each in its own thread.
+    Stages are joined by bounded queues: a slow stage makes the previous ones wait
+    instead of buffering the whole video in memory. Every stage is served by one thread,
+    so items leave the pipeline in the order the source produced them; latency of an item
+    is the time from the start of its decoding until the last stage finishes it.
+    Method run starts all threads, waits until the last item leaves the last stage and
+    returns statistics; method stats can be called while the pipeline is running.
+    """
+
+    def __init__(self, source, stages, queue_size=8, source_name='decode'):
+        self.source = source
+        self.source_stage = PipelineStage(source_name, None)
+        self.stages = stages
+        self.queue_size = queue_size
+        self.started = None
+        self.finished = None
+        self.latencies = deque(maxlen=_LATENCY_WINDOW)
+        self._item_starts = deque()
+        self._stop = Event()
+        self._error = None
+        self._lock = Lock()
+
+    def run(self):
+        """
+        Runs pipeline to the end of the source.
+        :return: [dict] statistics of stages (see stats)
+        """
+        for stage in self.stages:
+            stage.input_queue = Queue(maxsize=self.queue_size)
+
+        threads = [Thread(target=self.__run_source, name=self.source_stage.name)]
+        for i, stage in enumerate(self.stages):
+            next_stage = self.stages[i + 1] if i + 1 < len(self.stages) else None
+            threads.append(Thread(target=self.__run_stage, args=(stage, next_stage), name=stage.name))
+
+        self.started = time()
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.finished = time()
+
+        if self._error is not None:
+            raise self._error
+        stats = self.stats()
+        logging.log(logging.INFO, 'Pipeline finished: {}'.format(
+            ', '.join('{} {:.1f} items/s'.format(name, s['throughput']) for name, s in stats['stages'].items())))
+        return stats
+
+    def stats(self):
+        """
+        Statistics of pipeline.
+        Throughput of a stage is number of items it could process per second of its busy time,
+        so the stage with the lowest throughput is the bottleneck of the pipeline.
+        :return: [dict] elapsed time, overall FPS, 50th, 95th and 99th percentiles of latency of the last items
+                 and per-stage processed items, busy time, throughput, current and maximum depth of its input queue
+        """
+        elapsed = ((self.finished or time()) - self.started) if self.started else 0.0
+        stages = OrderedDict()
+        for stage in [self.source_stage] + self.stages:
+            stages[stage.name] = {
+                'processed': stage.processed,
+                'busy_time': stage.busy_time,
+                'throughput': stage.processed / stage.busy_time if stage.busy_time else 0.0,
+                'queue_depth': stage.input_queue.qsize() if stage.input_queue is not None else 0,
+                'max_queue_depth': stage.max_queue_depth,
+            }
+        done = self.stages[-1].processed if self.stages else self.source_stage.processed
+        latencies = list(self.latencies)
+        if latencies:
+            p50, p95, p99 = np.percentile(latencies, [50, 95, 99]).tolist()
+        else:
+            p50 = p95 = p99 = 0.0
+        return {
+            'elapsed': elapsed,
+            'fps': done / elapsed if elapsed else 0.0,
+            'latency': OrderedDict([('p50', p50), ('p95', p95), ('p99', p99)]),
+            'stages': stages,
+        }
+
+    def __fail(self, error):
+        with self._lock:
+            if self._error is None:
+                self._error = error
+        self._stop.set()
+
+    def __put(self, stage, queue, item):
+        """Puts item into a queue of the next stage, waiting while it is full (backpressure)."""
+        if queue is None:
+            return
+        while not self._stop.is_set():
+            try:
+                queue.put(item, timeout=0.1)
+            except Full:
+                continue
+            if stage is not None:
+                stage.max_queue_depth = max(stage.max_queue_depth, queue.qsize())
+            return
+
+    def __get(self, queue):
+        """Gets next item from a queue, returns _END if the pipeline was stopped."""
+        while not self._stop.is_set():
+            try:
+                return queue.get(timeout=0.1)
+            except Empty:
+                continue
+        return _END
+
+    def __run_source(self):
+        stage = self.source_stage
+        first_stage = self.stages[0] if self.stages else None
+        output_queue = first_stage.input_queue if first_stage else None
+        try:
+            iterator = iter(self.source)
+            while not self._stop.is_set():
+                start = time()
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    break
+                elapsed = time() - start
+                stage.busy_time += elapsed
+                stage.processed += 1
+                STAGE_SECONDS.observe(elapsed, (stage.name,))
+                self._item_starts.append(start)
+                self.__put(first_stage, output_queue, item)
+        except Exception as e:
+            logging.log(logging.ERROR, 'Pipeline stage {} failed: {}'.format(stage.name, e))
+            self.__fail(e)
+        self.__put(None, output_queue, _END)
+
+    def __run_stage(self, stage, next_stage):
+        output_queue = next_stage.input_queue if next_stage is not None else None
+        is_finished = False
+        try:
+            while not is_finished and not self._stop.is_set():
+                items = []
+                while len(items) < (stage.batch_size or 1):
+                    item = self.__get(stage.input_queue)
+                    if item is _END:
+                        is_finished = True
+                        break
+                    items.append(item)
+                if not items:
+                    break
+
+                start = time()
+                if stage.batch_size is not None:
+                    results = stage.func(items)
+                else:
+                    results = [stage.func(items[0])]
+                finished = time()
+                stage.busy_time += finished - start
+                stage.processed += len(items)
+                # Time of a batch is shared by its items
+                STAGE_SECONDS.observe((finished - start) / len(items), (stage.name,), count=len(items))
+                if next_stage is None:
+                    self.latencies.extend(finished - self._item_starts.popleft() for _ in items)
+                    FRAMES.inc(len(items))
+
+                for result in results:
+                    self.__put(next_stage, output_queue, result)
+        except Exception as e:
+            logging.log(logging.ERROR, 'Pipeline stage {} failed: {}'.format(stage.name, e))
+            self.__fail(e)
+        self.__put(None, output_queue, _END)
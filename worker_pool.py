@@ -0,0 +1,249 @@
+import itertools
+import logging
+import multiprocessing
+import os
+from concurrent.futures import Future
+from queue import Queue, Empty
+from threading import Thread, Lock
+
+import numpy as np
+
+from frame import Frame
+from model_manager import ModelManager
+
+
+def create_model_manager(warm_up_batch_sizes=(1,), **model_options):
+    """
+    Creates ModelManager of a worker process, builds its graph and warms it up.
+    :param warm_up_batch_sizes: [tuple of int] batch sizes of warm-up, see ModelManager.warm_up
+    :param model_options: keyword arguments of ModelManager
+    :return: [ModelManager obj]
+    """
+    model_manager = ModelManager(**model_options)
+    model_manager.build_graph()
+    model_manager.warm_up(batch_sizes=warm_up_batch_sizes)
+    return model_manager
+
+
+def split_cpus(workers, spec):
+    """
+    CPU sets of worker processes.
+    :param workers: [int] number of workers
+    :param spec: [str] 'auto' - available CPUs are split evenly between workers,
+                 list of CPU sets separated by ';' (e.g. '0,1;2,3') - one set per worker,
+                 empty - affinity is not set
+    :return: [list] set of CPUs or None for every worker
+    """
+    if not spec:
+        return [None] * workers
+    if spec == 'auto':
+        if not hasattr(os, 'sched_getaffinity'):
+            return [None] * workers
+        cpus = sorted(os.sched_getaffinity(0))
+        per_worker = max(1, len(cpus) // workers)
+        starts = [(i * per_worker) % len(cpus) for i in range(workers)]
+        return [set(cpus[start:start + per_worker]) for start in starts]
+    cpu_sets = [set(int(cpu) for cpu in cpu_set.split(',')) for cpu_set in spec.split(';')]
+    return [cpu_sets[i % len(cpu_sets)] for i in range(workers)]
+
+
+def put_detections_into_frame(frame, detections):
+    """
+    Sets detections computed by a worker process into Frame.
+    :param frame: [Frame obj] Frame, that was submitted to InferencePool
+    :param detections: [dict] result of InferencePool.submit
+    :return: [None]
+    """
+    frame.set_person_boxes(detections['person_boxes'])
+    frame.set_person_scores(detections['person_scores'])
+    frame.set_faces(detections['face_boxes'], detections['person_faces'])
+    frame.raw_detections = detections['raw_detections']
+
+
+def _work(worker_index, manager_factory, model_options, cpus, buffer, slot_bytes, tasks, results):
+    """Main loop of a worker process: reads frames from shared memory and returns their detections."""
+    if cpus and hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, cpus)
+    try:
+        model_manager = manager_factory(**model_options)
+    except Exception as e:
+        results.put(('failed', worker_index, str(e)))
+        return
+    results.put(('ready', worker_index, model_manager.version, dict(getattr(model_manager, 'load_times', {}))))
+
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+        task_id, slot, shape, image, threshold_person, threshold_face, face_mode, keep_raw = task
+        try:
+            if slot is not None:
+                # A view of the shared buffer, the frame is not copied
+                size = int(np.prod(shape))
+                image = np.frombuffer(buffer, dtype=np.uint8, count=size, offset=slot * slot_bytes).reshape(shape)
+            frame = Frame(image)
+            model_manager.put_person_predictions_into_frames([frame], threshold_person, keep_raw=keep_raw)
+            model_manager.put_face_predictions_into_frame(frame, threshold_face, face_mode)
+            detections = {
+                'person_boxes': frame.person_boxes,
+                'person_scores': frame.person_scores,
+                'face_boxes': frame.face_boxes,
+                'person_faces': frame.person_faces,
+                'raw_detections': frame.raw_detections,
+            }
+            results.put((task_id, worker_index, detections, None))
+        except Exception as e:
+            results.put((task_id, worker_index, None, str(e)))
+
+
+class InferencePool:
+    """
+    Class, that runs detectors in several worker processes, each with its own ModelManager,
+    so person and face detection are not limited by one Tensorflow session and the GIL.
+    Frames are passed to workers through a ring of slots in shared memory, only their position
+    is sent through the task queue; frames larger than a slot are sent through the queue.
+    Method submit returns a Future of frame detections; waiting for futures in the order of submission
+    gives results in frame order.
+    """
+
+    def __init__(self, workers=2, model_options=None, cpu_sets=None, slots=None, slot_bytes=1920 * 1080 * 3,
+                 manager_factory=create_model_manager):
+        self.workers = workers
+        self.model_options = model_options or {}
+        self.cpu_sets = cpu_sets or [None] * workers
+        self.slots = slots or 4 * workers
+        self.slot_bytes = slot_bytes
+        self.manager_factory = manager_factory
+        self.version = None
+        self.load_times = []
+        self.processed = [0] * workers
+        # Worker processes are spawned, forked Tensorflow runtime is not safe to use
+        self._context = multiprocessing.get_context('spawn')
+        self._buffer = None
+        self._tasks = None
+        self._results = None
+        self._processes = []
+        self._free_slots = Queue()
+        self._futures = {}
+        self._task_ids = itertools.count()
+        self._lock = Lock()
+        self._is_closed = False
+
+    def start(self, timeout=600):
+        """
+        Starts worker processes and waits until all of them have built their models.
+        :param timeout: [float] seconds to wait for every worker
+        :return: [InferencePool obj] self
+        """
+        self._buffer = self._context.RawArray('B', self.slots * self.slot_bytes)
+        self._tasks = self._context.Queue()
+        self._results = self._context.Queue()
+        for slot in range(self.slots):
+            self._free_slots.put(slot)
+
+        logging.log(logging.INFO, 'Starting {} inference workers with {} shared frame slots of {} bytes.'.format(
+            self.workers, self.slots, self.slot_bytes))
+        for i in range(self.workers):
+            process = self._context.Process(
+                target=_work, name='inference-worker-{}'.format(i),
+                args=(i, self.manager_factory, self.model_options, self.cpu_sets[i], self._buffer, self.slot_bytes,
+                      self._tasks, self._results))
+            process.daemon = True
+            process.start()
+            self._processes.append(process)
+
+        for _ in range(self.workers):
+            message = self._results.get(timeout=timeout)
+            if message[0] == 'failed':
+                self.close()
+                raise RuntimeError('Inference worker {} failed to start: {}'.format(message[1], message[2]))
+            self.version = message[2]
+            self.load_times.append(message[3])
+            logging.log(logging.INFO, 'Inference worker {} is ready.'.format(message[1]))
+
+        collector = Thread(target=self.__collect_results, name='inference-results')
+        collector.daemon = True
+        collector.start()
+        return self
+
+    def submit(self, image, threshold_person, threshold_face, face_mode='person', keep_raw=False):
+        """
+        Queues detection of persons and their faces in an image. Waits while all shared slots are in use.
+        :param image: [numpy array] BGR frame
+        :param threshold_person: [float] threshold of person detection algorithm
+        :param threshold_face: [float] threshold of face detection algorithm
+        :param face_mode: [str ('person' or 'frame')] face detection strategy
+        :param keep_raw: [bool] return raw detections too (see ModelManager.put_person_predictions_into_frames)
+        :return: [Future obj] Future of dict with person_boxes, person_scores, face_boxes, person_faces
+                 and raw_detections
+        """
+        future = Future()
+        task_id = next(self._task_ids)
+        slot = None
+        while True:
+            if self._is_closed:
+                raise RuntimeError('Inference pool is closed.')
+            if image.dtype != np.uint8 or image.nbytes > self.slot_bytes:
+                break
+            try:
+                slot = self._free_slots.get(timeout=1)
+                break
+            except Empty:
+                continue
+        if slot is not None:
+            view = np.frombuffer(self._buffer, dtype=np.uint8, count=image.size, offset=slot * self.slot_bytes)
+            view.reshape(image.shape)[...] = image
+        with self._lock:
+            self._futures[task_id] = (future, slot)
+        self._tasks.put((task_id, slot, image.shape, image if slot is None else None,
+                         threshold_person, threshold_face, face_mode, keep_raw))
+        return future
+
+    def stats(self):
+        """
+        :return: [dict] number of workers, frames processed by every worker, frames in progress
+        """
+        with self._lock:
+            return {
+                'workers': self.workers,
+                'processed': list(self.processed),
+                'in_progress': len(self._futures),
+            }
+
+    def close(self):
+        """Stops worker processes."""
+        self._is_closed = True
+        for _ in self._processes:
+            self._tasks.put(None)
+        for process in self._processes:
+            process.join(timeout=10)
+            if process.is_alive():
+                process.terminate()
+        self.__fail_pending('Inference pool is closed.')
+
+    def __collect_results(self):
+        while not self._is_closed:
+            try:
+                task_id, worker_index, detections, error = self._results.get(timeout=1)
+            except Empty:
+                dead = [process.name for process in self._processes if not process.is_alive()]
+                if dead:
+                    logging.log(logging.ERROR, 'Inference workers {} died.'.format(', '.join(dead)))
+                    self._is_closed = True
+                    self.__fail_pending('Inference workers {} died.'.format(', '.join(dead)))
+                continue
+            with self._lock:
+                future, slot = self._futures.pop(task_id)
+                self.processed[worker_index] += 1
+            if slot is not None:
+                self._free_slots.put(slot)
+            if error is None:
+                future.set_result(detections)
+            else:
+                future.set_exception(RuntimeError(error))
+
+    def __fail_pending(self, message):
+        with self._lock:
+            futures, self._futures = self._futures, {}
+        for future, _ in futures.values():
+            future.set_exception(RuntimeError(message))
@@ -0,0 +1,20 @@
+"""
+WSGI entry point for pre-fork servers, e.g.
+
+    gunicorn --preload -c gunicorn.conf.py -b 0.0.0.0:5000 wsgi:app
+
+With --preload this module is imported by the master process: frozen graph is read once and shared by
+the worker, while Tensorflow sessions, that can not be forked, are created after fork (see gunicorn.conf.py).
+The server runs one worker with threads, jobs and storage are kept in its memory.
+"""
+import logging
+
+from main import create_app
+from person_detector import preload_graph
+
+try:
+    preload_graph()
+except IOError as e:
+    # The worker fails to load models too and reports it by /readyz
+    logging.log(logging.ERROR, 'Frozen graph can not be preloaded: {}'.format(e))
+app = create_app(load_models=False)